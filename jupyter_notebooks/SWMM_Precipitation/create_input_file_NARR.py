@@ -7,8 +7,9 @@ import sys
 from tqdm import tqdm
 
 # Raster Data
-import rasterstats as rs
 import geopandas as gpd
+sys.path.insert(1, '../../python/')
+from zonal_statistics import get_geoid_timeseries
 
 # Plotting
 import matplotlib.pyplot as plt
@@ -17,37 +18,11 @@ import calendar
 
 def get_precipitation_timeseries_data(geoid, geotiffs, shape_frame):
     # Returns the precipitation data given a geoid and a list of masked GeoTIFFs
-    # shape = gpd.read_file(shape_file)
-    shape = shape_frame[shape_frame['GEOID10'] == geoid].reset_index()
+    # The band stack is read once per process and the block group's pixels are found once for all of the GeoTIFFs
+    data = get_geoid_timeseries(geoid, shape_frame, geotiffs, all_touched=True)
 
-    # Specify output statistics for zonal_stats
-    output_stats = ['mean']
-
-    # initialize the frame with the first GeoTIFF file
-    name = geotiffs[0][geotiffs[0].rfind('/')+1:geotiffs[0].rfind('.')]
-    stats = rs.zonal_stats(shape, geotiffs[0], stats=output_stats, all_touched=True)
-    frame = pd.DataFrame.from_dict(stats)
-    frame = frame.join(shape['GEOID10'])
-    frame = frame.rename(columns={'mean':name})
-    frame = frame[['GEOID10', name]]
-
-
-    # loop through all the GeoTIFFs and join onto the original frame
-    for file in geotiffs[1:]:
-        name = file[file.rfind('/')+1:file.rfind('.')]
-        stats = rs.zonal_stats(shape, file, stats=output_stats, all_touched=True)
-        sub_frame = pd.DataFrame.from_dict(stats)
-        sub_frame = sub_frame.rename(columns={'mean':name})
-        frame = frame.join(sub_frame)
-
-
-    # Convert to inches
-    data = frame.iloc[0, 1:]
-    data = data.apply(lambda x: x / 25.40)
-
-    # Sort smallest to largest (1, 2, 3, ..., 365)
-    data.index = data.index.astype(int)
-    data = data.sort_index()
+    # Convert to inches (sorted smallest to largest (1, 2, 3, ..., 365))
+    data = data / 25.40
 
     return data.to_numpy()
 
@@ -1,5 +1,7 @@
 import glob
-from swmmtoolbox import swmmtoolbox
+import sys
+sys.path.insert(1, '../../python/')
+from swmm_output import extract  # Memory mapped .out reader, same output as swmmtoolbox.extract
 from matplotlib import pyplot as plt
 import calendar
 import os
@@ -29,13 +31,13 @@ def compare_all(states):
             print('Failed to find one or more files for', state)
             break
 
-        daily_data = swmmtoolbox.extract(daily[0], *extract_vars).resample('d').sum()
-        hourly_data = swmmtoolbox.extract(hourly[0], *extract_vars).resample('d').sum()
-        prism_data = swmmtoolbox.extract(prism[0], *extract_vars).resample('d').sum()
+        daily_data = extract(daily[0], *extract_vars).resample('d').sum()
+        hourly_data = extract(hourly[0], *extract_vars).resample('d').sum()
+        prism_data = extract(prism[0], *extract_vars).resample('d').sum()
 
-        daily_dry_data = swmmtoolbox.extract(daily_dry[0], *extract_vars).resample('d').sum()
-        hourly_dry_data = swmmtoolbox.extract(hourly_dry[0], *extract_vars).resample('d').sum()
-        prism_dry_data = swmmtoolbox.extract(prism_dry[0], *extract_vars).resample('d').sum()
+        daily_dry_data = extract(daily_dry[0], *extract_vars).resample('d').sum()
+        hourly_dry_data = extract(hourly_dry[0], *extract_vars).resample('d').sum()
+        prism_dry_data = extract(prism_dry[0], *extract_vars).resample('d').sum()
 
         for data in ['system__Rainfall', 'system__Evaporation_infiltration', 'system__Runoff']:
             data_name = data[8:]
@@ -107,8 +109,8 @@ def compare_dry_plots(states):
 
             dry_only_yes = glob.glob('./' + sim_type + '/simulation_files/' + state + '*.out')[0]
             dry_only_no = glob.glob('./' + sim_type + '/simulation_files/dry_only_test/' + state + '*.out')[0]
-            dry_only_yes_data = swmmtoolbox.extract(dry_only_yes, *extract_vars).resample('d').sum()
-            dry_only_no_data = swmmtoolbox.extract(dry_only_no, *extract_vars).resample('d').sum()
+            dry_only_yes_data = extract(dry_only_yes, *extract_vars).resample('d').sum()
+            dry_only_no_data = extract(dry_only_no, *extract_vars).resample('d').sum()
 
             for data in ['system__Rainfall', 'system__Evaporation_infiltration', 'system__Runoff']:
                 data_name = data[8:]
@@ -1,8 +1,10 @@
 import os
 import pandas as pd
 import glob
-import geopandas as gpd  # For NARR Precipitation Data
-import rasterstats as rs  # For NARR Precipitation Data
+from functools import lru_cache  # Process level cache of the NARR timeseries
+from zonal_statistics import get_geoid_timeseries  # For NARR Precipitation Data
+from external_files import file_exists  # Cached directory listings of the weather and evaporation files
+import extraction  # Subcatchments the extraction reads from the .out file
 
 # No Green Infrastructure: https://docs.google.com/document/d/1_rnpjv8CfboOivYl6W7affA1tcGYJgd-x4SOpYENsFo/edit
 # Rain Garden: https://docs.google.com/document/d/1rpHAjt9MIGfQ17Wkbi4D-vHnY5gNW7pggtyGmI2G1RM/edit
@@ -15,21 +17,51 @@ overwrite = True
 # Define the absolute path to the Repository (used for path to precipitation and evaporation files)
 _repo_path = '/home/matas/Desktop/CPRHD_WNV_USA_SWMM/'
 
+# Folders containing the external precipitation (<PRISM_ID>.txt) and evaporation (<GEOID10>_EVAP.txt) files
+weather_directory = _repo_path + 'data/input_file_data/weather_data_swmm_format/'
+evaporation_directory = _repo_path + 'data/input_file_data/evaporation_data_timeseries/'
+
+# Folder containing the pre-calculated NARR timeseries (<daily or hourly>/timeseries/<state>.pkl)
+_narr_timeseries_path = _repo_path + 'jupyter_notebooks/SWMM_Precipitation/'
+
+# Number of formatted (precipitation type, state) NARR timeseries to keep in memory
+_narr_cache_size = 16
+
+# What SWMM writes to the .out file, set by the [REPORT] section:
+#   'full'          every subcatchment (and the rain barrel node) and a copy of the input in the report file
+#   'system-only'   the system variables, and only the subcatchments in extraction.subcatchment_variables
+#   'daily-totals'  the same as system-only, with a 24 hour REPORT_STEP
+output_profiles = ('full', 'system-only', 'daily-totals')
+
+# REPORT_STEP of the 'daily-totals' profile, set_output_profile sets it and set_time_steps cannot change it
+_daily_report_step = '24:00:00'
+
 
 class InputFile:
     def __init__(self, row, outfile, sim_type='ng'):
         self.sim_type = str(sim_type)  # Simulation type (ng = No Green Infrastructure, rb = Rain Barrel, rg = Rain Garden)
         self.data = row  # Row of the block group characteristics spreadsheet
 
+        # An already open file (or buffer) can be passed instead of a path, in which case the caller closes it
+        self.owns_file = not hasattr(outfile, 'write')
+
         # Make sure the file does not already exist
-        if os.path.exists(outfile) and not overwrite:
+        if self.owns_file and os.path.exists(outfile) and not overwrite:
             print('File already exists!', outfile)
             exit(1)
 
-        self.file = open(outfile, 'w')
+        self.file = open(outfile, 'w') if self.owns_file else outfile
         self.start = '01/01/1981'
         self.end = '12/31/2014'
         self.precipitation_data_type = 'PRISM'  # other options are narr_daily, narr_hourly
+        self.check_external_files = True  # Assert that the weather and evaporation files exist while writing
+
+        # Time steps of the [OPTIONS] section (HH:MM:SS), see step_tuning.py for choosing them
+        self.report_step = '24:00:00'
+        self.wet_step = '00:06:00'
+        self.dry_step = '00:06:00'
+        self.routing_step = '00:01:00'
+        self.output_profile = 'full'
 
         if self.sim_type == 'rb':
             self.rb_type = 'subcatchment'  # other option is 'lid', using LID Controls instead of subcatchment
@@ -39,6 +71,13 @@ class InputFile:
         self.rb_type = value
 
 
+    def set_output_profile(self, profile):
+        assert profile in output_profiles, 'Unknown output profile ' + str(profile) + ', options are ' + ', '.join(output_profiles)
+        self.output_profile = profile
+        if profile == 'daily-totals':
+            self.report_step = _daily_report_step
+
+
     def set_precipitation_data_type(self, data_type):
         self.precipitation_data_type = str(data_type)
 
@@ -51,6 +90,27 @@ class InputFile:
         self.end = str(date)
 
 
+    def set_time_steps(self, report_step=None, wet_step=None, dry_step=None, routing_step=None):
+        # Steps that are not passed are left unchanged
+        if report_step is not None:
+            if self.output_profile == 'daily-totals' and get_seconds(report_step) != get_seconds(_daily_report_step):
+                raise ValueError('The daily-totals output profile reports every ' + _daily_report_step + ', not every ' + str(report_step))
+            self.report_step = str(report_step)
+        if wet_step is not None:
+            self.wet_step = str(wet_step)
+        if dry_step is not None:
+            self.dry_step = str(dry_step)
+        if routing_step is not None:
+            self.routing_step = str(routing_step)
+
+
+    def get_subcatchment_names(self):
+        # Subcatchments of the input file, Subcatch4 is the roof draining to the rain barrel
+        if self.sim_type == 'rb' and self.rb_type == 'subcatchment':
+            return ['Subcatch1', 'Subcatch4']
+        return ['Subcatch1']
+
+
     def get_sim_name(self):
         sim_types = {'ng': 'No Green Infrastructure',
                      'rb': 'Rain Barrel',
@@ -91,10 +151,10 @@ class InputFile:
                            #'SWEEP_END': self.end[:-5] + '\n',  # Default
 
                            #'DRY_DAYS': '0',  # Default
-                           'REPORT_STEP': '24:00:00',
-                           'WET_STEP': '00:06:00',
-                           'DRY_STEP': '00:06:00',
-                           'ROUTING_STEP': '00:01:00\n',
+                           'REPORT_STEP': self.report_step,
+                           'WET_STEP': self.wet_step,
+                           'DRY_STEP': self.dry_step,
+                           'ROUTING_STEP': self.routing_step + '\n',
 
                            'INERTIAL_DAMPING': 'PARTIAL',  # Only used for Dynamic Wave Flow_Routing
                            #'NORMAL_FLOW_LIMITED': 'BOTH',  # Default
@@ -127,7 +187,8 @@ class InputFile:
     def evaporation(self):
         self.file.write('[EVAPORATION]\n')
         DRY_ONLY = 'YES'
-        assert os.path.exists(_repo_path + 'data/input_file_data/evaporation_data_timeseries/' + self.data['GEOID10'] + '_EVAP.txt'), 'Failed to find external evaporation file'
+        if self.check_external_files:
+            assert file_exists(evaporation_directory, self.data['GEOID10'] + '_EVAP.txt'), 'Failed to find external evaporation file'
         self.file.write('TIMESERIES ' + self.data['GEOID10'] + '_EVAP\n')
         self.file.write('DRY_ONLY\t' + DRY_ONLY + '\n')
 
@@ -140,7 +201,7 @@ class InputFile:
                                           'Form': 'VOLUME',  # form of recorded rainfall
                                           'Interval': '24:00:00',  # time interval between gage readings
                                           'SCF': '1.0',  # snow catch deficiency correction factor (use 1.0 for no adjustment)
-                                          'FILE': 'FILE ' + _repo_path + 'data/input_file_data/weather_data_swmm_format/' + self.data['PRISM_ID'] + '.txt',
+                                          'FILE': 'FILE ' + weather_directory + self.data['PRISM_ID'] + '.txt',
                                           'Sta': self.data['PRISM_ID'],
                                           'Units': 'IN'
                                           }
@@ -156,7 +217,8 @@ class InputFile:
 
         if self.precipitation_data_type == 'PRISM': # Use External File for Data Input
             # Check that the precipitation file exists
-            assert os.path.exists(_repo_path + 'data/input_file_data/weather_data_swmm_format/' + self.data['PRISM_ID'] + '.txt'), 'Failed to find external weather file'
+            if self.check_external_files:
+                assert file_exists(weather_directory, self.data['PRISM_ID'] + '.txt'), 'Failed to find external weather file'
 
             for key in raingage_parameters_file:
                 self.file.write(raingage_parameters_file[key] + '\t')
@@ -503,7 +565,7 @@ class InputFile:
         self.file.write('[TIMESERIES]\n')
         self.file.write(';;Name\t\tDate\t\tTime\t\tValue\n')
         # File Evaporation Data
-        self.file.write(self.data['GEOID10'] + '_EVAP ' + 'FILE ' + _repo_path + 'data/input_file_data/evaporation_data_timeseries/' + self.data['GEOID10'] + '_EVAP.txt\n')
+        self.file.write(self.data['GEOID10'] + '_EVAP ' + 'FILE ' + evaporation_directory + self.data['GEOID10'] + '_EVAP.txt\n')
 
         # NARR Precipitation Data
         if self.precipitation_data_type[:4] == 'narr':
@@ -515,8 +577,7 @@ class InputFile:
             # data = self.get_narr_precipitation_data(shape_file, masked_geotiffs)  # Uncomment to calculate the data on the fly
 
             # The NARR data has been pre-calculated for the 7 block groups we have been considering
-            data = pd.read_pickle('/home/matas/Desktop/CPRHD_WNV_USA_SWMM/jupyter_notebooks/SWMM_Precipitation/' + self.precipitation_data_type[5:] + '/timeseries/' + self.data['STATE'].lower() + '.pkl')
-            data.to_csv(self.file, sep='\t', index=False, header=None)
+            self.file.write(get_narr_timeseries_text(self.precipitation_data_type, self.data['STATE'].lower()))
             self.file.write('\n')
         self.file.write('\n')
 
@@ -535,6 +596,20 @@ class InputFile:
         if self.sim_type == 'rb' and self.rb_type == 'subcatchment':
             report_params['NODES'] = 'Barrel'
 
+        if self.output_profile != 'full':
+            # Only what the extraction reads, the system variables are always written
+            subcatchments = []
+            for subcatchment, _ in extraction.subcatchment_variables:
+                if subcatchment not in subcatchments:
+                    subcatchments.append(subcatchment)
+            unknown = [subcatchment for subcatchment in subcatchments if subcatchment not in self.get_subcatchment_names()]
+            if unknown:
+                raise ValueError('extraction.subcatchment_variables reads ' + ', '.join(unknown) + ', which the ' +
+                                 self.get_sim_name() + ' input files do not have (' + ', '.join(self.get_subcatchment_names()) + ')')
+            report_params['INPUT'] = 'NO'
+            report_params['SUBCATCHMENTS'] = ' '.join(subcatchments) if subcatchments else 'NONE'
+            report_params['NODES'] = 'NONE'
+
         for key, val in report_params.items():
             self.file.write(key + '\t' + val + '\n')
         self.file.write('\n\n')
@@ -557,40 +632,19 @@ class InputFile:
         self.xsections()
         self.timeseries()
         self.report()
-        self.file.close()
+        if self.owns_file:
+            self.file.close()
 
 
     def get_narr_precipitation_data(self, shape_file, masked_geotiffs):
         assert self.start == '01/01/2014' and self.end =='12/31/2014'  # We only have NARR data for 2014
 
-        shape = gpd.read_file(shape_file)
-
-        shape = shape[shape['GEOID10'] == self.data['GEOID10']].reset_index()
-        output_stats = 'mean'
-
-        # initialize the frame with the first GeoTIFF file
-        name = masked_geotiffs[0][masked_geotiffs[0].rfind('/') + 1:masked_geotiffs[0].rfind('.')]
-        stats = rs.zonal_stats(shape, masked_geotiffs[0], stats=output_stats, all_touched=True)
-        frame = pd.DataFrame.from_dict(stats)
-        frame = frame.join(shape['GEOID10'])
-        frame = frame.rename(columns={'mean': name})
-        frame = frame[['GEOID10', name]]
-
-        # loop through all the GeoTIFFs and join onto the original frame
-        for file in masked_geotiffs[1:]:
-            name = file[file.rfind('/') + 1:file.rfind('.')]
-            stats = rs.zonal_stats(shape, file, stats=output_stats, all_touched=True)
-            sub_frame = pd.DataFrame.from_dict(stats)
-            sub_frame = sub_frame.rename(columns={'mean': name})
-            frame = frame.join(sub_frame)
+        # Mean of the block group's pixels in every masked GeoTIFF, sorted smallest to largest (1, 2, 3, ..., 365)
+        # The shape file and GeoTIFFs are only read the first time, later block groups reuse them
+        data = get_geoid_timeseries(self.data['GEOID10'], shape_file, masked_geotiffs)
 
         # Convert to inches
-        data = frame.iloc[0, 1:]
-        data = data.apply(lambda x: x / 25.40)
-
-        # Sort smallest to largest (1, 2, 3, ..., 365)
-        data.index = data.index.astype(int)
-        data = data.sort_index().to_frame('VALUE')
+        data = (data / 25.40).to_frame('VALUE')
 
         if self.precipitation_data_type == 'narr_hourly':
             date_range = pd.date_range(start=self.start, end=pd.to_datetime(self.end) + pd.Timedelta('1 days'), freq='3H')[:-1]
@@ -609,3 +663,18 @@ class InputFile:
 
         data = data[['NAME', 'DATE', 'TIME', 'VALUE']]
         return data
+
+
+@lru_cache(maxsize=_narr_cache_size)
+def get_narr_timeseries_text(precipitation_data_type, state):
+    # Preconditions: A NARR precipitation type (narr_daily, narr_hourly) and a lower case state name have been passed
+    # Postconditions: The state's timeseries has been returned as tab separated text for the [TIMESERIES] section.
+    #                 The pickle is only read and formatted the first time each (type, state) pair is requested.
+    data = pd.read_pickle(_narr_timeseries_path + precipitation_data_type[5:] + '/timeseries/' + state + '.pkl')
+    return data.to_csv(sep='\t', index=False, header=None)
+
+
+def get_seconds(step):
+    # 'HH:MM:SS' time step -> seconds
+    hours, minutes, seconds = (int(value) for value in str(step).split(':'))
+    return hours * 3600 + minutes * 60 + seconds
@@ -0,0 +1,102 @@
+import io
+import os
+import InputFile as input_file_module
+from InputFile import InputFile
+
+
+class _FieldRecorder:
+    # Stands in for a row of the block group characteristics spreadsheet while a template is rendered.
+    # Every column that InputFile reads is replaced with a positional format field ({0}, {1}, ...),
+    # and the columns are kept in the order they were first read.
+    def __init__(self):
+        self.fields = []
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            self.fields.append(key)
+        return '{' + str(self.fields.index(key)) + '}'
+
+
+class InputFileTemplate:
+    def __init__(self, sim_type='ng', rb_type='subcatchment', start=None, end=None, steps=None, output_profile=None):
+        # INPUTS:
+        #   sim_type: ng = No Green Infrastructure, rb = Rain Barrel, rg = Rain Garden
+        #   rb_type (optional): 'subcatchment' or 'lid', only used for Rain Barrel (default subcatchment)
+        #   start, end (optional): simulation start and end date (defaults are the InputFile defaults)
+        #   steps (optional): time steps passed to InputFile.set_time_steps, ex. {'report_step': '01:00:00'}
+        #   output_profile (optional): what the .out file holds, see InputFile.output_profiles (default 'full')
+        #
+        # InputFile.write() is run once against a _FieldRecorder, so the template is exactly the text InputFile
+        # would write, with the block group's values left as format fields. Only PRISM precipitation is supported,
+        # NARR timeseries differ per state and are written with InputFile directly.
+
+        self.sim_type = str(sim_type)
+        self.rb_type = rb_type
+
+        recorder = _FieldRecorder()
+        buffer = io.StringIO()
+
+        file = InputFile(recorder, buffer, self.sim_type)
+        file.check_external_files = False  # The paths only contain format fields here
+        if self.sim_type == 'rb':
+            file.set_rainbarrel_type(rb_type)
+        if start is not None:
+            file.set_start_date(start)
+        if end is not None:
+            file.set_end_date(end)
+        if output_profile is not None:
+            file.set_output_profile(output_profile)
+        if steps is not None:
+            file.set_time_steps(**steps)
+        file.write()
+
+        self.start = file.start  # Simulation window
+        self.end = file.end
+        self.text = buffer.getvalue()
+        self.fields = recorder.fields  # Columns of the characteristics frame, in format field order
+        self._geoid_index = self.fields.index('GEOID10')
+
+
+    def render(self, values):
+        # values: the block group's values, in the same order as self.fields
+        return self.text.format(*values)
+
+
+    def render_row(self, row):
+        # row: row of the block group characteristics spreadsheet (pandas Series or dict)
+        return self.render([row[field] for field in self.fields])
+
+
+    def get_file_name(self, values):
+        return values[self._geoid_index] + '_' + self.sim_type + '.inp'
+
+
+    def write_values(self, values, out_dir):
+        # Writes one input file from a tuple of values ordered like self.fields, returns the path of the file
+        outfile = os.path.join(out_dir, self.get_file_name(values))
+
+        if os.path.exists(outfile) and not input_file_module.overwrite:
+            return outfile  # Keep the existing input file
+
+        with open(outfile, 'w') as file:
+            file.write(self.render(values))  # One write per input file
+        return outfile
+
+
+    def write_all(self, frame, out_dir):
+        # INPUTS:
+        #   frame: block group characteristics dataframe (read with dtype=str)
+        #   out_dir: folder to store the input files in
+        # OUTPUT:
+        #   count: number of input files written
+
+        count = 0
+        for values in frame[self.fields].itertuples(index=False, name=None):
+            self.write_values(values, out_dir)
+            count += 1
+        return count
+
+
+def get_templates(sim_types=('ng', 'rg', 'rb'), rb_type='subcatchment', start=None, end=None, output_profile=None):
+    # Returns a dictionary of sim_type -> InputFileTemplate, compiling each template once
+    return {sim_type: InputFileTemplate(sim_type, rb_type, start, end, output_profile=output_profile) for sim_type in sim_types}
@@ -0,0 +1,341 @@
+import os
+import sys
+import csv
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+import InputFile as input_file_module
+from InputFile import InputFile
+from InputFileTemplate import InputFileTemplate
+from external_files import clear_file_indexes
+from hotstart import run_simulation
+from isolation import run_isolated
+from swmm_output import extract
+from extraction import extract_variables
+from result_store import ResultStore
+
+
+# End-to-end benchmark of the pipeline, built on the Chicago inputs bundled in data/. N block group rows are
+# synthesized from the Chicago input files, and each stage is timed separately:
+#   input_file   InputFile writes the input files
+#   template     InputFileTemplate writes the same input files
+#   simulation   SWMM runs them
+#   isolated     SWMM runs them again, each in its own child process (isolation.py, as with _timeout in the runners)
+#   extraction   the system variables are read from the .out files
+#   daily        the extracted variables are summed by day
+# Every run is appended to the history file with the current commit, and stages that got slower than the previous
+# run of the same size (on another commit) are reported.
+#
+#   python benchmark.py [N] [sim_type ...]
+#   python benchmark.py 20 ng rg rb
+
+
+path_to_data = '../data/'
+history_file = '../logs/benchmark_history.csv'
+
+# Reference extraction of the Chicago No GI simulation (hourly system rainfall)
+reference_file = path_to_data + 'binary_csv/Chicago_U_NoGI.csv'
+
+# Simulation window of the Chicago inputs
+_start = '01/01/1981'
+_end = '12/31/1985'
+
+# Timeout of the isolated simulations, only there to run them in child processes
+_isolation_timeout = 3600
+
+# A stage is reported as a regression when its rate dropped by more than this fraction
+_regression_threshold = 0.20
+
+# Relative spread of the synthesized block group values around the Chicago values
+_spread = 0.25
+
+_history_columns = ['time', 'commit', 'rows', 'stage', 'items', 'seconds', 'per_second', 'mb_per_second']
+
+
+def read_section(input_file, section):
+    # Returns the fields of every line of a section of an input file, without the comment lines
+    lines = []
+    inside = False
+    with open(input_file) as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('['):
+                inside = line.upper() == '[' + section.upper() + ']'
+            elif inside and line and not line.startswith(';'):
+                lines.append(line.split())
+    return lines
+
+
+def get_rows(section_lines, name):
+    return [fields for fields in section_lines if fields[0] == name]
+
+
+def read_chicago_values(input_file):
+    # Characteristics of the Chicago block group, with the column names of the block group characteristics spreadsheet
+    subcatchment = get_rows(read_section(input_file, 'SUBCATCHMENTS'), 'Subcatch1')[0]
+    subarea = get_rows(read_section(input_file, 'SUBAREAS'), 'Subcatch1')[0]
+    infiltration = get_rows(read_section(input_file, 'INFILTRATION'), 'Subcatch1')[0]
+    values = {'Area_acre_30m': subcatchment[3], 'PCT_I_adj_30m': subcatchment[4], 'WIDTH_30m': subcatchment[5],
+              'pctslope_avg_30m': subcatchment[6], 'ROUGH_NI_30m': subarea[2], 'DEPRESS_NI_30m': subarea[4],
+              'GMSH_adj_BG_30m': infiltration[1], 'Keff_adj_BG_30m': infiltration[2], 'AMEP_adj_BG_30m': infiltration[3]}
+
+    controls = read_section(input_file, 'LID_CONTROLS')
+    soil = [fields for fields in controls if fields[:2] == ['RainGarden', 'SOIL']]
+    if soil:
+        storage = [fields for fields in controls if fields[:2] == ['RainGarden', 'STORAGE']][0]
+        usage = get_rows(read_section(input_file, 'LID_USAGE'), 'Subcatch1')[0]
+        values.update({'RG1_PCT_I_adj_30m': subcatchment[4], 'RG1_POROSITY': soil[0][3], 'RG1_FIELDCAP': soil[0][4],
+                       'RG1_WILTPT': soil[0][5], 'RG1_Ks': soil[0][6], 'RG1_Ks_SLOPE': soil[0][7], 'RG1_SH': soil[0][8],
+                       'RG1_SEEPAGE': storage[4], 'RG1_AREA_SQRFT': usage[3], 'RG1_PCT_I_TREAT_30m': usage[6]})
+    return values
+
+
+def get_chicago_rainfall():
+    # Returns the PRISM ID and the (date, value) pairs of the Chicago rainfall timeseries (P_<PRISM ID>)
+    rainfall = read_section(path_to_data + 'Chicago_U_NoGI.inp', 'TIMESERIES')
+    return rainfall[0][0].split('_')[1], [(fields[1], fields[3]) for fields in rainfall]
+
+
+def synthesize_rows(n, seed=0):
+    # INPUTS:
+    #   n: number of block groups, they all use the Chicago rainfall
+    #   seed (optional): seed of the random spread, so runs of the same size are comparable
+
+    # OUTPUT:
+    #   frame: n rows of block group characteristics (strings, like the spreadsheet). The No GI values come from
+    #          Chicago_U_NoGI.inp, the rain garden values alternate between Chicago_U_RG1.inp and Chicago_U_RG3A.inp,
+    #          and every value is spread by up to _spread. The rain barrel columns, which have no Chicago input, are
+    #          derived from the block group's area.
+
+    no_gi = read_chicago_values(path_to_data + 'Chicago_U_NoGI.inp')
+    rain_gardens = [read_chicago_values(path_to_data + 'Chicago_U_RG1.inp'), read_chicago_values(path_to_data + 'Chicago_U_RG3A.inp')]
+    prism_id = get_chicago_rainfall()[0]
+    random = np.random.default_rng(seed)
+
+    rows = []
+    for i in range(n):
+        base = dict(no_gi)
+        base.update({key: value for key, value in rain_gardens[i % 2].items() if key.startswith('RG1_')})
+        row = {key: float(value) * random.uniform(1 - _spread, 1 + _spread) for key, value in base.items()}
+        for column in ['PCT_I_adj_30m', 'RG1_PCT_I_adj_30m', 'RG1_PCT_I_TREAT_30m']:
+            row[column] = min(row[column], 100.0)
+        for column in ['RG1_FIELDCAP', 'RG1_WILTPT']:  # The soil must hold less water than its porosity
+            row[column] = min(row[column], row['RG1_POROSITY'] * 0.9)
+
+        # Rain barrels: a tenth of the area is roof draining to the barrels
+        row['SCA_ROOF_ACRE'] = row['Area_acre_30m'] * 0.1
+        row['SCA_ROOF_WIDTH'] = row['WIDTH_30m'] * 0.1
+        row['RB_SC1_ACRE_30m'] = row['Area_acre_30m'] - row['SCA_ROOF_ACRE']
+        row['RB_SC1_PCT_I_30m'] = max(row['PCT_I_adj_30m'] - 10.0, 0.0)
+        row['RB_SC1_WIDTH_30m'] = row['WIDTH_30m'] * 0.9
+        row['NUM_RB_INTEGER'] = int(row['SCA_ROOF_ACRE'] * 10)
+        row['RB_STORE_SQRFT'] = row['NUM_RB_INTEGER'] * 4.0
+        row['PCT_ISA_treated_RB_30'] = 10.0
+
+        row = {key: str(value) for key, value in row.items()}
+        row.update({'GEOID10': '17031%07d' % i, 'STATE': 'Illinois', 'COUNTY': 'Cook', 'TRACT': '%06d' % (i // 4),
+                    'BG_ID': str(i % 4 + 1), 'PRISM_ID': prism_id})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_external_files(directory, geoids):
+    # Writes the external files the synthesized input files read, from the Chicago rainfall timeseries and monthly
+    # evaporation. Returns the weather and evaporation directories.
+    weather_directory = os.path.join(directory, 'weather') + '/'
+    evaporation_directory = os.path.join(directory, 'evaporation') + '/'
+    os.makedirs(weather_directory)
+    os.makedirs(evaporation_directory)
+
+    prism_id, rainfall = get_chicago_rainfall()
+    with open(weather_directory + prism_id + '.txt', 'w') as file:  # SWMM user prepared format: STA YYYY MM DD HH mm value
+        for date, value in rainfall:
+            month, day, year = date.split('/')
+            file.write(prism_id + ' ' + year + ' ' + month + ' ' + day + ' 00 00 ' + value + '\n')
+
+    monthly = [float(value) for value in read_section(path_to_data + 'Chicago_U_NoGI.inp', 'EVAPORATION')[0][1:13]]
+    dates = pd.date_range(_start, _end, freq='D')
+    evaporation_file = evaporation_directory + 'chicago_EVAP.txt'
+    with open(evaporation_file, 'w') as file:
+        for date in dates:
+            file.write(date.strftime('%m/%d/%Y') + ' 00:00 ' + str(monthly[date.month - 1]) + '\n')
+    for geoid in geoids:  # Every block group has its own file, like the real evaporation data
+        os.link(evaporation_file, evaporation_directory + geoid + '_EVAP.txt')
+    return weather_directory, evaporation_directory
+
+
+def get_megabytes(files):
+    return sum(os.path.getsize(file) for file in files) / 1e6
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def check_reference(directory):
+    # Runs the bundled Chicago No GI simulation and compares its extracted rainfall to the reference extraction
+    input_file = shutil.copy(path_to_data + 'Chicago_U_NoGI.inp', directory)
+    run_simulation(input_file)
+    frame = extract(input_file[:-4] + '.out', 'system,Rainfall,Rainfall')
+    reference = pd.read_csv(reference_file, index_col=0, parse_dates=True)
+    difference = np.abs(frame.iloc[:, 0].values - reference.iloc[:, 0].reindex(frame.index).values)
+    assert np.nanmax(difference) < 1e-4, 'The extracted Chicago rainfall differs from ' + reference_file
+    os.remove(input_file[:-4] + '.out')
+
+
+def check_result_store(directory):
+    # Stores the results of one block group and links another one to it: reading a prefix with only the linked block
+    # group returns the results of its source, with the same columns and types
+    store = ResultStore(os.path.join(directory, 'result_store'))
+    results = pd.DataFrame({'rainfall': [0.5, 1.0], 'runoff': [0.1, 0.2]}, index=pd.date_range('1981-01-01', periods=2, name='date'))
+    store.append('170319800001_ng', results)
+    store.flush()
+    store.link([('180010000001_ng', '170319800001_ng')])
+    source = store.read(geoids=['170319800001'])
+    linked = store.read(prefix='18001')
+    assert list(linked.columns) == list(source.columns), 'The linked results do not have the columns of the stored results'
+    assert (linked.dtypes == source.dtypes).all(), 'The linked results do not have the types of the stored results'
+    assert np.array_equal(linked[['rainfall', 'runoff']].values, source[['rainfall', 'runoff']].values), 'The linked results differ from their source'
+    shutil.rmtree(store.directory)
+
+
+def run_benchmark(n, sim_types=('ng', 'rg', 'rb'), directory=None):
+    # INPUTS:
+    #   n: number of synthesized block groups
+    #   sim_types (optional): simulation types to generate and run for every block group
+    #   directory (optional): scratch folder, a temporary folder by default (deleted at the end)
+
+    # OUTPUT:
+    #   results: one row per stage with the number of items, seconds, items per second and MB per second
+
+    scratch = tempfile.mkdtemp(dir=directory)
+    saved_directories = input_file_module.weather_directory, input_file_module.evaporation_directory
+    try:
+        check_reference(scratch)
+        check_result_store(scratch)
+
+        frame = synthesize_rows(n)
+        weather_directory, evaporation_directory = write_external_files(scratch, frame['GEOID10'])
+        input_file_module.weather_directory = weather_directory
+        input_file_module.evaporation_directory = evaporation_directory
+        clear_file_indexes()
+
+        results = []
+
+        def add_result(stage, items, seconds, megabytes):
+            results.append({'stage': stage, 'items': items, 'seconds': seconds, 'per_second': items / seconds,
+                            'mb_per_second': megabytes / seconds})
+
+        # InputFile
+        input_files = []
+        start = time.perf_counter()
+        for sim_type in sim_types:
+            for _, row in frame.iterrows():
+                outfile = os.path.join(scratch, row['GEOID10'] + '_' + sim_type + '.inp')
+                file = InputFile(row, outfile, sim_type)
+                file.set_start_date(_start)
+                file.set_end_date(_end)
+                file.write()
+                input_files.append(outfile)
+        add_result('input_file', len(input_files), time.perf_counter() - start, get_megabytes(input_files))
+
+        # InputFileTemplate (the files are written to their own folder, so the simulations use the InputFile ones)
+        template_directory = os.path.join(scratch, 'template')
+        os.makedirs(template_directory)
+        start = time.perf_counter()
+        for sim_type in sim_types:
+            InputFileTemplate(sim_type, start=_start, end=_end).write_all(frame, template_directory)
+        template_files = [os.path.join(template_directory, name) for name in os.listdir(template_directory)]
+        add_result('template', len(template_files), time.perf_counter() - start, get_megabytes(template_files))
+
+        # Simulation
+        start = time.perf_counter()
+        for input_file in input_files:
+            run_simulation(input_file)
+        seconds = time.perf_counter() - start
+        output_files = [input_file[:-4] + '.out' for input_file in input_files]
+        report_files = [input_file[:-4] + '.rpt' for input_file in input_files]
+        add_result('simulation', len(input_files), seconds, get_megabytes(output_files + report_files))
+
+        # The same simulations in child processes, the difference with 'simulation' is the cost of the isolation
+        start = time.perf_counter()
+        for input_file in input_files:
+            run_isolated(run_simulation, input_file, timeout=_isolation_timeout)
+        add_result('isolated', len(input_files), time.perf_counter() - start, get_megabytes(output_files + report_files))
+
+        # Extraction, then daily aggregation of the extracted variables
+        start = time.perf_counter()
+        frames = [extract_variables(output_file, daily=False) for output_file in output_files]
+        add_result('extraction', len(output_files), time.perf_counter() - start, get_megabytes(output_files))
+
+        start = time.perf_counter()
+        for extracted in frames:
+            extracted.resample('D').sum()
+        add_result('daily', len(frames), time.perf_counter() - start, sum(extracted.memory_usage().sum() for extracted in frames) / 1e6)
+    finally:
+        input_file_module.weather_directory, input_file_module.evaporation_directory = saved_directories
+        clear_file_indexes()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return pd.DataFrame(results)
+
+
+def load_benchmark_history():
+    if not os.path.exists(history_file):
+        return pd.DataFrame(columns=_history_columns)
+    return pd.read_csv(history_file, dtype={'commit': str}, keep_default_na=False)
+
+
+def find_regressions(results, history, rows, commit):
+    # Returns the stages whose rate dropped by more than _regression_threshold since the last run of the same size on
+    # another commit, as (stage, previous commit, previous rate, rate)
+    history = history.loc[(history['rows'].astype(int) == rows) & (history['commit'] != commit)]
+    regressions = []
+    for result in results.itertuples():
+        previous = history.loc[history['stage'] == result.stage]
+        if len(previous) == 0:
+            continue
+        previous = previous.iloc[-1]
+        if result.per_second < float(previous['per_second']) * (1 - _regression_threshold):
+            regressions.append((result.stage, previous['commit'], float(previous['per_second']), result.per_second))
+    return regressions
+
+
+def write_benchmark_history(results, rows, commit):
+    directory = os.path.dirname(history_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    new_file = not os.path.exists(history_file)
+    now = datetime.now().isoformat(timespec='seconds')
+    with open(history_file, 'a', newline='') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(_history_columns)
+        for result in results.itertuples():
+            writer.writerow([now, commit, rows, result.stage, result.items, round(result.seconds, 4),
+                             round(result.per_second, 3), round(result.mb_per_second, 3)])
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    sim_types = tuple(sys.argv[2:]) or ('ng', 'rg', 'rb')
+    commit = get_commit()
+
+    results = run_benchmark(rows, sim_types)
+    print(results.to_string(index=False, float_format='%.3f'))
+
+    for stage, previous_commit, previous, rate in find_regressions(results, load_benchmark_history(), rows, commit):
+        print('Regression: %s %.3f/s, was %.3f/s at %s' % (stage, rate, previous, previous_commit))
+    write_benchmark_history(results, rows, commit)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import os
+import sys
+import csv
+import time
+import queue
+import tempfile
+from datetime import datetime
+
+
+# A worker is removed whenever the host is under pressure: less available memory than this fraction of the total,
+# a load average above this many processes per core, or a small fsync'ed write to the output disk slower than this
+_min_available_memory = 0.10
+_max_load_per_core = 1.5
+_max_write_seconds = 0.5
+
+# A window whose throughput is this much lower than the previous window's counts as a drop
+_tolerance = 0.05
+
+# Number of times the direction is reversed before the best setting seen is kept as the steady state
+_reversals = 2
+
+_history_columns = ['time', 'label', 'processes', 'sims_per_minute']
+
+
+def get_cpu_count():
+    # Cores this process may run on (a batch scheduler may allow fewer than the host has)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_available_memory():
+    # Returns the fraction of the memory that is available, or None on hosts without /proc/meminfo
+    try:
+        with open('/proc/meminfo') as file:
+            values = {line.split(':')[0]: int(line.split()[1]) for line in file}
+        return values['MemAvailable'] / values['MemTotal']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def get_load_per_core():
+    try:
+        return os.getloadavg()[0] / get_cpu_count()
+    except (AttributeError, OSError):
+        return None
+
+
+def get_write_seconds(directory):
+    # Seconds to write and fsync 64 KB in directory, the latency the workers' output files see
+    start = time.time()
+    with tempfile.NamedTemporaryFile(dir=directory) as file:
+        file.write(b'\0' * 65536)
+        file.flush()
+        os.fsync(file.fileno())
+    return time.time() - start
+
+
+def load_steady_state(history_file, label):
+    # Returns the last steady number of processes logged for label, or None
+    if not os.path.exists(history_file):
+        return None
+    processes = None
+    with open(history_file, newline='') as file:
+        for row in csv.DictReader(file):
+            if row['label'] == label:
+                processes = int(row['processes'])
+    return processes
+
+
+class ConcurrencyTuner:
+    # Adjusts the number of workers of a running pool by hill climbing on the measured throughput. After each window
+    # the number of workers is moved one step, and the direction is reversed when the throughput dropped. Once it has
+    # been reversed _reversals times, the setting with the best throughput is kept (the steady state) and logged.
+    # Memory, load or disk write pressure removes a worker at any time.
+    #
+    #   tuner = ConcurrencyTuner(16, label='jit_rb_subcatchment', directory='../result_store/')
+    #   ... start at most tuner.limit jobs at a time ...
+    #   tuner.completed(weight)  # as each job finishes
+    #   tuner.update()           # often, returns the new limit
+
+    def __init__(self, maximum, start=None, minimum=1, label='', directory='.', history_file=None, window_seconds=120):
+        # INPUTS:
+        #   maximum: largest number of workers (the size of the pool)
+        #   start (optional): first number of workers, the last steady state of label in history_file or maximum
+        #   minimum (optional): smallest number of workers, the number is fixed when it is the same as maximum
+        #   label (optional): name of the kind of run, the best setting differs between simulation types
+        #   directory (optional): folder the workers write to, used to measure the write latency
+        #   history_file (optional): CSV file the steady states are appended to
+        #   window_seconds (optional): shortest time the throughput of a setting is measured over
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.label = label
+        self.directory = directory
+        self.history_file = history_file
+        self.window_seconds = window_seconds
+
+        if start is None and history_file is not None:
+            start = load_steady_state(history_file, label)
+        self.limit = max(self.minimum, min(maximum, start or maximum))
+        self.steady = self.minimum == self.maximum
+        self.direction = -1 if self.limit == maximum else 1
+        self.reversals = 0
+        self.previous = None
+        self.throughputs = {}  # Best weighted throughput of each limit
+        self.sims_per_minute = {}  # Simulations per minute of the window with that throughput
+
+        self._start_window(time.time())
+
+
+    def _start_window(self, now):
+        self.window_start = now
+        self.window_weight = 0.0
+        self.window_count = 0
+
+
+    def completed(self, weight=1.0):
+        # weight: estimated cost of the finished job, so that a window of long jobs is not taken as a slow setting
+        self.window_weight += weight
+        self.window_count += 1
+
+
+    def get_pressure(self):
+        # Returns the reason the host is under pressure, or None
+        memory = get_available_memory()
+        if memory is not None and memory < _min_available_memory:
+            return 'available memory %.0f%%' % (memory * 100)
+        load = get_load_per_core()
+        if load is not None and load > _max_load_per_core:
+            return 'load %.2f per core' % load
+        try:
+            write_seconds = get_write_seconds(self.directory)
+        except OSError:
+            return None
+        if write_seconds > _max_write_seconds:
+            return 'disk write %.2fs' % write_seconds
+        return None
+
+
+    def update(self, now=None):
+        # Ends the window once it is long enough and enough jobs finished in it, returns the (new) limit
+        now = time.time() if now is None else now
+        elapsed = now - self.window_start
+        if elapsed < self.window_seconds or self.window_count < self.limit:
+            return self.limit
+
+        throughput = self.window_weight / elapsed
+        sims_per_minute = self.window_count / elapsed * 60
+        if throughput >= self.throughputs.get(self.limit, 0.0):
+            self.throughputs[self.limit] = throughput
+            self.sims_per_minute[self.limit] = sims_per_minute
+        self._start_window(now)
+
+        pressure = self.get_pressure()
+        if pressure is not None:
+            if self.limit > self.minimum:
+                self._log('Under pressure (' + pressure + '), %d -> %d processes' % (self.limit, self.limit - 1))
+                self.limit -= 1
+            return self.limit
+        if self.steady:
+            return self.limit
+
+        if self.previous is not None and throughput < self.previous * (1 - _tolerance):
+            self.direction = -self.direction
+            self.reversals += 1
+        self.previous = throughput
+
+        step = self.limit + self.direction
+        if step < self.minimum or step > self.maximum:
+            self.direction = -self.direction
+            self.reversals += 1
+            step = self.limit + self.direction
+
+        if self.reversals >= _reversals or not self.minimum <= step <= self.maximum:
+            self.limit = max(self.throughputs, key=self.throughputs.get)
+            self.steady = True
+            self._log('Steady state: %d processes, %.1f sims/min' % (self.limit, self.sims_per_minute[self.limit]))
+            self._write_steady_state(self.sims_per_minute[self.limit])
+        else:
+            self._log('%.1f sims/min with %d processes, trying %d' % (sims_per_minute, self.limit, step))
+            self.limit = step
+        return self.limit
+
+
+    def _log(self, message):
+        # Runners send their own stdout to /dev/null
+        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), self.label, message, file=sys.__stdout__, flush=True)
+
+
+    def _write_steady_state(self, sims_per_minute):
+        if self.history_file is None:
+            return
+        directory = os.path.dirname(self.history_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_file = not os.path.exists(self.history_file)
+        with open(self.history_file, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(_history_columns)
+            writer.writerow([datetime.now().isoformat(timespec='seconds'), self.label, self.limit, round(sims_per_minute, 2)])
+
+
+def make_tuner(processes, label, directory, history_file):
+    # processes: a fixed number of workers, or None to tune it between 1 and the number of cores
+    if processes is None:
+        return ConcurrencyTuner(get_cpu_count(), label=label, directory=directory, history_file=history_file)
+    return ConcurrencyTuner(processes, minimum=processes, label=label, directory=directory)
+
+
+def imap_adaptive(pool, function, items, tuner, weights=None, poll_seconds=5):
+    # Like pool.imap_unordered(function, items, chunksize=1), but items are started in order with at most tuner.limit
+    # of them running at a time. The pool must have tuner.maximum processes, the extra ones wait idle.
+    # weights (optional): estimated cost of each item, passed to tuner.completed
+    results = queue.Queue()
+    items = iter(items)
+    weights = iter(weights) if weights is not None else None
+    running = 0
+    exhausted = False
+
+    while True:
+        while not exhausted and running < tuner.limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            weight = next(weights) if weights is not None else 1.0
+            pool.apply_async(function, (item,), callback=lambda result, weight=weight: results.put((result, weight, None)),
+                             error_callback=lambda error: results.put((None, 0.0, error)))
+            running += 1
+        if running == 0:
+            return
+
+        try:
+            result, weight, error = results.get(timeout=poll_seconds)
+        except queue.Empty:
+            tuner.update()
+            continue
+        running -= 1
+        if error is not None:
+            raise error
+        tuner.completed(weight)
+        tuner.update()
+        yield result
@@ -1,34 +1,140 @@
+import os
 import pandas as pd
-from pandarallel import pandarallel  # Multiprocessing a pandas DataFrame
-from InputFile import InputFile
+from multiprocessing import Pool
+from tqdm import tqdm  # Progress bar
+import InputFile as input_file_module
+from InputFile import InputFile, weather_directory, evaporation_directory
+from external_files import missing_external_files
+from InputFileTemplate import get_templates
+from concurrency import make_tuner, imap_adaptive
 
 
-def main():
-    # Number of processes to create when multiprocessing
-    num_processes = 4
+# Simulation types to create input files for (ng = No Green Infrastructure, rb = Rain Barrel, rg = Rain Garden)
+_sim_types = ('ng', 'rg', 'rb')
+_rb_type = 'subcatchment'  # other option is 'lid'
+
+# What the input files write to the .out file, see InputFile.output_profiles. 'system-only' writes only what
+# extraction.py reads, use 'full' to keep every subcatchment variable in the .out files.
+_output_profile = 'full'
+
+# Precipitation input of the input files. The templates only support 'PRISM' (an external weather file per PRISM cell),
+# 'narr_daily' and 'narr_hourly' write the state's NARR timeseries in each file with InputFile, which is slower.
+_precipitation_data_type = 'PRISM'
+
+# Folder that will contain one sub-folder of input files per simulation type
+_out_dir = '/home/matas/Desktop/all_input_files/'
+
+# Report of block groups whose external weather or evaporation file is missing
+_missing_files_report = '../data/input_file_data/missing_external_files.csv'
+
+# Number of block groups sent to a worker at a time
+_chunk_size = 2000
 
+# Number of processes to create when multiprocessing, None tunes it while the files are written (concurrency.py)
+_max_processes = None
+
+# Steady number of processes found for each set of simulation types, the next run starts from it
+_concurrency_history_file = '../logs/concurrency_history.csv'
+
+# Set in each worker process by _initialize_worker
+_templates = {}
+_positions = {}
+_columns = []
+
+
+def main():
     # Load the Block Group Characteristics Data
     characteristics_file = '../data/input_file_data/Selected_BG_inputs_20191212.csv'
     characteristics_frame = pd.read_csv(characteristics_file, skip_blank_lines=True, low_memory=False, dtype=str)  # Read the green infrastructure data to a pandas dataframe
 
-    # Load the Evaporation Data
-    evaporation_data = pd.read_pickle('../data/input_file_data/evaporation_converted.pkl')
+    # Pre-flight check of the external weather and evaporation files, before any input file is written
+    missing = missing_external_files(characteristics_frame, weather_directory, evaporation_directory)
+    if _precipitation_data_type != 'PRISM':
+        missing = missing.loc[missing['missing_evaporation']]  # The NARR precipitation is written in the input files
+    if len(missing) > 0:
+        missing.to_csv(_missing_files_report, index=False)
+        print(len(missing), 'block groups are missing external weather or evaporation files, see', _missing_files_report)
+        exit(1)
 
-    # Initialize pandarallel
-    pandarallel.initialize(nb_workers=num_processes, progress_bar=True, verbose=1, use_memory_fs=True)
+    # The evaporation data is read by SWMM from the external <GEOID10>_EVAP.txt timeseries files, so only the
+    # characteristics columns used by the templates are sent to the workers (NARR input files use the same columns)
+    columns = get_columns(get_templates(_sim_types, _rb_type, output_profile=_output_profile))
 
-    # Set simulation type (ng = No Green Infrastructure, rb = Rain Barrel, rg = Rain Garden)
-    sim_type = 'ng'
+    for sim_type in _sim_types:
+        os.makedirs(_out_dir + sim_type, exist_ok=True)
 
-    # Apply the create_input_function to each GEOID in the block group characteristics frame
-    characteristics_frame.parallel_apply(lambda x: create_input_file(x, evaporation_data.loc[x['GEOID10']], sim_type), axis=1)
+    chunks = split_frame(characteristics_frame[columns], _chunk_size)
+    progress = tqdm(total=len(characteristics_frame) * len(_sim_types))
+
+    # Writing input files is bound by the disk more than by the cores, so the tuner also watches the write latency
+    tuner = make_tuner(_max_processes, 'create_input_files_' + '_'.join(_sim_types), _out_dir, _concurrency_history_file)
+    with Pool(tuner.maximum, initializer=_initialize_worker, initargs=(columns, _sim_types, _rb_type, _output_profile, _precipitation_data_type)) as pool:
+        for count in imap_adaptive(pool, write_chunk, chunks, tuner):
+            progress.update(count)  # Progress is reported as each chunk finishes
+    progress.close()
     return
 
 
-def create_input_file(row, evap, sim_type):
-    out_dir = '/home/matas/Desktop/all_input_files/ng/'
-    outfile = out_dir + row['GEOID10'] + '_' + sim_type + '.inp'
-    file = InputFile(row, outfile, evap, sim_type)
+def get_columns(templates):
+    # Returns every characteristics column used by the templates, in a fixed order
+    columns = []
+    for template in templates.values():
+        for field in template.fields:
+            if field not in columns:
+                columns.append(field)
+    return columns
+
+
+def split_frame(frame, chunk_size):
+    # Yields contiguous chunks of the frame as lists of plain tuples, which are cheap to pickle
+    for start in range(0, len(frame), chunk_size):
+        yield list(frame.iloc[start:start + chunk_size].itertuples(index=False, name=None))
+
+
+def _initialize_worker(columns, sim_types, rb_type, output_profile, precipitation_data_type):
+    # Compile the templates once per worker, and find where each template's fields are in the chunk tuples
+    global _templates, _positions, _columns, _precipitation_data_type
+    _columns = columns
+    _precipitation_data_type = precipitation_data_type
+    _templates = get_templates(sim_types, rb_type, output_profile=output_profile)
+    _positions = {sim_type: [columns.index(field) for field in template.fields] for sim_type, template in _templates.items()}
+
+
+def write_chunk(chunk):
+    # Writes the input files of every simulation type for a chunk of block groups, returns the number of files written
+    count = 0
+    for row in chunk:
+        if _precipitation_data_type != 'PRISM':
+            values = dict(zip(_columns, row))
+            for sim_type in _templates:
+                create_input_file(values, sim_type)
+                count += 1
+            continue
+
+        for sim_type, template in _templates.items():
+            template.write_values([row[i] for i in _positions[sim_type]], _out_dir + sim_type)
+            count += 1
+    return count
+
+
+def create_input_file(row, sim_type):
+    # Creates a single input file with InputFile (used for NARR precipitation, which the templates do not support)
+    # INPUTS:
+    #   row: the block group's characteristics, by column name
+    #   sim_type: simulation type of the input file
+    outfile = _out_dir + sim_type + '/' + row['GEOID10'] + '_' + sim_type + '.inp'
+    if os.path.exists(outfile) and not input_file_module.overwrite:
+        return  # Keep the existing input file, like InputFileTemplate.write_values
+
+    file = InputFile(row, outfile, sim_type)
+    file.check_external_files = False  # Checked for every block group before any file is written
+    file.set_precipitation_data_type(_precipitation_data_type)
+    if _precipitation_data_type != 'PRISM':
+        file.set_start_date('01/01/2014')  # The NARR timeseries only cover 2014
+        file.set_end_date('12/31/2014')
+    file.set_output_profile(_output_profile)
+    if sim_type == 'rb':
+        file.set_rainbarrel_type(_rb_type)
     file.write()
     return
 
@@ -0,0 +1,47 @@
+import os
+
+
+# Directory -> set of file names, filled once per directory per process
+_file_indexes = {}
+
+
+def get_file_index(directory):
+    # Preconditions: A directory has been passed
+    # Postconditions: A set of the names of the files in the directory has been returned. The directory is only scanned
+    #                 the first time it is requested, so checking a file costs a set lookup instead of a filesystem call.
+    if directory not in _file_indexes:
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                _file_indexes[directory] = set(entry.name for entry in entries)
+        else:
+            _file_indexes[directory] = set()
+    return _file_indexes[directory]
+
+
+def file_exists(directory, file_name):
+    return file_name in get_file_index(directory)
+
+
+def clear_file_indexes():
+    # Forget the scanned directories (use after adding weather or evaporation files)
+    _file_indexes.clear()
+
+
+def missing_external_files(frame, weather_directory, evaporation_directory):
+    # INPUTS:
+    #   frame: block group characteristics dataframe (needs GEOID10 and PRISM_ID)
+    #   weather_directory: folder containing the <PRISM_ID>.txt precipitation files
+    #   evaporation_directory: folder containing the <GEOID10>_EVAP.txt evaporation files
+
+    # OUTPUT:
+    #   report: dataframe of every block group missing its weather and/or evaporation file
+
+    weather_files = get_file_index(weather_directory)
+    evaporation_files = get_file_index(evaporation_directory)
+
+    report = frame[['GEOID10', 'PRISM_ID']].copy()
+    report['missing_weather'] = ~(report['PRISM_ID'] + '.txt').isin(weather_files)
+    report['missing_evaporation'] = ~(report['GEOID10'] + '_EVAP.txt').isin(evaporation_files)
+
+    report = report.loc[report['missing_weather'] | report['missing_evaporation']]
+    return report.reset_index(drop=True)
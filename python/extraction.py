@@ -0,0 +1,74 @@
+from swmm_output import extract  # Memory mapped reader of the binary .out file
+
+
+# Which system catalog variables we extract from every simulation, and their column names
+system_variables = ['Rainfall', 'Evaporation_infiltration', 'Runoff', 'Total_lateral_inflow', 'Flow_leaving_outfalls', 'Evaporation_rate', 'Potential_PET']
+column_names = ['rainfall', 'evaporation_infiltration', 'runoff', 'total_lateral_inflow', 'flow_leaving_outfalls', 'evaporation_rate', 'potential_PET']
+
+# Subcatchment variables extracted along with the system variables, as (subcatchment, variable)
+# ex. [('Subcatch1', 'Runoff_rate'), ('Subcatch1', 'Infiltration_loss')]
+subcatchment_variables = []
+
+
+def get_labels(subcatchments=None):
+    # Returns the swmmtoolbox labels (type,name,variable) and column names of every configured variable
+    if subcatchments is None:
+        subcatchments = subcatchment_variables
+
+    labels = ['system,' + variable + ',' + variable for variable in system_variables]
+    columns = list(column_names)
+    for subcatchment, variable in subcatchments:
+        labels.append('subcatchment,' + subcatchment + ',' + variable)
+        columns.append(subcatchment.lower() + '_' + variable.lower())
+    return labels, columns
+
+
+def get_report_section(text):
+    # Returns the [REPORT] options of an input file's text, ex. {'SUBCATCHMENTS': ['ALL'], 'NODES': ['NONE']}
+    options = {}
+    inside = False
+    for line in text.splitlines():
+        line = line.split(';')[0].strip()
+        if line.startswith('['):
+            inside = line.upper() == '[REPORT]'
+        elif inside and line:
+            fields = line.split()
+            options.setdefault(fields[0].upper(), []).extend(fields[1:])
+    return options
+
+
+def get_missing_variables(text, subcatchments=None):
+    # INPUTS:
+    #   text: content of an input file
+    #   subcatchments (optional): (subcatchment, variable) pairs to extract (default subcatchment_variables)
+
+    # OUTPUT:
+    #   missing: the extraction labels that the input file does not write to the .out file (system variables are
+    #            always written). An input file with SUBCATCHMENTS NONE cannot be extracted with subcatchment variables.
+
+    if subcatchments is None:
+        subcatchments = subcatchment_variables
+    reported = [name.upper() for name in get_report_section(text).get('SUBCATCHMENTS', ['NONE'])]
+    return ['subcatchment,' + subcatchment + ',' + variable for subcatchment, variable in subcatchments
+            if 'ALL' not in reported and subcatchment.upper() not in reported]
+
+
+def check_report_coverage(text, subcatchments=None):
+    missing = get_missing_variables(text, subcatchments)
+    if missing:
+        raise ValueError('The input files do not write ' + ', '.join(missing) + ' to the .out file, see InputFile.output_profiles')
+
+
+def extract_variables(output_file, daily=True, subcatchments=None):
+    # Preconditions: A binary .out file generated by SWMM has been passed
+    # Postconditions: A dataframe of the system variables and the configured subcatchment variables has been returned,
+    #                 summed by day if daily is True. The index is named 'date'.
+
+    labels, columns = get_labels(subcatchments)
+    frame = extract(output_file, *labels)  # Extract all parameters, the header is only parsed once
+
+    if daily:
+        frame = frame.resample('D').sum()  # Group by day and sum
+    frame.columns = columns
+    frame.index.name = 'date'
+    return frame
@@ -0,0 +1,52 @@
+import os
+import pandas as pd
+from pyswmm import Simulation
+
+
+# Hotstart files hold the state of a simulation (ponded water, soil moisture, groundwater, LID storage) at its end.
+# They are named <GEOID10>_<sim_type>_<YYYYMMDD>.hsf after the last simulated day, so a simulation of the following
+# days (ex. a new year of weather data) can continue from the state of the run that ended the day before it starts.
+
+
+def get_name(input_file):
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+
+def get_hotstart_file(directory, name, date):
+    # Hotstart file of the simulation name, saved at the end of date
+    return os.path.join(directory, name + '_' + pd.Timestamp(date).strftime('%Y%m%d') + '.hsf')
+
+
+def get_previous_hotstart_file(directory, name, start):
+    # Hotstart file that a simulation starting on start continues from
+    return get_hotstart_file(directory, name, pd.Timestamp(start) - pd.Timedelta('1 days'))
+
+
+def save_hotstart(sim, directory, name):
+    # Saves the current state of a finished simulation, the file is renamed into place once it is complete
+    hotstart_file = get_hotstart_file(directory, name, sim.end_time)
+    temporary_file = os.path.join(directory, '.' + os.path.basename(hotstart_file))
+    sim.save_hotstart(temporary_file)
+    os.replace(temporary_file, hotstart_file)
+    return hotstart_file
+
+
+def run_simulation(input_file, use_hotstart=None, hotstart_directory=None):
+    # INPUTS:
+    #   input_file: path to the .inp file
+    #   use_hotstart (optional): hotstart file to start the simulation from (default None, a cold start)
+    #   hotstart_directory (optional): folder to save the state at the end of the simulation in (default None, not saved)
+
+    # Postconditions: The simulation has been run to its end, the same as Simulation.execute()
+
+    with Simulation(input_file) as sim:
+        if use_hotstart is not None:
+            sim.use_hotstart(use_hotstart)
+
+        # A single step for the whole simulation, so SWMM never returns to Python before the end
+        sim.step_advance(int((sim.end_time - sim.start_time).total_seconds()) + 1)
+        for _ in sim:
+            pass
+
+        if hotstart_directory is not None:
+            save_hotstart(sim, hotstart_directory, get_name(input_file))
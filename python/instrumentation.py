@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import socket
+import resource
+import pandas as pd
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+
+# Every job appends one JSON record to the job log, ex.
+#   {"time": "2026-10-18T14:53:52", "host": "node1", "pid": 1234, "name": "170319800001_ng", "GEOID10": "170319800001",
+#    "sim_type": "ng", "queue_wait": 12.5, "input": 0.01, "execute": 31.2, "extract": 0.4, "bytes_written": 91234567,
+#    "worker_peak_rss_kb": 80232, "status": "ok"}
+# Stage times are seconds, a stage the job did not have (ex. input in the 'files' mode) is null.
+
+_stages = ['input', 'execute', 'extract']
+
+# Seconds of finished jobs the rolling throughput of the summary is measured over
+_rolling_seconds = 600
+
+# Seconds between two writes of the summary file
+_summary_seconds = 10
+
+
+class JobTimer:
+    # Times the stages of one job in a worker, and appends its record to the job log
+    #   timer = JobTimer('170319800001_ng', queued)
+    #   with timer.stage('execute'):
+    #       run_simulation(file)
+    #   timer.add_bytes(output_file)
+    #   timer.write(log_file)
+
+    def __init__(self, name, queued=None):
+        # name: simulation name (<GEOID10>_<sim_type>), queued (optional): time.time() when the job was queued
+        self.name = name
+        self.start = time.time()
+        self.queue_wait = None if queued is None else self.start - queued
+        self.seconds = dict.fromkeys(_stages)
+        self.bytes_written = 0
+        self.status = 'ok'  # Or 'error', 'timeout', 'crashed'
+
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = (self.seconds[stage] or 0.0) + time.time() - start
+
+
+    def add_bytes(self, *files):
+        # Counts the size of files the job wrote, call it before they are deleted
+        for file in files:
+            if file is not None and os.path.exists(file):
+                self.bytes_written += os.path.getsize(file)
+
+
+    def get_record(self, status):
+        geoid, sim_type = (self.name.split('_') + [''])[:2]
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'host': socket.gethostname(), 'pid': os.getpid(),
+                  'name': self.name, 'GEOID10': geoid, 'sim_type': sim_type,
+                  'queue_wait': None if self.queue_wait is None else round(self.queue_wait, 3)}
+        for stage in _stages:
+            record[stage] = None if self.seconds[stage] is None else round(self.seconds[stage], 3)
+        record['bytes_written'] = self.bytes_written
+        # Peak RSS of the worker process since it started (ru_maxrss), not of this job: a job is only seen to use more
+        # memory when it raises the peak of its worker, and a simulation run in its own child process (isolation.py) is
+        # not counted
+        record['worker_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record['status'] = status
+        return record
+
+
+    def write(self, log_file, status=None):
+        append_record(log_file, self.get_record(status or self.status))
+
+
+def append_record(log_file, record):
+    # One write per record on a file opened in append mode, so the records of concurrent workers are not interleaved
+    directory = os.path.dirname(log_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    descriptor = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(descriptor, (json.dumps(record) + '\n').encode())
+    finally:
+        os.close(descriptor)
+
+
+def read_job_log(log_file):
+    # Returns the job log as a frame, one row per job
+    return pd.read_json(log_file, lines=True, dtype={'GEOID10': str, 'name': str})
+
+
+class ProgressSummary:
+    # Live summary of a run, rewritten every _summary_seconds: jobs done, rolling throughput and estimated end
+    #   summary = ProgressSummary('../logs/ng_summary.json', total=len(jobs))
+    #   summary.update(done)  # as the jobs finish
+
+    def __init__(self, summary_file, total, label=''):
+        self.summary_file = summary_file
+        self.total = total
+        self.label = label
+        self.start = time.time()
+        self.finished = deque()  # (time, number of jobs done)
+        self.written = 0.0
+        directory = os.path.dirname(summary_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+
+    def update(self, done, force=False):
+        now = time.time()
+        self.finished.append((now, done))
+        while len(self.finished) > 2 and now - self.finished[0][0] > _rolling_seconds:
+            self.finished.popleft()
+        if force or now - self.written >= _summary_seconds:
+            self.write(now, done)
+
+
+    def write(self, now, done):
+        first_time, first_done = self.finished[0]
+        if now > first_time and done > first_done:
+            rate = (done - first_done) / (now - first_time)
+        else:
+            rate = done / (now - self.start) if now > self.start else 0.0
+        remaining = self.total - done
+        summary = {'label': self.label, 'updated': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                   'started': datetime.fromtimestamp(self.start).isoformat(timespec='seconds'),
+                   'done': done, 'total': self.total, 'sims_per_minute': round(rate * 60, 2),
+                   'eta': (datetime.fromtimestamp(now) + timedelta(seconds=remaining / rate)).isoformat(timespec='seconds') if rate > 0 else None}
+
+        temporary_file = self.summary_file + '.tmp'  # Readers never see a partial summary
+        with open(temporary_file, 'w') as file:
+            json.dump(summary, file, indent=1)
+        os.replace(temporary_file, self.summary_file)
+        self.written = now
@@ -1,6 +1,8 @@
-import rasterstats as rs
-import geopandas as gpd
+import numpy as np
+import rasterio
 import pandas as pd
+from zonal_statistics import read_shape_file
+from weight_matrix import get_weight_matrix, zonal_stats
 from tqdm import tqdm
 import glob
 from multiprocessing import Pool
@@ -17,12 +19,17 @@ def intersections(raster_file, shape_file, proj4='+proj=longlat +datum=WGS84 +no
     # OUTPUT:
     #   frame: pandas dataframe that contains the min, max, and mean values for each feature in the shape file
 
-    shape_frame = gpd.read_file(shape_file)
-    shape = shape_frame.to_crs(proj4)  # Change the projection using the input proj4 string
+    shape_frame = read_shape_file(shape_file).copy()
+
+    # The polygon x pixel weights are built once per shape file and raster grid, then loaded from disk
+    # (the shapes are projected using the input proj4 string before they are rasterized)
+    matrix, _ = get_weight_matrix(shape_file, raster_file, all_touched=True, proj4=proj4, id_column=None)
+
+    with rasterio.open(raster_file) as raster:
+        band = raster.read(1, masked=True).astype(np.float64).filled(np.nan)
 
     output_columns = ['count', 'min', 'max', 'mean']
-    stats = rs.zonal_stats(shape, raster_file, stats=output_columns, all_touched=True)
-    frame = pd.DataFrame.from_dict(stats)
+    frame = pd.DataFrame(zonal_stats(matrix, band))[output_columns]
 
     if 'GEOID' in shape_frame.columns:  # If the shapefile has GEOID in its attributes
         shape_frame['GEOID'] = shape_frame['GEOID'].astype(str)  # Convert to string to keep the leading zeroes
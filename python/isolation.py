@@ -0,0 +1,81 @@
+import os
+import sys
+import pickle
+import shutil
+import tempfile
+import traceback
+import subprocess
+
+
+# Runs a function (ex. a SWMM simulation) in its own Python process, so a simulation that runs past its wall-clock
+# budget can be killed, and one that crashes SWMM does not take its worker down with it. The function and its
+# arguments are pickled to a request file, and the child pickles the result (or the exception) to a result file:
+#   frame = run_isolated(run_streaming, file, 'D', timeout=3600)
+# Pool workers are daemonic processes, which cannot start multiprocessing children, so the child is a subprocess.
+
+
+class SimulationFailed(Exception):
+    # Base of the ways an isolated simulation fails, status is the name used in the job log and quarantine list
+    status = 'error'
+
+
+class SimulationTimeout(SimulationFailed):
+    status = 'timeout'
+
+
+class SimulationCrashed(SimulationFailed):
+    status = 'crashed'
+
+
+def run_isolated(function, *args, timeout=None, **kwargs):
+    # INPUTS:
+    #   function: module level function (picklable by name) to run, with its args and kwargs
+    #   timeout (optional): wall-clock seconds before the child is killed, None runs the function in this process
+
+    # OUTPUT:
+    #   result: what function returned. SimulationTimeout is raised when the child was killed, SimulationCrashed when it
+    #           died without a result (ex. a segmentation fault in SWMM), and SimulationFailed when function raised.
+
+    if timeout is None:
+        return function(*args, **kwargs)
+
+    directory = tempfile.mkdtemp()
+    request_file = os.path.join(directory, 'request.pkl')
+    result_file = os.path.join(directory, 'result.pkl')
+    try:
+        with open(request_file, 'wb') as file:
+            pickle.dump((function, args, kwargs), file)
+
+        try:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), request_file, result_file], timeout=timeout,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired:  # The child has been killed
+            raise SimulationTimeout('Killed after ' + str(timeout) + ' seconds')
+
+        if not os.path.exists(result_file):
+            raise SimulationCrashed('Exit code ' + str(process.returncode) + '\n' + process.stderr.decode(errors='replace')[-2000:])
+        with open(result_file, 'rb') as file:
+            succeeded, result = pickle.load(file)
+        if not succeeded:
+            raise SimulationFailed(result)
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)  # A child killed while writing its result leaves a temporary file
+
+
+def _run_request(request_file, result_file):
+    with open(request_file, 'rb') as file:
+        function, args, kwargs = pickle.load(file)
+    try:
+        result = (True, function(*args, **kwargs))
+    except Exception:
+        result = (False, traceback.format_exc())
+
+    temporary_file = result_file + '.tmp'  # A child killed while writing leaves no result
+    with open(temporary_file, 'wb') as file:
+        pickle.dump(result, file)
+    os.replace(temporary_file, result_file)
+
+
+if __name__ == '__main__':
+    _run_request(sys.argv[1], sys.argv[2])
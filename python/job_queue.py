@@ -0,0 +1,126 @@
+import os
+import time
+import sqlite3
+
+
+# Status of a job in the queue
+READY = 0
+LEASED = 1
+DONE = 2
+FAILED = 3
+
+
+class JobQueue:
+    # Persistent job queue shared by the worker processes, stored in a SQLite database.
+    # Workers lease a batch of jobs at a time, and the lease expires after lease_seconds. A job that is still leased
+    # when its lease expires (its worker died or was killed) is handed out again, up to max_attempts times, after
+    # which it is marked as failed. A worker acknowledges (or fails) the finished jobs of its batch a few at a time, and
+    # renews the lease of the rest in the same transaction. Only the worker that holds a job's lease can acknowledge or
+    # fail it.
+    #
+    #   queue = JobQueue('../queues/ng_queue.db')
+    #   queue.put(['../input_files/ng/170319800001_ng.inp'])
+    #   jobs = queue.lease('worker-1', 10)  # [(1, '../input_files/ng/170319800001_ng.inp')]
+    #   queue.ack('worker-1', [job_id for job_id, data in jobs])  # Or a few at a time, as they finish
+
+    def __init__(self, path, lease_seconds=3600, max_attempts=3):
+        # INPUTS:
+        #   path: SQLite database file of the queue, created if it does not exist
+        #   lease_seconds (optional): seconds before a leased job is handed out again (default 1 hour)
+        #   max_attempts (optional): number of leases before a job whose lease keeps expiring is failed (default 3)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=120, isolation_level=None)  # Transactions are explicit
+        self.connection.execute('PRAGMA journal_mode=WAL')  # Readers are not blocked by the writers
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, data TEXT UNIQUE, status INTEGER, '
+                                'worker TEXT, lease_expires REAL, attempts INTEGER DEFAULT 0, error TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)')
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def put(self, items):
+        # Adds the items (strings) that are not in the queue yet, returns the number of items added
+        self.connection.execute('BEGIN IMMEDIATE')
+        count = self.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        self.connection.executemany('INSERT OR IGNORE INTO jobs (data, status) VALUES (?, ?)', [(item, READY) for item in items])
+        added = self.connection.execute('SELECT COUNT(*) FROM jobs').fetchone()[0] - count
+        self.connection.execute('COMMIT')
+        return added
+
+
+    def lease(self, worker, count=1):
+        # Leases up to count ready jobs to the worker, returns a list of (job id, data). An empty list means the queue is
+        # drained, or that the remaining jobs are leased by other workers.
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        self._reclaim(now)
+        jobs = self.connection.execute('SELECT id, data FROM jobs WHERE status = ? ORDER BY id LIMIT ?', (READY, count)).fetchall()
+        self.connection.executemany('UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                                    [(LEASED, worker, now + self.lease_seconds, job_id) for job_id, _ in jobs])
+        self.connection.execute('COMMIT')
+        return jobs
+
+
+    def _reclaim(self, now):
+        # Expired leases are handed out again, or failed once they have used every attempt
+        self.connection.execute('UPDATE jobs SET status = ?, error = ? WHERE status = ? AND lease_expires < ? AND attempts >= ?',
+                                (FAILED, 'Lease expired ' + str(self.max_attempts) + ' times', LEASED, now, self.max_attempts))
+        self.connection.execute('UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND lease_expires < ?', (READY, LEASED, now))
+
+
+    def ack(self, worker, job_ids, failures=()):
+        # Marks jobs leased by the worker as done, and failures ((job id, error) pairs) as failed, then renews the lease of
+        # the worker's other jobs, in one transaction. Returns the number of jobs acknowledged or failed. Jobs whose
+        # lease expired and were handed out again are left to the worker that holds them now.
+        self.connection.execute('BEGIN IMMEDIATE')
+        count = sum(self.connection.execute('UPDATE jobs SET status = ? WHERE id = ? AND worker = ? AND status = ?',
+                                            (DONE, job_id, worker, LEASED)).rowcount for job_id in job_ids)
+        count += sum(self.connection.execute('UPDATE jobs SET status = ?, error = ? WHERE id = ? AND worker = ? AND status = ?',
+                                             (FAILED, error, job_id, worker, LEASED)).rowcount for job_id, error in failures)
+        self.connection.execute('UPDATE jobs SET lease_expires = ? WHERE worker = ? AND status = ?',
+                                (time.time() + self.lease_seconds, worker, LEASED))
+        self.connection.execute('COMMIT')
+        return count
+
+
+    def release(self, job_ids):
+        # Hands leased jobs out again right away (ex. the rest of a batch when a worker is stopped)
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany('UPDATE jobs SET status = ?, worker = NULL, attempts = attempts - 1 WHERE id = ? AND status = ?',
+                                    [(READY, job_id, LEASED) for job_id in job_ids])
+        self.connection.execute('COMMIT')
+
+
+    def release_workers(self, pattern):
+        # Hands out again the jobs leased by workers that are known to be dead, without waiting for their leases to expire.
+        # pattern is a SQL LIKE pattern of the worker names. The attempt is still counted, so a job that kills its worker
+        # every time is failed after max_attempts.
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('UPDATE jobs SET status = ?, error = ? WHERE worker LIKE ? AND status = ? AND attempts >= ?',
+                                (FAILED, 'Worker died ' + str(self.max_attempts) + ' times', pattern, LEASED, self.max_attempts))
+        self.connection.execute('UPDATE jobs SET status = ?, worker = NULL WHERE worker LIKE ? AND status = ?', (READY, pattern, LEASED))
+        self.connection.execute('COMMIT')
+
+
+    def counts(self):
+        # Number of jobs of each status, ex. {'ready': 10, 'leased': 8, 'done': 100, 'failed': 1}
+        counts = dict(self.connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {name: counts.get(status, 0) for name, status in [('ready', READY), ('leased', LEASED), ('done', DONE), ('failed', FAILED)]}
+
+
+    def failed(self):
+        # Returns (data, worker, attempts, error) of every failed job
+        return self.connection.execute('SELECT data, worker, attempts, error FROM jobs WHERE status = ? ORDER BY id', (FAILED,)).fetchall()
+
+
+    def retry_failed(self):
+        # Puts the failed jobs back in the queue
+        self.connection.execute('UPDATE jobs SET status = ?, worker = NULL, attempts = 0, error = NULL WHERE status = ?', (READY, FAILED))
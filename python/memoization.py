@@ -0,0 +1,115 @@
+import os
+import re
+import csv
+import glob
+import hashlib
+from functools import lru_cache
+
+
+# Simulations are keyed by a hash of their input file, so a simulation whose input file is the same as one that has
+# already been run (same characteristics, same PRISM weather) reuses the stored results instead of running SWMM again.
+# The key is computed from a canonical form of the input file: comments and whitespace are dropped, the block group's
+# GEOID10 (used in the evaporation timeseries name) is replaced, and every external file is replaced by the hash of
+# its content, so the key only changes when something SWMM reads changes.
+
+_file_pattern = re.compile(r'\bFILE\s+("[^"]+"|\S+)')
+
+_index_columns = ['key', 'name']
+
+
+@lru_cache(maxsize=None)
+def _hash_file(path, modified, size):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def hash_file(path):
+    # Hash of the content of a file, computed once per process for each version of the file (weather files are shared)
+    stat = os.stat(path)
+    return _hash_file(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_canonical_text(text, geoid):
+    # INPUTS:
+    #   text: content of the input file
+    #   geoid: GEOID10 of the block group
+
+    # OUTPUT:
+    #   canonical: the input file without comments, blank lines or repeated whitespace, with the GEOID10 replaced and
+    #              the external file paths replaced by the hash of their content
+
+    def replace_file(match):
+        return 'FILE ' + hash_file(match.group(1).strip('"'))
+
+    lines = []
+    for line in text.splitlines():
+        line = line.split(';')[0].strip()
+        if line:
+            line = _file_pattern.sub(replace_file, line)
+            lines.append(' '.join(line.replace(geoid, '<GEOID10>').split()))
+    return '\n'.join(lines)
+
+
+def get_simulation_key(text, geoid, *extra):
+    # extra: anything else the stored results depend on (sim_type, how they were extracted, a hotstart file hash, ...)
+    key = hashlib.sha256(get_canonical_text(text, geoid).encode())
+    for value in extra:
+        key.update(b'\0' + str(value).encode())
+    return key.hexdigest()
+
+
+class SimulationCache:
+    # Index of simulation keys and the name of the simulation whose results are in the result store, kept as an
+    # append-only CSV file. Keys are only added once the results have been written. The workers add the keys of their
+    # own simulations, each add is a single append so the rows of concurrent workers are not interleaved.
+    def __init__(self, index_file, load=True, shared_files=()):
+        # INPUTS:
+        #   index_file: CSV file of the cache, keys are added to it
+        #   load (optional): False only appends to the index (ex. in a worker), without reading the keys already in it
+        #   shared_files (optional): index files (or glob patterns) of other caches whose results end up in the same
+        #                            result store (ex. the campaign's cache and the other launchers' caches), their keys
+        #                            are reused but not added to index_file
+        self.index_file = index_file
+        self.names = {}
+        if load:
+            for pattern in list(shared_files) + [index_file]:
+                for path in sorted(glob.glob(pattern)):
+                    self.names.update(read_names(path))
+
+    def get(self, key):
+        return self.names.get(key)
+
+    def add(self, items):
+        # items: (key, name) pairs of simulations whose results have been stored
+        rows = []
+        for key, name in items:
+            if key not in self.names:
+                rows.append(key + ',' + name + '\n')
+                self.names[key] = name
+        if not rows:
+            return
+        directory = os.path.dirname(self.index_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            descriptor = os.open(self.index_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(descriptor, (','.join(_index_columns) + '\n').encode())
+            os.close(descriptor)
+        except FileExistsError:
+            pass
+        descriptor = os.open(self.index_file, os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(descriptor, ''.join(rows).encode())
+        finally:
+            os.close(descriptor)
+
+
+def read_names(index_file):
+    # Returns the simulation name of each key of a cache index file. Other processes may be appending to it, so a last
+    # line without its end of line is skipped.
+    with open(index_file, newline='') as file:
+        lines = file.read().split('\n')[:-1]
+    return {row[0]: row[1] for row in csv.reader(lines[1:]) if len(row) == 2}
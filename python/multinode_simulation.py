@@ -0,0 +1,109 @@
+import os
+import sys
+import glob
+import time
+import socket
+import multiprocess_simulation as simulation
+from result_store import ResultStore
+from memoization import SimulationCache
+from shards import ShardDirectory, Heartbeat
+
+
+# Runs a 'jit' (or 'extend') campaign of multiprocess_simulation.py on any number of hosts that share a filesystem.
+# Start this script on every host (or several times on one host), each launcher claims shards of the job manifest and
+# runs them with a local pool sized by multiprocess_simulation._max_processes. Each launcher writes its results to
+# its own result store, once every shard is done they are combined (and their small part files compacted) with:
+#   python multinode_simulation.py merge
+
+
+# Number of block groups in a shard of the manifest
+_shard_size = 500
+
+# Seconds without a heartbeat before a claimed shard is run by another launcher, and the heartbeat interval
+_lease_seconds = 1800
+_heartbeat_seconds = 60
+
+# Seconds between checks for expired shards, once no shard is ready but other launchers are still running
+_poll_seconds = 60
+
+
+path_to_shards = '../shards/' + simulation._sim_type + '/'
+
+# Result store of each launcher, merged into simulation.path_to_result_store
+path_to_launcher_stores = simulation.path_to_result_store + '_launchers/'
+
+
+def main():
+    assert simulation._mode in ('jit', 'extend'), 'Only the jit and extend modes can run on multiple hosts'
+    launcher = socket.gethostname() + '-' + str(os.getpid())
+
+    # The first launcher writes the manifest
+    shards = ShardDirectory(path_to_shards, _lease_seconds)
+    if not shards.exists():
+        jobs = simulation.get_jit_jobs()
+        if shards.create(jobs, _shard_size):
+            print('Created', shards.counts()['ready'], 'shards of', len(jobs), 'block groups in', path_to_shards)
+
+    # Every launcher has its own result store and job log, so launchers never write to the same files. The simulations
+    # already in the campaign's result store, or in another launcher's, are reused.
+    simulation.shared_cache_files = [simulation.simulation_cache_file, path_to_launcher_stores + '*/_simulation_cache.csv']
+    simulation.path_to_result_store = path_to_launcher_stores + launcher + '/'
+    simulation.simulation_cache_file = simulation.path_to_result_store + '_simulation_cache.csv'
+    simulation.job_log_file = '../logs/' + simulation._sim_type + '_jobs_' + launcher + '.jsonl'
+    simulation.summary_file = '../logs/' + simulation._sim_type + '_summary_' + launcher + '.json'
+    if simulation._save_hotstart:
+        os.makedirs(simulation.path_to_hotstart_files, exist_ok=True)
+
+    # One pool and concurrency tuner runs every shard the launcher claims, a new shard is claimed once every job of the
+    # previous one has started. A shard is finished once its results are written.
+    heartbeats = {}
+
+    def claim_shards(claim):
+        while claim is not None:
+            claimed_file, jobs = claim
+            print(launcher, 'claimed', os.path.basename(claimed_file), file=sys.__stdout__)
+            heartbeats[claimed_file] = Heartbeat(claimed_file, _heartbeat_seconds).start()
+            yield claimed_file, jobs
+            shards.reclaim_expired()
+            claim = shards.claim(launcher)
+
+    while True:
+        shards.reclaim_expired()
+        claim = shards.claim(launcher)
+        if claim is None:
+            if shards.counts()['claimed'] == 0:
+                break  # Every shard is done
+            time.sleep(_poll_seconds)  # Wait in case a running launcher dies and its shards are reclaimed
+            continue
+
+        for claimed_file in simulation.run_batches(claim_shards(claim), simulation.jit_worker,
+                                                   simulation._initialize_jit_worker, simulation._memoize):
+            heartbeats.pop(claimed_file).stop()
+            shards.finish(claimed_file)
+
+    print(launcher, 'finished', shards.counts(), file=sys.__stdout__)
+    return
+
+
+def merge():
+    # Combines the result stores of every launcher, once every shard is done
+    counts = ShardDirectory(path_to_shards).counts()
+    assert counts['ready'] == 0 and counts['claimed'] == 0, 'Shards are still running: ' + str(counts)
+
+    store = ResultStore(simulation.path_to_result_store)
+    cache = SimulationCache(simulation.simulation_cache_file)
+    launcher_stores = sorted(glob.glob(path_to_launcher_stores + '*/'))
+    for launcher_store in launcher_stores:
+        launcher_cache = SimulationCache(launcher_store + '_simulation_cache.csv')
+        cache.add(launcher_cache.names.items())
+    store.merge(launcher_stores)  # Block groups run by more than one launcher are kept once
+    store.compact()
+    print('Merged', len(launcher_stores), 'launcher result stores into', simulation.path_to_result_store)
+    return
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        merge()
+    else:
+        main()
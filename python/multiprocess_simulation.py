@@ -1,9 +1,25 @@
 import glob
-from pyswmm import Simulation
+import time
+import itertools
+import tempfile
+import pandas as pd
 from multiprocessing import Pool
 import shutil
 import os
 import sys
+import traceback
+from multiprocessing.util import Finalize
+from InputFileTemplate import InputFileTemplate
+from extraction import extract_variables, check_report_coverage
+from streaming import run_streaming
+from hotstart import run_simulation, get_previous_hotstart_file
+from result_store import ResultStore
+from memoization import SimulationCache, get_simulation_key, hash_file
+from scheduling import make_job, read_simulation_days, get_days, load_history, estimate_costs, order_jobs, RuntimeRecorder
+from concurrency import make_tuner, imap_adaptive
+from instrumentation import JobTimer, ProgressSummary
+from isolation import run_isolated, SimulationFailed
+from quarantine import Quarantine
 
 
 _sim_types = {'ng': 'no_green_infrastructure',
@@ -13,34 +29,484 @@ _sim_types = {'ng': 'no_green_infrastructure',
 
 
 _sim_type = 'ng'
-_max_processes = 8
+_rb_type = 'subcatchment'  # other option is 'lid'
+_max_processes = None  # None tunes the number of workers while the simulations run (concurrency.py), from the number of cores
+
+# 'files' runs the input files found in path_to_input_files, and keeps the .out and .rpt files
+# 'fused' runs the input files found in path_to_input_files, extracts the results to the result store and deletes the .out file
+# 'jit' creates each block group's input file inside the worker, runs it, extracts the results and deletes everything
+# 'extend' is the same as 'jit', but only simulates _extend_start to _extend_end, continuing from the hotstart file each
+#          block group saved at the end of its previous run. The results are appended to the result store.
+_mode = 'files'
+
+# Save the state of every simulation at its end (<GEOID10>_<sim_type>_<YYYYMMDD>.hsf), so it can be extended later
+_save_hotstart = True
+
+# New weather window of the 'extend' mode, the weather files must already contain it
+_extend_start = '01/01/2015'
+_extend_end = '12/31/2015'
+
+# Sum the extracted results by day before storing them ('fused' and 'jit' modes)
+_daily = True
+
+# How the 'fused' and 'jit' modes get their results
+# 'extract' executes the simulation and reads the system variables back from the .out file
+# 'streaming' steps the simulation and accumulates rainfall, runoff, evaporation + infiltration and outfall flow totals
+#             of the system and of Subcatch1/Subcatch4 as it runs (streaming.py), the .out file is never read
+_backend = 'extract'
+_frequency = 'D'  # Period of the 'streaming' totals, 'D' (daily) or 'M' (monthly)
+
+# What the input files of the 'jit' and 'extend' modes write to the .out file (see InputFile.output_profiles). The .out
+# files are deleted once extracted, so only what extraction.py reads is written.
+_output_profile = 'system-only'
+
+# Skip the simulations whose input files are the same as one whose results are already stored, and link them to those
+# results instead ('fused', 'jit' and 'extend' modes, see memoization.py)
+_memoize = True
+
+# Wall-clock seconds a simulation may run for. Each simulation runs in its own child process (isolation.py), which is
+# killed once it runs out of time. Simulations that time out, crash or fail are quarantined and the run goes on.
+# None runs the simulations inside the workers, without a time limit.
+# Each child starts a new interpreter and imports pyswmm and pandas, a fixed cost per simulation (compare the
+# 'isolated' and 'simulation' stages of benchmark.py) that is small next to a multi-year simulation, and in exchange
+# a hung or crashing SWMM cannot stall or take down a worker. Set None for very short simulations.
+_timeout = 2 * 3600
+
+# Number of jobs whose results a worker of the 'fused', 'jit' and 'extend' modes buffers before writing them to one
+# part file (it also writes them once they reach ResultStore.buffer_rows rows, and when it exits). The .out and input
+# files of the 'fused' mode are deleted, and the simulations are cached (memoization.py), only once their results are
+# written, so a killed worker loses at most this many simulations, which run again with the next run.
+_flush_jobs = 100
+
+# Seconds between checks for the batches of jobs (ex. the shards of multinode_simulation.py) whose results have all been
+# written, while the workers are running
+_batch_check_seconds = 60
 
 
 path_to_input_files = '../input_files/' + _sim_type + '/'
 path_to_output_files = '../output_files/' + _sim_type + '/'
 path_to_report_files = '../report_files/' + _sim_type + '/'
+path_to_result_store = '../result_store/'
+path_to_hotstart_files = '../hotstart_files/' + _sim_type + '/'
+
+# Input and report files of the quarantined simulations, and the list of them with their errors (quarantine.py)
+path_to_quarantine = '../quarantine/' + _sim_type + '/'
+
+# Index of the simulation keys whose results are in the result store
+simulation_cache_file = path_to_result_store + '_simulation_cache.csv'
+
+# Simulation caches (files or glob patterns) of other result stores that are merged with this one, their simulations
+# are reused too (multinode_simulation.py)
+shared_cache_files = []
+
+characteristics_file = '../data/input_file_data/Selected_BG_inputs_20191212.csv'
+
+# Measured runtimes of past simulations, used to run the longest simulations first
+runtime_history_file = '../logs/runtime_history.csv'
+
+# Steady number of workers found for each kind of run, the next run of the same kind starts from it
+concurrency_history_file = '../logs/concurrency_history.csv'
+
+# Append-only log of one JSON record per job (stage times, bytes written, peak memory, status), and live summary of the
+# run with its rolling throughput and estimated end (instrumentation.py)
+job_log_file = '../logs/' + _sim_type + '_jobs.jsonl'
+summary_file = '../logs/' + _sim_type + '_summary.json'
+
+# Scratch space for the 'jit' mode, a tmpfs so the input, report and output files never reach the disk
+_scratch_dir = '/dev/shm/' if os.path.isdir('/dev/shm/') else None
+
+# Input file template of the 'jit' mode, compiled once per worker process
+_template = None
+
+# Result store of the 'fused' and 'jit' modes, one per worker process
+_store = None
+
+# Timer and simulation key of the job the worker process is running
+_timer = None
+_key = None
+
+# Simulation cache of the worker process, the keys of its jobs are added once their results are written
+_cache = None
+
+# (name, key, files to delete) of the jobs whose results the worker process has not written yet
+_pending = []
 
 
 def main():
-    input_files = glob.glob(path_to_input_files + '*.inp')
-    print('Input Files:', len(input_files))
-    sys.stdout = open(os.devnull, 'w')
-    print('hello')
-    pool = Pool(_max_processes)
-    pool.map(worker, input_files)
+    if _save_hotstart:
+        os.makedirs(path_to_hotstart_files, exist_ok=True)
+
+    if _mode in ('jit', 'extend'):
+        if _backend == 'extract':
+            check_report_coverage(get_template().text)
+        jobs = get_jit_jobs()
+        run_jobs(jobs, jit_worker, _initialize_jit_worker, _memoize)
+    else:
+        input_files = glob.glob(path_to_input_files + '*.inp')
+        print('Input Files:', len(input_files))
+        if _mode == 'fused' and _backend == 'extract' and input_files:
+            with open(input_files[0]) as file:
+                check_report_coverage(file.read())
+        jobs = [make_job(get_name(file), _sim_type, _rb_type, read_simulation_days(file), file) for file in input_files]
+        if _mode == 'fused':
+            run_jobs(jobs, fused_worker, _initialize_store, _memoize)
+        else:
+            run_jobs(jobs, worker)
+            return
+
+    # The workers have flushed their results, their small part files are combined
+    ResultStore(path_to_result_store).compact()
     return
 
 
+def run_jobs(jobs, worker_function, initializer=None, memoize=False):
+    # Runs every job in one pool (see run_batches)
+    for _ in run_batches([(None, jobs)], worker_function, initializer, memoize):
+        pass
+
+
+def run_batches(batches, worker_function, initializer=None, memoize=False):
+    # Runs batches of jobs (ex. the shards claimed by multinode_simulation.py) with one pool and one concurrency tuner.
+    # A batch is read once every job of the previous one has started. The jobs of a batch are dispatched longest
+    # estimated first, each one as soon as a worker is free. The tuner weighs the finished jobs by their estimated
+    # cost, so the shorter jobs at the end of a batch do not look like a faster setting.
+    # INPUTS:
+    #   batches: iterable of (batch id, jobs)
+    #   worker_function: function run in a worker with the data of a job, returns (name, seconds), seconds is None if
+    #                    the simulation was quarantined
+    #   initializer (optional): function run when a worker process starts
+    #   memoize (optional): only run the first job of each simulation key, the others are linked to its stored results
+
+    # OUTPUT:
+    #   yields the id of each batch once its jobs are done and their results (and links) are written
+
+    history = load_history(runtime_history_file)
+    recorder = RuntimeRecorder(runtime_history_file)
+    tuner = make_tuner(_max_processes, get_concurrency_label(), get_output_directory(), concurrency_history_file)
+    summary = ProgressSummary(summary_file, 0, get_concurrency_label())
+
+    names = {}       # Batch id -> names of the batch's jobs
+    running = {}     # Batch id -> names of the batch's jobs that are not done
+    links = {}       # Batch id -> (name, source) links added once the batch is done
+    batch_ids = {}   # Name -> batch id of the jobs of the batches that are not done
+    jobs_by_name = {}
+    sources = {}     # Simulation key -> name of the job of this run that simulates it
+    failed = set()   # Quarantined
+
+    def get_items():
+        for batch_id, jobs in batches:
+            keys = {}
+            links[batch_id] = []
+            if memoize:
+                jobs, keys, links[batch_id] = memoize_jobs(jobs, sources)
+            jobs = order_jobs(jobs, history)
+            names[batch_id] = set(job['name'] for job in jobs)
+            running[batch_id] = set(names[batch_id])
+            summary.total += len(jobs)
+            queued = time.time()
+            for job, cost in zip(jobs, estimate_costs(jobs, history)):
+                jobs_by_name[job['name']] = job
+                batch_ids[job['name']] = batch_id
+                yield (worker_function, job['name'], job['data'], queued, keys.get(job['name'])), cost
+
+    def finish_batches(written=None):
+        # written: names of the jobs whose results are written, None once the workers have exited
+        for batch_id in [batch_id for batch_id, remaining in running.items() if not remaining]:
+            if written is not None and not names[batch_id] - failed <= written:
+                continue  # Buffered in a worker
+            del running[batch_id]
+            for name in names.pop(batch_id):
+                del batch_ids[name]
+            # Links to a simulation of a batch that is not done yet are added with that batch
+            ready = []
+            for name, source in links.pop(batch_id):
+                if source in batch_ids:
+                    links[batch_ids[source]].append((name, source))
+                else:
+                    ready.append((name, source))
+            if memoize:
+                link_results(ready)
+            yield batch_id
+
+    # The index rows of the part files that are not in the store yet are the results written by this run
+    stored_files = set(ResultStore(path_to_result_store).read_index()['file'])
+
+    def get_written():
+        index = ResultStore(path_to_result_store).read_index()
+        index = index.loc[~index['file'].isin(stored_files)]
+        return set(index['GEOID10'] + '_' + index['sim_type'])
+
+    items, weights = itertools.tee(get_items())
+    sys.stdout = open(os.devnull, 'w')
+    pool = Pool(tuner.maximum, initializer=initializer)
+    done = 0
+    checked = time.time()
+    try:
+        for done, (name, seconds) in enumerate(imap_adaptive(pool, run_job, (item for item, _ in items), tuner,
+                                                             (weight for _, weight in weights)), 1):
+            running[batch_ids[name]].discard(name)
+            job = jobs_by_name.pop(name)
+            if seconds is None:
+                failed.add(name)
+            else:
+                recorder.record(job, seconds)
+            summary.update(done)
+            if time.time() - checked >= _batch_check_seconds and not all(running.values()):
+                yield from finish_batches(get_written())
+                checked = time.time()
+    except BaseException:
+        pool.terminate()  # The buffered results are lost, their jobs are neither cached nor deleted and run again
+        raise
+    finally:
+        recorder.close()
+    pool.close()
+    pool.join()  # The workers write the results they still buffer as they exit
+    summary.update(done, force=True)
+    yield from finish_batches()
+    if failed:
+        print(len(failed), 'simulations were quarantined, see', path_to_quarantine + '_quarantine.csv', file=sys.__stdout__)
+
+
+def run_job(item):
+    # Runs one job with its worker function, and appends the job's record to the job log whether it succeeded or not.
+    # Returns the worker's (name, seconds), seconds is None if the simulation was quarantined.
+    global _timer, _key
+    worker_function, name, data, queued, _key = item
+    _timer = JobTimer(name, queued)
+    result = worker_function(data)
+    _timer.write(job_log_file)
+    return result
+
+
+def quarantine_job(name, error, directory):
+    # Moves the input and report files of a failed simulation to the quarantine, returns the job's (name, seconds)
+    if isinstance(error, SimulationFailed):
+        _timer.status, message = error.status, str(error)
+    else:
+        _timer.status, message = 'error', traceback.format_exc()
+    output_file = os.path.join(directory, name + '.out')
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    Quarantine(path_to_quarantine).add(name, _timer.status, message, [os.path.join(directory, name + ext) for ext in ['.inp', '.rpt']])
+    return name, None
+
+
+def get_concurrency_label():
+    # The best number of workers depends on the simulation type and on what the workers do besides SWMM
+    label = _mode + '_' + _sim_type
+    if _sim_type == 'rb':
+        label += '_' + _rb_type
+    if _mode != 'files':
+        label += '_' + _backend
+    return label
+
+
+def get_output_directory():
+    # Folder SWMM writes the .out files to, next to the input files
+    if _mode in ('jit', 'extend'):
+        return _scratch_dir or tempfile.gettempdir()
+    return path_to_input_files
+
+
+def memoize_jobs(jobs, sources):
+    # Returns the jobs to run, the simulation key of each of them and the (name, source) links of the other jobs, whose
+    # simulation is already stored or run by another job.
+    # sources: simulation key -> name of the jobs run so far, the jobs to run are added to it
+    cache = SimulationCache(simulation_cache_file, shared_files=shared_cache_files)
+    existing_links = ResultStore(path_to_result_store).read_links()
+    linked = set(existing_links['GEOID10'] + '_' + existing_links['sim_type'])
+    template = get_template() if _mode in ('jit', 'extend') else None
+    keys = {}
+    links = []
+    new_jobs = []
+    for job in jobs:
+        key = get_job_key(job, template)
+        source = cache.get(key) or sources.get(key)
+        if source is None:
+            sources[key] = job['name']
+            keys[job['name']] = key
+            new_jobs.append(job)
+        elif source != job['name'] and job['name'] not in linked:
+            links.append((job['name'], source))
+    print('Simulations to run:', len(new_jobs), 'Simulations reused:', len(jobs) - len(new_jobs), file=sys.__stdout__)
+    return new_jobs, keys, links
+
+
+def link_results(links):
+    # Links jobs to the stored results of their source. Each simulation is cached by its worker once its results are
+    # written, and jobs linked to a simulation without stored results (quarantined, or lost with a killed worker) run
+    # again with the next run.
+    stored = set(SimulationCache(simulation_cache_file, shared_files=shared_cache_files).names.values())
+    links = [(name, source) for name, source in links if source in stored]
+    if links:
+        ResultStore(path_to_result_store).link(links)
+    if _save_hotstart:
+        for name, source in links:
+            link_hotstart_files(name, source)
+    if _mode == 'fused':
+        for name, _ in links:
+            os.remove(path_to_input_files + name + '.inp')  # Deleted, the same as the input files of the simulations that ran
+
+
+def get_job_key(job, template=None):
+    # Key of the simulation's input file, and of everything else its stored results depend on
+    name = job['name']
+    if template is None:
+        with open(job['data']) as file:
+            text = file.read()
+    else:
+        text = template.render(job['data'])
+
+    extra = [_sim_type, _backend, _daily if _backend == 'extract' else _frequency]
+    if _mode == 'extend':
+        extra.append(hash_file(get_previous_hotstart_file(path_to_hotstart_files, name, template.start)))
+    return get_simulation_key(text, name.split('_')[0], *extra)
+
+
+def link_hotstart_files(name, source):
+    # The linked simulation ends in the same state as its source, so it can be extended the same way
+    for hotstart_file in glob.glob(path_to_hotstart_files + source + '_*.hsf'):
+        linked_file = path_to_hotstart_files + name + hotstart_file[len(path_to_hotstart_files + source):]
+        if not os.path.exists(linked_file):
+            os.link(hotstart_file, linked_file)
+
+
+def get_name(file):
+    return file[file.rfind('/')+1:file.rfind('.')]
+
+
 def worker(file):
-    name = file[file.rfind('/')+1:file.rfind('.')]
-    sim = Simulation(file)
-    sim.execute()
+    name = get_name(file)
+    start = time.time()
     try:
-        os.remove(file)
-        _ = shutil.move(path_to_input_files + name + '.out', path_to_output_files)  # move the output file to another folder
-        _ = shutil.move(path_to_input_files + name + '.rpt', path_to_report_files)
-    except:
-        pass
+        with _timer.stage('execute'):
+            run_isolated(run_simulation, file, hotstart_directory=get_hotstart_directory(), timeout=_timeout)
+    except Exception as error:
+        return quarantine_job(name, error, path_to_input_files)
+    seconds = time.time() - start
+    _timer.add_bytes(path_to_input_files + name + '.out', path_to_input_files + name + '.rpt')
+    os.remove(file)
+    _ = shutil.move(path_to_input_files + name + '.out', path_to_output_files)  # move the output file to another folder
+    _ = shutil.move(path_to_input_files + name + '.rpt', path_to_report_files)
+    return name, seconds
+
+
+def fused_worker(file):
+    # Runs the simulation, extracts the results to the result store, and deletes the input and binary output files
+    name = get_name(file)
+    try:
+        frame, seconds = simulate(file)
+    except Exception as error:
+        return quarantine_job(name, error, path_to_input_files)
+    _timer.add_bytes(path_to_input_files + name + '.out', path_to_input_files + name + '.rpt')
+    _ = shutil.move(path_to_input_files + name + '.rpt', path_to_report_files)  # Report files are small, keep them
+    with _timer.stage('extract'):
+        store_results(name, frame, [path_to_input_files + name + '.out', file])  # Deleted once the results are written
+    return name, seconds
+
+
+def get_hotstart_directory():
+    return path_to_hotstart_files if _save_hotstart else None
+
+
+def simulate(file, use_hotstart=None):
+    # Runs the simulation of the 'fused', 'jit' and 'extend' modes with the configured backend, returns its results and runtime
+    # The streaming backend accumulates its results while SWMM runs, so all of its time is the execute stage
+    start = time.time()
+    if _backend == 'streaming':
+        with _timer.stage('execute'):
+            frame = run_isolated(run_streaming, file, _frequency, use_hotstart=use_hotstart,
+                                 hotstart_directory=get_hotstart_directory(), timeout=_timeout)
+        return frame, time.time() - start
+
+    with _timer.stage('execute'):
+        run_isolated(run_simulation, file, use_hotstart, get_hotstart_directory(), timeout=_timeout)
+    seconds = time.time() - start
+    with _timer.stage('extract'):
+        frame = extract_variables(file[:file.rfind('.')] + '.out', _daily)
+    return frame, seconds
+
+
+def _initialize_store():
+    # Each worker writes the results of its jobs to its own part files, and compact() combines them after the run
+    global _store, _cache
+    _store = ResultStore(path_to_result_store)
+    _cache = SimulationCache(simulation_cache_file, load=False) if _memoize else None
+    Finalize(None, flush_results, exitpriority=10)  # Run when the pool's worker exits after pool.close()
+
+
+def store_results(name, frame, files=()):
+    # Buffers the results of a job in the worker's result store, and writes them every _flush_jobs jobs
+    _store.append(name, frame)
+    _pending.append((name, _key, files))
+    if _store.rows == 0 or len(_pending) >= _flush_jobs:  # No rows left: append wrote them at buffer_rows
+        flush_results()
+
+
+def flush_results():
+    # Writes the buffered results, then deletes the files of their jobs and caches their simulation keys
+    global _pending
+    _store.flush()
+    for name, key, files in _pending:
+        for file in files:
+            if os.path.exists(file):
+                os.remove(file)
+    if _cache is not None:
+        _cache.add([(key, name) for name, key, _ in _pending if key is not None])
+    _pending = []
+
+
+def get_jit_jobs():
+    # Load the Block Group Characteristics Data, only the columns used in the input files are sent to the workers
+    characteristics_frame = pd.read_csv(characteristics_file, skip_blank_lines=True, low_memory=False, dtype=str)
+    template = get_template()
+    days = get_days(template.start, template.end)
+
+    jobs = []
+    missing = 0
+    for values in characteristics_frame[template.fields].itertuples(index=False, name=None):
+        name = template.get_file_name(values)[:-4]
+        if _mode == 'extend' and not os.path.exists(get_previous_hotstart_file(path_to_hotstart_files, name, template.start)):
+            missing += 1  # Never simulated up to the extension, it needs a full run
+            continue
+        jobs.append(make_job(name, _sim_type, _rb_type, days, values))
+    print('Block Groups:', len(jobs))
+    if missing > 0:
+        print('Block groups without a hotstart file to extend:', missing)
+    return jobs
+
+
+def get_template():
+    if _mode == 'extend':
+        return InputFileTemplate(_sim_type, _rb_type, _extend_start, _extend_end, output_profile=_output_profile)
+    return InputFileTemplate(_sim_type, _rb_type, output_profile=_output_profile)
+
+
+def _initialize_jit_worker():
+    global _template
+    _template = get_template()
+    _initialize_store()
+
+
+def jit_worker(values):
+    # values: the block group's characteristics, in the order of _template.fields
+    scratch = tempfile.mkdtemp(dir=_scratch_dir)
+    name = _template.get_file_name(values)[:-4]
+    try:
+        with _timer.stage('input'):
+            file = _template.write_values(values, scratch)
+        use_hotstart = None
+        if _mode == 'extend':
+            use_hotstart = get_previous_hotstart_file(path_to_hotstart_files, name, _template.start)
+        frame, seconds = simulate(file, use_hotstart)
+        with _timer.stage('extract'):
+            store_results(name, frame)  # The scratch files are not needed to run the block group again
+    except Exception as error:
+        return quarantine_job(name, error, scratch)
+    finally:
+        _timer.add_bytes(*glob.glob(os.path.join(scratch, '*')))
+        shutil.rmtree(scratch, ignore_errors=True)  # Delete the input, report and output files
+    return name, seconds
 
 
 if __name__ == '__main__':
@@ -1,9 +1,19 @@
 import glob
-import persistqueue
-from pyswmm import Simulation
-from multiprocessing import Process
+import csv
+import time
+import signal
+import socket
+import traceback
+from hotstart import run_simulation as execute
+from multiprocessing import Process, Event
 import shutil
 import os
+import sys
+from job_queue import JobQueue
+from concurrency import make_tuner
+from instrumentation import JobTimer, ProgressSummary
+from isolation import run_isolated, SimulationFailed
+from quarantine import Quarantine
 
 
 _sim_types = {'ng': 'no_green_infrastructure',
@@ -13,44 +23,193 @@ _sim_types = {'ng': 'no_green_infrastructure',
 
 
 _sim_type = 'ng'
-_max_processes = 8
+_max_processes = None  # None tunes the number of workers while the simulations run (concurrency.py), from the number of cores
+
+# Number of input files each worker leases at a time
+_batch_size = 10
+
+# Number of finished input files a worker acknowledges at a time (and at the end of its batch), in one transaction that
+# also renews its lease. Files finished but not acknowledged when a worker dies are leased again, and the ones whose
+# results were already moved are acknowledged without running them again.
+_ack_size = 5
+
+# Number of times an input file is leased before it is failed, when its worker keeps dying
+_max_attempts = 3
+
+# Wall-clock seconds a simulation may run for, in its own child process (isolation.py). Simulations that time out,
+# crash or fail are failed in the queue and quarantined. None runs the simulations inside the workers.
+# Each child starts a new interpreter and imports pyswmm and pandas, a fixed cost per simulation (compare the
+# 'isolated' and 'simulation' stages of benchmark.py) that is small next to a multi-year simulation, and in exchange
+# a hung or crashing SWMM cannot stall or take down a worker. Set None for very short simulations.
+_timeout = 2 * 3600
+
+# Seconds before the input files leased by a worker that stopped (ex. killed, or its machine went down) are run by
+# another worker. A whole batch of simulations that run up to their timeout fits in a lease, and workers also renew
+# their lease each time they acknowledge finished files.
+_lease_seconds = _batch_size * (_timeout or 4 * 3600) + 3600
 
 
 path_to_input_files = '../input_files/' + _sim_type + '/'
 path_to_output_files = '../output_files/' + _sim_type + '/'
 path_to_report_files = '../report_files/' + _sim_type + '/'
 
-path_to_queue = '../queues/' + _sim_type + '_queue'
-q = persistqueue.UniqueAckQ(path_to_queue, auto_commit=True, multithreading=True)
+path_to_queue = '../queues/' + _sim_type + '_queue.db'
+
+# Input and report files of the quarantined simulations (quarantine.py)
+path_to_quarantine = '../quarantine/' + _sim_type + '/'
+
+# Input files whose simulation failed, with the error
+failed_jobs_file = '../logs/' + _sim_type + '_failed_jobs.csv'
+
+# Steady number of workers found for each simulation type, the next run starts from it
+concurrency_history_file = '../logs/concurrency_history.csv'
+
+# Append-only log of one JSON record per simulation, and live summary of the run (instrumentation.py)
+job_log_file = '../logs/' + _sim_type + '_queue_jobs.jsonl'
+summary_file = '../logs/' + _sim_type + '_queue_summary.json'
 
 
 def main():
-    if q.size == 0:
-        input_files = glob.glob(path_to_input_files + '*.inp')
-        print('Queue is empty, adding', len(input_files), 'files from', path_to_input_files)
-        for file in input_files:
-            q.put(file)
-
-    print('Queue Size:', q.size)
-    for i in range(_max_processes):
-        p = Process(target=worker)
-        p.start()
+    # Input files already in the queue are not added again, so an interrupted run is resumed by running this again
+    queue = JobQueue(path_to_queue, _lease_seconds, _max_attempts)
+    input_files = glob.glob(path_to_input_files + '*.inp')
+    print('Added', queue.put(input_files), 'of', len(input_files), 'files from', path_to_input_files)
+
+    # No worker of this machine is running yet, so files still leased by one are from a run that was killed
+    queue.release_workers(socket.gethostname() + '-%')
+    print('Queue:', queue.counts())
+
+    # Ctrl-C or kill stops the workers after their current simulation, the rest of their batch is put back in the queue
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda signal_number, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: stop.set())
+
+    # Every worker also has its own stop event, so the tuner can stop one after its current simulation
+    tuner = make_tuner(_max_processes, 'queue_' + _sim_type, path_to_input_files, concurrency_history_file)
+    started = time.time()  # The queue wait of the job log is counted from the start of this run
+    processes = [start_worker(stop, started) for _ in range(tuner.limit)]
+    counts = queue.counts()
+    done = counts['done']
+    summary = ProgressSummary(summary_file, sum(counts.values()), 'queue_' + _sim_type)
+    while processes:
+        time.sleep(1)
+        for process, worker_stop in [item for item in processes if not item[0].is_alive()]:
+            processes.remove((process, worker_stop))
+            if process.exitcode != 0:
+                # The worker died during a simulation, its files are leased again right away
+                print('Worker', process.pid, 'exited with code', process.exitcode)
+                queue.release_workers(get_worker_name(process.pid))
+                if not stop.is_set() and queue.counts()['ready'] > 0:
+                    processes.append(start_worker(stop, started))
+
+        # The throughput is measured from the simulations acknowledged in the queue
+        counts = queue.counts()
+        for _ in range(counts['done'] - done):
+            tuner.completed()
+        done = counts['done']
+        summary.update(counts['done'] + counts['failed'])
+        limit = tuner.update()
+        running = [item for item in processes if not item[1].is_set()]
+        if limit < len(running):
+            running[-1][1].set()
+        elif limit > len(running) and not stop.is_set() and counts['ready'] > 0:
+            processes.append(start_worker(stop, started))
+
+    counts = queue.counts()
+    summary.update(counts['done'] + counts['failed'], force=True)
+    write_failed_jobs(queue)
+    print('Queue:', counts)
+    queue.close()
     return
 
 
-def worker():
-    while True:
-        file = q.get(block=True)
-        name = file[file.rfind('/')+1:file.rfind('.')]
-        sim = Simulation(file)
-        sim.execute()
-        try:
-            os.remove(file)
-            _ = shutil.move(path_to_input_files + name + '.out', path_to_output_files)  # move the output file to another folder
-            _ = shutil.move(path_to_input_files + name + '.rpt', path_to_report_files)
-        except:
-            pass
-        q.ack(file)
+def start_worker(stop, started):
+    # Returns the process and its own stop event
+    worker_stop = Event()
+    process = Process(target=worker, args=(stop, worker_stop, started))
+    process.start()
+    return process, worker_stop
+
+
+def get_worker_name(pid):
+    return socket.gethostname() + '-' + str(pid)
+
+
+def worker(stop, worker_stop, started):
+    # Runs batches of input files until the queue is drained, or the runner or the tuner stops it
+    sys.stdout = open(os.devnull, 'w')
+    queue = JobQueue(path_to_queue, _lease_seconds, _max_attempts)  # Each process has its own connection
+    name = get_worker_name(os.getpid())
+
+    def stopped():
+        return stop.is_set() or worker_stop.is_set()
+
+    while not stopped():
+        jobs = queue.lease(name, _batch_size)
+        if not jobs:
+            break  # Drained
+
+        done = []
+        failures = []
+        for i, (job_id, file) in enumerate(jobs):
+            if stopped():
+                queue.release([job_id for job_id, _ in jobs[i:]])
+                break
+            timer = JobTimer(get_name(file), started)
+            try:
+                run_simulation(file, timer)
+                done.append(job_id)
+            except SimulationFailed as error:
+                timer.status = error.status
+                failures.append((job_id, error.status + ': ' + str(error)))
+                quarantine(file, error.status, str(error))
+            except Exception:
+                timer.status = 'error'
+                failures.append((job_id, traceback.format_exc()))
+                quarantine(file, 'error', traceback.format_exc())
+            timer.write(job_log_file)
+            if len(done) + len(failures) >= _ack_size:
+                queue.ack(name, done, failures)  # The rest of the batch gets a full lease again
+                done = []
+                failures = []
+        queue.ack(name, done, failures)
+
+    queue.close()
+
+
+def get_name(file):
+    return file[file.rfind('/')+1:file.rfind('.')]
+
+
+def run_simulation(file, timer):
+    name = get_name(file)
+    if not os.path.exists(file) and os.path.exists(path_to_output_files + name + '.out'):
+        return  # Finished before its worker died, but not acknowledged
+    with timer.stage('execute'):
+        run_isolated(execute, file, timeout=_timeout)
+    timer.add_bytes(path_to_input_files + name + '.out', path_to_input_files + name + '.rpt')
+    os.remove(file)
+    _ = shutil.move(path_to_input_files + name + '.out', path_to_output_files + name + '.out')  # move the output file to another folder
+    _ = shutil.move(path_to_input_files + name + '.rpt', path_to_report_files + name + '.rpt')
+
+
+def quarantine(file, status, message):
+    # Moves the input and report files of a failed simulation to the quarantine, the error is also kept in the queue
+    name = get_name(file)
+    if os.path.exists(path_to_input_files + name + '.out'):
+        os.remove(path_to_input_files + name + '.out')
+    Quarantine(path_to_quarantine).add(name, status, message, [file, path_to_input_files + name + '.rpt'])
+
+
+def write_failed_jobs(queue):
+    failed = queue.failed()
+    if len(failed) > 0:
+        print(len(failed), 'simulations failed, see', failed_jobs_file)
+    os.makedirs(os.path.dirname(failed_jobs_file), exist_ok=True)
+    with open(failed_jobs_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['input_file', 'worker', 'attempts', 'error'])
+        writer.writerows(failed)
 
 
 if __name__ == '__main__':
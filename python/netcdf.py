@@ -93,48 +93,91 @@ def convert_int_to_month(number):
     return months[int(number)]
 
 
-def extract_evaporation_data(geotiff_files):
-    # TODO Make this a bit faster by filling the dataframe directly instead of array -> dataframe. https://stackoverflow.com/questions/17091769/python-pandas-fill-a-dataframe-row-by-row
-    # Preconditions: A list of .geotiff files has been passed
-    # Postconditions: A pickled pandas dataframe file has been created, containing all of the data from the .geotiff files
+# First year of the monthly GeoTIFFs (extract_bands), and the number of years read. The data for 2019 is incomplete.
+_start_year = 1979
+_years = 40
 
-    with rasterio.open(geotiff_files[0]) as raster:
-        width = raster.profile['width']  # Get width of raster
-        height = raster.profile['height']  # Get height of raster
+month_names = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
 
-    evap_array = np.zeros((width, height, 40, 12))  # Create a 4-D array (Width x Height x Months x Years)
 
-    year = 0  # Begin the year at 0
-    month = 0  # Begin the month at 0
+def get_months(count, first=0):
+    # Returns the months of the GeoTIFFs first to first + count (one GeoTIFF per month from January of _start_year)
+    return pd.period_range(start=str(_start_year) + '-01', periods=first + count, freq='M')[first:]
 
-    for geotiff_file in tqdm(geotiff_files):  # TQDM gives us a progress bar
+
+def read_bands(geotiff_files, cube):
+    # Reads each GeoTIFF's band into its slice of cube (time, y, x), without an intermediate array per file
+    for index, geotiff_file in enumerate(geotiff_files):
         with rasterio.open(geotiff_file) as raster:
-            data = raster.read()  # Convert the .geotiff file to a numpy array
-            data = np.squeeze(data)  # Remove one of the dimensions as it is a singleton dimension (1, 277, 349) -> (277, 349)
+            raster.read(1, out=cube[index])
 
-            # Loop through the 2-D raster array
-            for i in range(raster.width):
-                for j in range(raster.height):
-                    evap_array[i][j][year][month] = data[j][i]  # Insert the .geotiff data into the corresponding spot in our array. data[j][i] because the raster data is [height][width], but our array is [width][height]
 
-        # Increment the month (or year)
-        if month == 11:
-            month = 0
-            year += 1
-            if year == 40:  # The data for 2019 is incomplete, so end early
-                break
-        else:
-            month += 1
-
-    arr = np.column_stack(list(map(np.ravel, np.meshgrid(*map(np.arange, evap_array.shape), indexing="ij"))) + [evap_array.ravel()])  # Convert 4-D Array to Dataframe https://stackoverflow.com/questions/45422898/how-can-i-efficiently-convert-a-4d-numpy-array-into-a-pandas-dataframe-with-indi
-    frame = pd.DataFrame(arr, columns=['x', 'y', 'year', 'month', 'value'])  # Set column names
-    frame['year'] = frame['year'].apply(lambda x: x + 1979).astype(int)  # Convert [0-39] to [1979-2018]
-    frame['x'] = frame['x'].astype(int)  # Convert float to int
-    frame['y'] = frame['y'].astype(int)  # Convert float to int
-    frame['month'] = frame['month'].apply(convert_int_to_month)  # Convert [0-11] to month name
+def load_evaporation_cube(geotiff_files, years=_years):
+    # Preconditions: A list of the monthly .geotiff files (YYYY_MM.geotiff) has been passed
+    # Postconditions: A float32 (time, y, x) array of the first `years` years of data, and the month of each time step,
+    #                 have been returned
+
+    geotiff_files = sorted(geotiff_files)[:years * 12]  # YYYY_MM names sort by month
+    with rasterio.open(geotiff_files[0]) as raster:
+        height, width = raster.height, raster.width
+
+    cube = np.empty((len(geotiff_files), height, width), dtype=np.float32)
+    read_bands(tqdm(geotiff_files), cube)
+    return cube, get_months(len(geotiff_files))
+
+
+def iter_evaporation_chunks(geotiff_files, chunk_months=120):
+    # Streaming version of load_evaporation_cube for records too long to hold in memory, yields float32
+    # (time, y, x) arrays of chunk_months months (the last one can be shorter) and their months
+    geotiff_files = sorted(geotiff_files)
+    with rasterio.open(geotiff_files[0]) as raster:
+        height, width = raster.height, raster.width
+
+    for first in trange(0, len(geotiff_files), chunk_months):
+        chunk_files = geotiff_files[first:first + chunk_months]
+        cube = np.empty((len(chunk_files), height, width), dtype=np.float32)
+        read_bands(chunk_files, cube)
+        yield cube, get_months(len(chunk_files), first)
+
+
+def cube_to_frame(cube, months):
+    # Preconditions: A (time, y, x) array and its months (load_evaporation_cube) have been passed
+    # Postconditions: A long dataframe with one row per pixel and month has been returned: x and y are int16, year and
+    #                 month are categories and value is float32
+
+    time, height, width = cube.shape
+    pixels = height * width
+    years = np.asarray(months.year)
+    frame = pd.DataFrame({'x': np.tile(np.arange(width, dtype=np.int16), time * height),
+                          'y': np.tile(np.repeat(np.arange(height, dtype=np.int16), width), time),
+                          'year': pd.Categorical.from_codes(np.repeat(years - years.min(), pixels), np.arange(years.min(), years.max() + 1)),
+                          'month': pd.Categorical.from_codes(np.repeat(np.asarray(months.month) - 1, pixels), month_names, ordered=True),
+                          'value': cube.reshape(-1)})
     return frame
 
 
+def extract_evaporation_data(geotiff_files):
+    # Preconditions: A list of .geotiff files has been passed
+    # Postconditions: A long dataframe (x, y, year, month, value) of the data from the .geotiff files has been returned,
+    #                 see load_evaporation_cube for the data as an array
+    return cube_to_frame(*load_evaporation_cube(geotiff_files))
+
+
+def get_monthly_average(geotiff_files, chunk_months=120):
+    # Preconditions: A list of .geotiff files has been passed
+    # Postconditions: A float32 (12, y, x) array of the average of each month over the years has been returned,
+    #                 read chunk by chunk
+    totals = None
+    for cube, months in iter_evaporation_chunks(geotiff_files, chunk_months):
+        if totals is None:
+            totals = np.zeros((12,) + cube.shape[1:], dtype=np.float64)
+            counts = np.zeros(12, dtype=np.int64)
+        month_indices = np.asarray(months.month) - 1
+        np.add.at(totals, month_indices, cube)
+        np.add.at(counts, month_indices, 1)
+    return (totals / counts[:, None, None]).astype(np.float32)
+
+
 def get_average_evaporation(frame):
     # Preconditions: A frame generated by extract_evaporation_data has been passed.
     # Postconditions: Twelve files have been created, containing the average evaporation values for each month
@@ -143,7 +186,7 @@ def get_average_evaporation(frame):
         print(month)
         sub_frame = frame.loc[(frame['month'] == month)]  # Select the month we are averaging over
         sub_frame.drop(labels='year', axis=1, inplace=True)  # Drop the 'year' column
-        sub_frame = sub_frame.groupby(['x', 'y']).mean()  # Sum each coordinate's value for each year
+        sub_frame = sub_frame.groupby(['x', 'y'])[['value']].mean()  # Average each coordinate's value over the years
         sub_frame.reset_index(inplace=True)
         return sub_frame
 
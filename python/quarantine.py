@@ -0,0 +1,102 @@
+import os
+import io
+import re
+import csv
+import shutil
+import pandas as pd
+from datetime import datetime
+
+
+# Simulations that failed, ran past their time budget or crashed are quarantined: their input and report files are
+# moved to <directory>/<name>/ and a row is appended to <directory>/_quarantine.csv, so the run goes on and the bad
+# block groups can be looked at (and run again) later.
+
+_columns = ['time', 'name', 'status', 'runoff_continuity_error', 'routing_continuity_error', 'report_errors', 'message']
+
+# Continuity error lines of a report file, by the section they follow
+_continuity_sections = {'Runoff Quantity Continuity': 'runoff_continuity_error',
+                        'Flow Routing Continuity': 'routing_continuity_error'}
+_continuity_pattern = re.compile(r'Continuity Error \(%\)\s*\.*\s*(-?[\d.]+)')
+
+
+def read_report_errors(report_file):
+    # OUTPUT:
+    #   errors: the runoff and routing continuity errors (%) of a report file, None when the simulation did not get to
+    #           write them, and its ERROR and WARNING lines (ex. 'ERROR 317: cannot open rainfall data file')
+
+    errors = dict.fromkeys(_continuity_sections.values())
+    errors['report_errors'] = []
+    if report_file is None or not os.path.exists(report_file):
+        return errors
+
+    section = None
+    with open(report_file, errors='replace') as file:
+        for line in file:
+            for title, column in _continuity_sections.items():
+                if title in line:
+                    section = column
+            match = _continuity_pattern.search(line)
+            if match is not None and section is not None:
+                errors[section] = float(match.group(1))
+                section = None
+            stripped = line.strip()
+            if stripped.startswith('ERROR') or stripped.startswith('WARNING'):
+                errors['report_errors'].append(stripped)
+    return errors
+
+
+class Quarantine:
+    #   quarantine = Quarantine('../quarantine/ng/')
+    #   quarantine.add('170319800001_ng', 'timeout', 'Killed after 7200 seconds', [input_file, report_file])
+    #   quarantine.read()  # One row per quarantined simulation
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.list_file = os.path.join(directory, '_quarantine.csv')
+
+
+    def add(self, name, status, message, files):
+        # INPUTS:
+        #   name: simulation name (<GEOID10>_<sim_type>)
+        #   status: 'timeout', 'crashed' or 'error'
+        #   message: the error, or why the simulation was killed
+        #   files: the simulation's input and report files (missing ones are skipped), moved to the quarantine
+
+        folder = os.path.join(self.directory, name)
+        os.makedirs(folder, exist_ok=True)
+        report_file = None
+        for file in files:
+            if file is not None and os.path.exists(file):
+                moved = shutil.move(file, os.path.join(folder, os.path.basename(file)))
+                if moved.endswith('.rpt'):
+                    report_file = moved
+
+        errors = read_report_errors(report_file)
+        row = [datetime.now().isoformat(timespec='seconds'), name, status, errors['runoff_continuity_error'],
+               errors['routing_continuity_error'], ' | '.join(errors['report_errors']), message]
+
+        # Workers quarantine concurrently, so the header is written by the worker that creates the file and each row
+        # is a single append
+        try:
+            descriptor = os.open(self.list_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(descriptor, (','.join(_columns) + '\n').encode())
+            os.close(descriptor)
+        except FileExistsError:
+            pass
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        descriptor = os.open(self.list_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, buffer.getvalue().encode())
+        finally:
+            os.close(descriptor)
+
+
+    def read(self):
+        if not os.path.exists(self.list_file):
+            return pd.DataFrame(columns=_columns)
+        return pd.read_csv(self.list_file, dtype={'name': str})
+
+
+    def names(self):
+        return set(self.read()['name'])
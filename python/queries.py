@@ -0,0 +1,187 @@
+import os
+import sys
+import pandas as pd
+from result_store import ResultStore
+
+
+# Area-weighted rollups of the stored simulation results for any GEOID prefix (state, county, tract) and date range.
+# Each variable is summed over the days of the date range (or of each month/year). Rainfall and evaporation +
+# infiltration are rates per unit area, so they are weighted by the area (Area_acre_30m) of each block group: 'total'
+# is the sum over the block groups of area * value. Runoff is a flow (CFS) from the whole subcatchment, which already
+# scales with its area, so its 'total' is the sum of the flows. 'mean' divides the total by the area of the block
+# groups with results (runoff per acre).
+#   query = ResultQuery()
+#   query.query('17031', '2015-01-01', '2015-12-31')                       # Cook County, one row per sim_type
+#   query.query('17', '2015-01-01', '2015-12-31', frequency='M', level=5)  # Every Illinois county, by month
+# Monthly and annual sums of every county are precomputed (build_rollups), so queries by state or county over whole
+# months are answered from them without reading the daily results. Other queries (a tract, part of a month, daily
+# values) read the daily results of the prefix from the result store. The rollups are built again after a run with:
+#   python queries.py build
+#   python queries.py 17031 2015-01-01 2015-12-31 mean
+
+
+path_to_result_store = '../result_store/'
+path_to_rollups = path_to_result_store + '_rollups/'
+characteristics_file = '../data/input_file_data/Selected_BG_inputs_20191212.csv'
+
+# Variables of the rollups (extraction.column_names), the system does not report infiltration apart from evaporation
+variables = ['rainfall', 'runoff', 'evaporation_infiltration']
+
+# Variables that are rates per unit area, weighted by the area of each block group
+area_weighted_variables = ['rainfall', 'evaporation_infiltration']
+
+# Number of GEOID10 digits the rollups are precomputed at (5 = county)
+_rollup_digits = 5
+
+
+class ResultQuery:
+
+    def __init__(self, store_directory=path_to_result_store, rollups_directory=path_to_rollups, areas_file=characteristics_file):
+        self.store = ResultStore(store_directory)
+        self.rollups_directory = rollups_directory
+        self.areas_file = areas_file
+        self._areas = None
+        self._rollups = {}
+
+
+    def get_areas(self):
+        # Area_acre_30m of each GEOID10
+        if self._areas is None:
+            frame = pd.read_csv(self.areas_file, usecols=['GEOID10', 'Area_acre_30m'], dtype={'GEOID10': str})
+            self._areas = pd.to_numeric(frame['Area_acre_30m'], errors='coerce').groupby(frame['GEOID10']).first()
+        return self._areas
+
+
+    def weigh(self, frame, sim_type=None):
+        # Multiplies the rates per unit area of each block group by its area, block groups without an area are dropped
+        frame = frame.assign(area=frame['GEOID10'].map(self.get_areas())).dropna(subset=['area'])
+        frame[variables] = frame[variables].astype(float)
+        frame[area_weighted_variables] = frame[area_weighted_variables].multiply(frame['area'], axis=0)
+        if sim_type is not None:
+            frame['sim_type'] = sim_type
+        return frame.drop(columns='area')
+
+
+    def get_result_areas(self, keys, digits=None):
+        # keys: GEOID10 and sim_type of the block groups with results, returns their area by GEOID prefix of digits
+        # digits (every digit by default) and sim_type
+        keys = keys.drop_duplicates()
+        keys = keys.assign(area=keys['GEOID10'].map(self.get_areas()), geoid=keys['GEOID10'].str[:digits])
+        return keys.groupby(['geoid', 'sim_type'], as_index=False)['area'].sum()
+
+
+    def build_rollups(self):
+        # Sums the daily results of every row group of the store by month, weighted by area (weigh), and adds them up by county.
+        # Linked block groups (memoization.py) count with the results of their source block group.
+        links = self.store.read_links()
+        months = []
+        for sim_type, frame in self.store.iter_row_groups(['date'] + variables):
+            frame = frame.groupby(['GEOID10', frame['date'].dt.to_period('M').dt.start_time])[variables].sum().reset_index()
+            linked = links.loc[(links['sim_type'] == sim_type) & links['source'].isin(frame['GEOID10'].unique())]
+            if len(linked) > 0:
+                sources = linked[['GEOID10', 'source']].merge(frame.rename(columns={'GEOID10': 'source'}), on='source')
+                frame = pd.concat([frame, sources.drop(columns='source')], ignore_index=True)
+            frame = self.weigh(frame, sim_type)
+            frame['geoid'] = frame.pop('GEOID10').str[:_rollup_digits]
+            months.append(frame.groupby(['geoid', 'sim_type', 'date'], as_index=False)[variables].sum())
+
+        monthly = pd.concat(months, ignore_index=True).groupby(['geoid', 'sim_type', 'date'], as_index=False)[variables].sum()
+        annual = monthly.groupby(['geoid', 'sim_type', monthly['date'].dt.to_period('Y').dt.start_time], as_index=False)[variables].sum()
+        keys = pd.concat([self.store.read_index()[['GEOID10', 'sim_type']], links[['GEOID10', 'sim_type']]], ignore_index=True)
+
+        os.makedirs(self.rollups_directory, exist_ok=True)
+        for name, frame in [('monthly', monthly), ('annual', annual), ('area', self.get_result_areas(keys, _rollup_digits))]:
+            frame.to_parquet(os.path.join(self.rollups_directory, name + '.parquet'), index=False)
+        self._rollups = {}
+        print('Rollups:', monthly['geoid'].nunique(), 'counties,', len(monthly), 'monthly rows ->', self.rollups_directory)
+
+
+    def rollups_current(self):
+        # The rollups are used when they have been built since the store (its index or links) last changed
+        rollup_files = [os.path.join(self.rollups_directory, name + '.parquet') for name in ['monthly', 'annual', 'area']]
+        if not all(os.path.exists(file) for file in rollup_files):
+            return False
+        store_files = [file for file in [self.store.index_file, self.store.links_file] if os.path.exists(file)]
+        return min(os.path.getmtime(file) for file in rollup_files) >= max([os.path.getmtime(file) for file in store_files] + [0])
+
+
+    def get_rollup(self, name):
+        # Rollups are kept in memory once read, for interactive queries
+        if name not in self._rollups:
+            self._rollups[name] = pd.read_parquet(os.path.join(self.rollups_directory, name + '.parquet'))
+        return self._rollups[name]
+
+
+    def query(self, prefix='', start=None, end=None, statistic='mean', frequency=None, level=None, sim_types=None):
+        # INPUTS:
+        #   prefix: GEOID prefix of the block groups ('' for every block group, '17' for Illinois, '17031' for Cook County)
+        #   start, end (optional): first and last day of the date range (ex. '2015-01-01'), the whole record by default
+        #   statistic (optional): 'mean' or 'total'
+        #   frequency (optional): None for one value over the date range, 'D', 'M' or 'A' for one value per day, month or year
+        #   level (optional): number of GEOID digits the results are grouped by (default len(prefix), ex. 5 for each county)
+        #   sim_types (optional): list of sim_types, every one by default
+
+        # OUTPUT:
+        #   frame: one row per GEOID prefix of level digits, sim_type (and date), one column per variable
+
+        assert statistic in ('mean', 'total'), 'statistic is mean or total'
+        assert frequency in (None, 'D', 'M', 'A'), 'frequency is None, D, M or A'
+        level = len(prefix) if level is None else level
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+
+        whole_months = (start is None or start.is_month_start) and (end is None or end.is_month_end)
+        use_rollups = max(level, len(prefix)) <= _rollup_digits and frequency != 'D' and whole_months
+        if use_rollups and not self.rollups_current():
+            # Missing, or older than the results: the daily results are read until 'python queries.py build' is run
+            print('The rollups in', self.rollups_directory, 'are missing or out of date, reading the daily results')
+            self._rollups = {}
+            use_rollups = False
+        if use_rollups:
+            whole_years = (start is None or start.is_year_start) and (end is None or end.is_year_end)
+            frame = self.get_rollup('annual' if whole_years and frequency != 'M' else 'monthly')
+            frame = frame.loc[frame['geoid'].str.startswith(prefix)]
+            areas = self.get_rollup('area')
+            areas = areas.loc[areas['geoid'].str.startswith(prefix)]
+        else:
+            frame = self.store.read(prefix=prefix, columns=['date'] + variables)
+            areas = self.get_result_areas(frame[['GEOID10', 'sim_type']])
+            frame = self.weigh(frame)
+            frame['geoid'] = frame.pop('GEOID10')
+
+        if start is not None:
+            frame = frame.loc[frame['date'] >= start]
+        if end is not None:
+            frame = frame.loc[frame['date'] <= end]
+        if sim_types is not None:
+            frame = frame.loc[frame['sim_type'].isin(sim_types)]
+        return aggregate(frame, areas, statistic, frequency, level)
+
+
+def aggregate(frame, areas, statistic, frequency, level):
+    # Adds up the area-weighted sums of frame (geoid, sim_type, date, variables) by GEOID prefix of level digits,
+    # sim_type and frequency, and divides the means by the area of the block groups with results
+    keys = [frame['geoid'].str[:level].rename('geoid'), frame['sim_type'].astype(str)]
+    if frequency is not None:
+        keys.append(frame['date'].dt.to_period(frequency.replace('A', 'Y')).dt.start_time)
+    frame = frame.groupby(keys)[variables].sum()
+    if statistic == 'total':
+        return frame.reset_index()
+
+    areas = areas.groupby([areas['geoid'].str[:level], areas['sim_type'].astype(str)])['area'].sum()
+    frame = frame.divide(areas.reindex(frame.index.droplevel('date') if frequency is not None else frame.index).values, axis=0)
+    return frame.reset_index()
+
+
+def main():
+    if sys.argv[1] == 'build':
+        ResultQuery().build_rollups()
+        return
+    prefix, start, end = sys.argv[1:4]
+    statistic = sys.argv[4] if len(sys.argv) > 4 else 'mean'
+    print(ResultQuery().query(prefix, start, end, statistic).to_string(index=False))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import os
+import re
+import sys
+import glob
+import pandas as pd
+from multiprocessing import Pool
+from concurrency import get_cpu_count
+
+
+# Reads the summaries of SWMM report (.rpt) files into one typed table, one row per report keyed by GEOID10, sim_type
+# and precipitation source. The runoff quantity and flow routing continuity tables, the subcatchment runoff summary
+# and the LID performance summary are read, and each file is only read up to the end of the last of them.
+#   frame = read_reports(glob.glob('../report_files/ng/*.rpt'), source='prism')
+#   python reports.py ../logs/reports.parquet prism='../report_files/*/*.rpt' daily='./daily/*.rpt'
+# Report files named <GEOID10>_<sim_type>_<source>.rpt (ex. 170319800001_ng_daily.rpt) take their source from the name.
+
+_continuity_sections = {'Runoff Quantity Continuity': 'runoff', 'Flow Routing Continuity': 'routing'}
+_table_sections = ['Subcatchment Runoff Summary', 'LID Performance Summary']
+
+# Columns of the tables, by the number of values in a row (older SWMM versions do not split impervious and pervious runoff)
+_subcatchment_columns = {10: ['total_precip', 'total_runon', 'total_evap', 'total_infil', 'imperv_runoff', 'perv_runoff',
+                              'total_runoff', 'total_runoff_mgal', 'peak_runoff', 'runoff_coeff'],
+                         8: ['total_precip', 'total_runon', 'total_evap', 'total_infil', 'total_runoff',
+                             'total_runoff_mgal', 'peak_runoff', 'runoff_coeff']}
+_lid_columns = {8: ['total_inflow', 'evap_loss', 'infil_loss', 'surface_outflow', 'drain_outflow', 'initial_storage',
+                    'final_storage', 'continuity_error']}
+
+_key_columns = ['GEOID10', 'sim_type', 'source']
+
+_label_pattern = re.compile(r'^\s*(.+?)\s*\.{2,}\s*(.*)$')
+
+
+def get_column_name(label):
+    # 'Total Precipitation' -> 'total_precipitation'
+    return re.sub(r'[^a-z0-9]+', '_', label.lower()).strip('_')
+
+
+def get_key(report_file, source=None):
+    # Returns the GEOID10, sim_type and precipitation source of a report file
+    parts = os.path.splitext(os.path.basename(report_file))[0].split('_')
+    return {'GEOID10': parts[0], 'sim_type': parts[1] if len(parts) > 1 else None,
+            'source': '_'.join(parts[2:]) if len(parts) > 2 else source}
+
+
+def parse_continuity(line, prefix, row):
+    match = _label_pattern.match(line)
+    if match is None:
+        return
+    name = re.sub(r'_volume$', '', get_column_name(match.group(1)))
+    values = [float(value) for value in match.group(2).split()]
+    if name == 'continuity_error':
+        row[prefix + '_continuity_error'] = values[0]
+    elif prefix == 'runoff':
+        row['runoff_' + name + '_volume'] = values[0]
+        if len(values) > 1:
+            row['runoff_' + name + '_depth'] = values[1]
+    else:
+        row['routing_' + name + '_volume'] = values[0]  # The second value is the same volume in 10^6 gal
+
+
+def parse_table_row(line, section, row):
+    fields = line.split()
+    if section == 'Subcatchment Runoff Summary':
+        prefix, values, columns = fields[0].lower() + '_', fields[1:], _subcatchment_columns
+    else:
+        prefix, values, columns = fields[0].lower() + '_' + fields[1].lower() + '_', fields[2:], _lid_columns
+    names = columns.get(len(values), ['value_' + str(i) for i in range(len(values))])
+    for name, value in zip(names, values):
+        row[prefix + name] = float(value)
+
+
+def parse_report(report_file, source=None):
+    # INPUTS:
+    #   report_file: path to the .rpt file
+    #   source (optional): precipitation source, when it is not in the file name
+
+    # OUTPUT:
+    #   row: dictionary of the key columns and every value read from the summaries
+
+    row = get_key(report_file, source)
+    section = None
+    rules = 0  # Number of dashed rules seen in the current table section, its rows come after the second
+    previous = ['', '']
+    subcatchments_read = False
+
+    with open(report_file, errors='replace') as file:
+        for line in file:
+            stripped = line.strip()
+
+            # Section titles are framed by lines of asterisks (the continuity titles are followed by their units)
+            if stripped.startswith('***') and previous[0].startswith('***'):
+                title = re.split(r'\s{2,}', previous[1].strip())[0]
+                if subcatchments_read and title not in _table_sections:
+                    break  # Every needed section has been read
+                section = title
+                rules = 0
+                subcatchments_read = subcatchments_read or title == 'Subcatchment Runoff Summary'
+            elif stripped.startswith('Analysis begun on'):
+                break
+            elif section in _continuity_sections and '..' in stripped:
+                parse_continuity(stripped, _continuity_sections[section], row)
+            elif section in _table_sections:
+                if stripped.startswith('---'):
+                    rules += 1
+                elif rules >= 2 and stripped:
+                    parse_table_row(stripped, section, row)
+                elif rules >= 2:
+                    section = None  # A blank line ends the table
+
+            previous = [previous[1], stripped]
+    return row
+
+
+def _parse_report(item):
+    return parse_report(*item)
+
+
+def read_reports(report_files, source=None, processes=None, chunksize=256):
+    # INPUTS:
+    #   report_files: paths to .rpt files
+    #   source (optional): precipitation source of the files whose name does not have one
+    #   processes (optional): number of processes (default the number of cores)
+
+    # OUTPUT:
+    #   frame: one row per report, the key columns are categories and every value is a float
+
+    items = [(report_file, source) for report_file in report_files]
+    with Pool(processes or get_cpu_count()) as pool:
+        rows = pool.map(_parse_report, items, chunksize=chunksize)
+
+    frame = pd.DataFrame(rows, columns=None if rows else _key_columns)
+    value_columns = sorted(column for column in frame.columns if column not in _key_columns)
+    frame = frame[_key_columns + value_columns]
+    frame[value_columns] = frame[value_columns].astype(float)
+    frame['GEOID10'] = frame['GEOID10'].astype(str)
+    frame['sim_type'] = frame['sim_type'].astype('category')
+    frame['source'] = frame['source'].astype('category')
+    return frame
+
+
+def main():
+    # python reports.py <output file (.parquet or .csv)> <source>=<glob> [<source>=<glob> ...]
+    output_file = sys.argv[1]
+    frames = []
+    for argument in sys.argv[2:]:
+        source, pattern = argument.split('=', 1)
+        report_files = sorted(glob.glob(pattern))
+        print(source + ':', len(report_files), 'report files')
+        frames.append(read_reports(report_files, source))
+
+    frame = pd.concat(frames, ignore_index=True)
+    for column in ['sim_type', 'source']:
+        frame[column] = frame[column].astype('category')
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if output_file.endswith('.csv'):
+        frame.to_csv(output_file, index=False)
+    else:
+        frame.to_parquet(output_file, index=False)
+    print('Reports:', len(frame), '->', output_file)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+import os
+import io
+import uuid
+import glob
+import shutil
+import socket
+import itertools
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+_index_columns = ['GEOID10', 'sim_type', 'file', 'row_group', 'rows']
+
+# Number of rows of the part files written by compact() and merge()
+_target_rows = 5000000
+
+
+class ResultStore:
+    # Columnar (Parquet) store of the extracted simulation results, shared by every worker.
+    # The results are partitioned by state FIPS (the first two digits of GEOID10) and sim_type, and each worker buffers
+    # its results and writes its own part files, so workers never write to the same file:
+    #   <directory>/state=<FIPS>/sim_type=<ng|rg|rb>/part-<host>-<pid>-<n>.parquet
+    # Every part file holds rows of GEOID10, date and one float32 column per extracted variable, sorted by GEOID10 and
+    # date, and every block group is in a single row group. <directory>/_index.csv lists the part file and row group of
+    # each GEOID10 and sim_type, so reading a few block groups (ex. one county's three scenarios) only reads their row
+    # groups. compact() combines the small part files of each partition once the workers are done.
+    # Simulations that were not run because their results are the same as another simulation's (memoization.py) are
+    # linked to that simulation in <directory>/_links.csv, and read() returns the linked results under their own GEOID10.
+
+    def __init__(self, directory, buffer_rows=500000, row_group_rows=100000):
+        # INPUTS:
+        #   directory: folder of the result store
+        #   buffer_rows (optional): number of rows kept in memory before they are written to part files
+        #   row_group_rows (optional): block groups are added to a row group until it has at least this many rows
+        self.directory = directory
+        self.buffer_rows = buffer_rows
+        self.row_group_rows = row_group_rows
+        self.buffer = []
+        self.rows = 0
+        self._counter = itertools.count()
+        # Files starting with _ are skipped by the Parquet readers
+        self.links_file = os.path.join(directory, '_links.csv')
+        self.index_file = os.path.join(directory, '_index.csv')
+
+
+    def get_partition(self, state, sim_type):
+        return os.path.join('state=' + state, 'sim_type=' + sim_type)
+
+
+    def append(self, name, frame):
+        # name: simulation name (<GEOID10>_<sim_type>), frame: extracted results indexed by date
+        geoid, sim_type = name.split('_')[:2]
+        frame = frame.reset_index()
+        float_columns = frame.select_dtypes('float').columns
+        frame[float_columns] = frame[float_columns].astype('float32')
+        frame.insert(0, 'sim_type', sim_type)
+        frame.insert(0, 'GEOID10', geoid)
+
+        self.buffer.append(frame)
+        self.rows += len(frame)
+        if self.rows >= self.buffer_rows:
+            self.flush()
+
+
+    def flush(self):
+        # Write the buffered results, one part file per state and sim_type
+        if not self.buffer:
+            return
+
+        frame = pd.concat(self.buffer, ignore_index=True)
+        index = []
+        for (state, sim_type), sub_frame in frame.groupby([frame['GEOID10'].str[:2], 'sim_type']):
+            part_name = 'part-' + socket.gethostname() + '-' + str(os.getpid()) + '-' + str(next(self._counter)) + '.parquet'
+            part_file = os.path.join(self.get_partition(state, sim_type), part_name)
+            index.append(self._write_part(part_file, sim_type, sub_frame.drop(columns='sim_type')))
+        self._append_index(pd.concat(index, ignore_index=True))
+
+        self.buffer = []
+        self.rows = 0
+
+
+    def _write_part(self, part_file, sim_type, frame):
+        # Writes frame to part_file (relative to the store), with whole block groups in each row group.
+        # Returns the index rows of the part file.
+        frame = frame.sort_values(['GEOID10', 'date'] if 'date' in frame.columns else ['GEOID10'])
+        path = os.path.join(self.directory, part_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_file = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))  # Readers skip hidden files until the rename
+
+        index = []
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        counts = frame['GEOID10'].value_counts(sort=False).sort_index()
+        with pq.ParquetWriter(temporary_file, table.schema) as writer:
+            offset = 0
+            group = []
+            row_group = 0
+            for geoid, rows in itertools.chain(counts.items(), [(None, 0)]):
+                group_rows = sum(count for _, count in group)
+                if group and (geoid is None or group_rows >= self.row_group_rows):
+                    writer.write_table(table.slice(offset, group_rows), row_group_size=group_rows)
+                    index.extend([group_geoid, sim_type, part_file, row_group, count] for group_geoid, count in group)
+                    offset += group_rows
+                    row_group += 1
+                    group = []
+                if geoid is not None:
+                    group.append((geoid, rows))
+        os.replace(temporary_file, path)
+        return pd.DataFrame(index, columns=_index_columns)
+
+
+    def _append_index(self, index):
+        # Workers write concurrently, so the header is written by the worker that creates the index and the rows of a
+        # flush are a single append
+        if len(index) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            descriptor = os.open(self.index_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(descriptor, (','.join(_index_columns) + '\n').encode())
+            os.close(descriptor)
+        except FileExistsError:
+            pass
+        buffer = io.StringIO()
+        index[_index_columns].to_csv(buffer, index=False, header=False)
+        descriptor = os.open(self.index_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(descriptor, buffer.getvalue().encode())
+        finally:
+            os.close(descriptor)
+
+
+    def read_index(self):
+        if not os.path.exists(self.index_file):
+            return pd.DataFrame(columns=_index_columns)
+        return pd.read_csv(self.index_file, dtype={'GEOID10': str, 'sim_type': str, 'file': str})
+
+
+    def _write_index(self, index):
+        temporary_file = os.path.join(self.directory, '._index.csv')
+        index[_index_columns].to_csv(temporary_file, index=False)
+        os.replace(temporary_file, self.index_file)
+
+
+    def get_part_files(self, sim_type=None, state=None):
+        # Returns the part files (relative to the store) of a sim_type and state, every one by default
+        pattern = os.path.join(self.directory, 'state=' + (state or '*'), 'sim_type=' + (sim_type or '*'), 'part-*.parquet')
+        return sorted(os.path.relpath(path, self.directory) for path in glob.glob(pattern))
+
+
+    def compact(self, small_rows=None, target_rows=_target_rows):
+        # Combines the part files of each partition with fewer than small_rows rows (default buffer_rows) into part files
+        # of up to about target_rows rows, and rewrites the index. The row groups are copied one at a time, so only one
+        # of them is in memory. The workers write to the index, so compact runs once they are done
+        # (ex. after multiprocess_simulation.py or after multinode_simulation.merge).
+        small_rows = small_rows or self.buffer_rows
+        index = self.read_index()
+        rows = index.groupby('file')['rows'].sum()
+
+        partitions = {}
+        for part_file in self.get_part_files():
+            if rows.get(part_file, 0) < small_rows:
+                partitions.setdefault(os.path.dirname(part_file), []).append(part_file)
+
+        compacted = []
+        new_index = []
+        for partition, small_files in sorted(partitions.items()):
+            if len(small_files) < 2:
+                continue
+            new_index.extend(self._copy_row_groups(partition, small_files, target_rows))
+            compacted.extend(small_files)
+
+        if not compacted:
+            return
+        index = index.loc[~index['file'].isin(compacted)]
+        self._write_index(pd.concat([index] + new_index, ignore_index=True))
+        for part_file in compacted:
+            os.remove(os.path.join(self.directory, part_file))
+        print('Compacted', len(compacted), 'part files into', len(new_index))
+
+
+    def _copy_row_groups(self, partition, part_files, target_rows, removed=None):
+        # Copies the row groups of part_files into new part files of the partition, a new file is started once one has
+        # target_rows rows (or when a part file has another schema). Returns the index of each new part file.
+        # removed (optional): (part file, GEOID10) pairs of the block groups that are left out
+        sim_type = self._get_keys(partition)[1]
+        removed = removed or set()
+        new_index = []
+        writer = None
+        try:
+            for part_file in part_files:
+                parquet_file = pq.ParquetFile(os.path.join(self.directory, part_file))
+                schema = parquet_file.schema_arrow.remove_metadata()
+                left_out = [geoid for file, geoid in removed if file == part_file]
+                for row_group in range(parquet_file.num_row_groups):
+                    table = parquet_file.read_row_group(row_group).replace_schema_metadata(None)
+                    if left_out:
+                        table = table.filter(pa.array(~table.column('GEOID10').to_pandas().isin(left_out).values))
+                    if table.num_rows == 0:
+                        continue
+
+                    if writer is not None and (written >= target_rows or not writer.schema.equals(schema)):
+                        writer.close()
+                        os.replace(temporary_file, path)
+                        writer = None
+                    if writer is None:
+                        new_file = os.path.join(partition, 'part-compact-' + uuid.uuid4().hex + '.parquet')
+                        path = os.path.join(self.directory, new_file)
+                        temporary_file = os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+                        writer = pq.ParquetWriter(temporary_file, schema)
+                        written = 0
+                        groups = 0
+                        index = []
+                        new_index.append(index)
+
+                    writer.write_table(table, row_group_size=table.num_rows)
+                    counts = table.column('GEOID10').to_pandas().value_counts(sort=False)
+                    index.extend([geoid, sim_type, new_file, groups, count] for geoid, count in counts.items())
+                    written += table.num_rows
+                    groups += 1
+        finally:
+            if writer is not None:
+                writer.close()
+                os.replace(temporary_file, path)
+        return [pd.DataFrame(index, columns=_index_columns) for index in new_index]
+
+
+    def _get_keys(self, partition):
+        # 'state=17/sim_type=ng' -> ('17', 'ng')
+        state, sim_type = partition.split(os.sep)
+        return state.split('=', 1)[1], sim_type.split('=', 1)[1]
+
+
+    def rebuild_index(self):
+        # Indexes every part file again, for part files written by a worker killed before its index rows were appended
+        index = []
+        for part_file in self.get_part_files():
+            parquet_file = pq.ParquetFile(os.path.join(self.directory, part_file))
+            for row_group in range(parquet_file.num_row_groups):
+                counts = parquet_file.read_row_group(row_group, columns=['GEOID10']).to_pandas()['GEOID10'].value_counts()
+                for geoid, count in counts.items():
+                    index.append([geoid, self._get_keys(os.path.dirname(part_file))[1], part_file, row_group, count])
+        self._write_index(pd.DataFrame(index, columns=_index_columns))
+
+
+    def iter_row_groups(self, columns=None):
+        # Yields the sim_type and results of every row group of the store (not the links), so the whole store can be
+        # aggregated without reading it into memory. Every block group of a row group is whole.
+        read_columns = None if columns is None else ['GEOID10'] + [column for column in columns if column != 'GEOID10']
+        for part_file in self.get_part_files():
+            sim_type = self._get_keys(os.path.dirname(part_file))[1]
+            parquet_file = pq.ParquetFile(os.path.join(self.directory, part_file))
+            for row_group in range(parquet_file.num_row_groups):
+                yield sim_type, parquet_file.read_row_group(row_group, columns=read_columns).to_pandas()
+
+
+    def merge(self, directories, target_rows=_target_rows):
+        # Moves the part files, index and links of other result stores (ex. each launcher's results) into this store,
+        # and deletes them. A block group and sim_type found in more than one of them (ex. a shard that was run again by
+        # another launcher after its lease expired) keeps the results of the last one, in the order of directories, and
+        # is removed from the part files of the others.
+        indexes = []
+        links = [self.read_links()]
+        for directory in directories:
+            other = ResultStore(directory)
+            renamed = {}
+            for part_file in other.get_part_files():
+                target = os.path.join(self.directory, part_file)
+                if os.path.exists(target):  # Same host and process id as a part file already in the store
+                    target = os.path.join(os.path.dirname(target), 'part-' + uuid.uuid4().hex + '.parquet')
+                    renamed[part_file] = os.path.relpath(target, self.directory)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(os.path.join(directory, part_file), target)
+            # Hidden part files were never renamed into place, the worker was killed while writing them
+
+            index = other.read_index()
+            index['file'] = index['file'].replace(renamed)
+            indexes.append(index)
+            links.append(other.read_links())
+        if not indexes:
+            return
+
+        index = pd.concat(indexes, ignore_index=True)
+        duplicated = index.duplicated(['GEOID10', 'sim_type'], keep='last')
+        if duplicated.any():
+            removed = index.loc[duplicated]
+            index = index.loc[~duplicated]
+            rewritten = list(removed['file'].unique())
+            new_index = []
+            for partition, part_files in itertools.groupby(sorted(rewritten), os.path.dirname):
+                new_index.extend(self._copy_row_groups(partition, list(part_files), target_rows, set(zip(removed['file'], removed['GEOID10']))))
+            index = pd.concat([index.loc[~index['file'].isin(rewritten)]] + new_index, ignore_index=True)
+            for part_file in rewritten:
+                os.remove(os.path.join(self.directory, part_file))
+            print('Removed', duplicated.sum(), 'results found in more than one store')
+        self._append_index(index)
+
+        links = pd.concat(links, ignore_index=True).drop_duplicates(['GEOID10', 'sim_type'], keep='last')
+        if len(links) > 0:
+            temporary_file = os.path.join(self.directory, '._links.csv')
+            links.to_csv(temporary_file, index=False)
+            os.replace(temporary_file, self.links_file)
+        for directory in directories:
+            shutil.rmtree(directory)
+
+
+    def link(self, links):
+        # links: (name, source) pairs, the results of simulation source are also the results of simulation name
+        os.makedirs(self.directory, exist_ok=True)
+        frame = pd.DataFrame([name.split('_')[:2] + [source.split('_')[0]] for name, source in links], columns=['GEOID10', 'sim_type', 'source'])
+        frame.to_csv(self.links_file, mode='a', index=False, header=not os.path.exists(self.links_file))
+
+
+    def read_links(self):
+        if not os.path.exists(self.links_file):
+            return pd.DataFrame(columns=['GEOID10', 'sim_type', 'source'])
+        return pd.read_csv(self.links_file, dtype=str)
+
+
+    def _read_results(self, sim_type=None, geoids=None, prefix=None, columns=None):
+        # Stored results of the block groups (not the links). Without geoids every part file of the partitions is read,
+        # with geoids only their row groups are read, found in the index.
+        read_columns = None if columns is None else ['GEOID10'] + [column for column in columns if column not in ('GEOID10', 'sim_type')]
+        frames = []
+        if geoids is None:
+            state = prefix[:2] if prefix is not None and len(prefix) >= 2 else None
+            for part_file in self.get_part_files(sim_type, state):
+                frame = pd.read_parquet(os.path.join(self.directory, part_file), columns=read_columns)
+                if prefix is not None:
+                    frame = frame.loc[frame['GEOID10'].str.startswith(prefix)]
+                frame.insert(1, 'sim_type', self._get_keys(os.path.dirname(part_file))[1])
+                frames.append(frame)
+        else:
+            geoids = set(geoids)
+            index = self.read_index()
+            index = index.loc[index['GEOID10'].isin(geoids)]
+            if sim_type is not None:
+                index = index.loc[index['sim_type'] == sim_type]
+            for (part_file, part_sim_type), rows in index.groupby(['file', 'sim_type']):
+                parquet_file = pq.ParquetFile(os.path.join(self.directory, part_file))
+                frame = parquet_file.read_row_groups(sorted(set(rows['row_group'])), columns=read_columns).to_pandas()
+                frame = frame.loc[frame['GEOID10'].isin(geoids)]  # Row groups hold other block groups too
+                frame.insert(1, 'sim_type', part_sim_type)
+                frames.append(frame)
+
+        if not frames:
+            return self._empty_results(read_columns)
+        return pd.concat(frames, ignore_index=True)
+
+
+    def _empty_results(self, read_columns=None):
+        # Results without rows, with the columns and types of the part files (or only the requested columns when the
+        # store has no part file yet)
+        part_files = self.get_part_files()
+        if not part_files:
+            return pd.DataFrame(columns=['GEOID10', 'sim_type'] + (read_columns or [])[1:])
+        schema = pq.read_schema(os.path.join(self.directory, part_files[0]))
+        frame = schema.empty_table().to_pandas()
+        frame = frame[read_columns or frame.columns]
+        frame.insert(1, 'sim_type', pd.Series(dtype=object))
+        return frame
+
+
+    def read(self, sim_type=None, geoids=None, columns=None, prefix=None):
+        # Returns the stored results, optionally only one sim_type, a list of GEOID10's and the GEOID10's starting with
+        # a prefix (ex. '17' for Illinois, '17031' for Cook County)
+        stored_geoids = geoids
+        if prefix is not None and geoids is None and len(prefix) > 2:
+            # A county or tract is found in the index rather than by reading the whole state
+            stored_geoids = [geoid for geoid in self.read_index()['GEOID10'].unique() if geoid.startswith(prefix)]
+        frame = self._read_results(sim_type, stored_geoids, prefix, columns)
+
+        links = self.read_links()
+        if sim_type is not None:
+            links = links.loc[links['sim_type'] == sim_type]
+        if geoids is not None:
+            links = links.loc[links['GEOID10'].isin(list(geoids))]
+        if prefix is not None:
+            links = links.loc[links['GEOID10'].str.startswith(prefix)]
+        if len(links) == 0:
+            return frame
+
+        # Results of the linked simulations, read from their source simulation
+        sources = self._read_results(sim_type, links['source'].unique(), columns=columns)
+        linked = links.merge(sources.rename(columns={'GEOID10': 'source'}), on=['source', 'sim_type']).drop(columns='source')
+        linked = linked.reindex(columns=frame.columns).astype(frame.dtypes.to_dict())
+        if len(frame) == 0:
+            return linked.reset_index(drop=True)  # Only linked block groups in the selection
+        return pd.concat([frame, linked], ignore_index=True)
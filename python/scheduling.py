@@ -0,0 +1,106 @@
+import os
+import csv
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+
+# Relative cost of one simulated day for each (sim_type, rb_type), used until runtimes have been measured.
+# Rain barrels modelled as a subcatchment route through storage and a conduit, so they are the slowest.
+_default_costs = {('ng', ''): 1.0,
+                  ('rg', ''): 1.3,
+                  ('rb', 'lid'): 1.4,
+                  ('rb', 'subcatchment'): 3.0
+                  }
+
+_history_columns = ['name', 'sim_type', 'rb_type', 'days', 'seconds']
+
+
+def get_days(start, end):
+    # Number of simulated days between two MM/DD/YYYY dates (inclusive)
+    return (datetime.strptime(end, '%m/%d/%Y') - datetime.strptime(start, '%m/%d/%Y')).days + 1
+
+
+def read_simulation_days(input_file):
+    # Reads the START_DATE and END_DATE from the [OPTIONS] section at the top of an input file
+    start = end = None
+    with open(input_file) as file:
+        for line in file:
+            if line.startswith('START_DATE'):
+                start = line.split()[1]
+            elif line.startswith('END_DATE'):
+                end = line.split()[1]
+            if start is not None and end is not None:
+                break
+    return get_days(start, end)
+
+
+def make_job(name, sim_type, rb_type, days, data):
+    # A simulation job: data is what the worker receives (an input file path, or a block group's values)
+    return {'name': name, 'sim_type': sim_type, 'rb_type': rb_type if sim_type == 'rb' else '', 'days': days, 'data': data}
+
+
+def load_history(history_file):
+    # Returns the measured runtimes, or an empty frame if nothing has been measured yet
+    if not os.path.exists(history_file):
+        return pd.DataFrame(columns=_history_columns)
+    return pd.read_csv(history_file, dtype={'name': str, 'sim_type': str, 'rb_type': str}, keep_default_na=False)
+
+
+def estimate_costs(jobs, history):
+    # INPUTS:
+    #   jobs: list of jobs from make_job
+    #   history: frame of measured runtimes from load_history
+
+    # OUTPUT:
+    #   costs: estimated seconds of every job. A block group's own past runtime is used first, then the average of its
+    #          (sim_type, rb_type), then the default relative cost scaled to the measured runtimes.
+
+    history = history.loc[history['days'].astype(float) > 0]
+    seconds_per_day = history['seconds'].astype(float) / history['days'].astype(float)
+
+    by_name = seconds_per_day.groupby(history['name']).last().to_dict()
+    by_type = seconds_per_day.groupby([history['sim_type'], history['rb_type']]).mean().to_dict()
+
+    # Converts the default relative costs to seconds, using the types that have been measured
+    scales = [value / _default_costs[key] for key, value in by_type.items() if key in _default_costs]
+    scale = float(np.median(scales)) if scales else 1.0
+
+    costs = []
+    for job in jobs:
+        key = (job['sim_type'], job['rb_type'])
+        if job['name'] in by_name:
+            rate = by_name[job['name']]
+        elif key in by_type:
+            rate = by_type[key]
+        else:
+            rate = _default_costs.get(key, max(_default_costs.values())) * scale
+        costs.append(rate * job['days'])
+    return costs
+
+
+def order_jobs(jobs, history):
+    # Longest estimated job first, so the slow simulations do not end up at the tail of the run
+    costs = estimate_costs(jobs, history)
+    order = np.argsort(costs, kind='stable')[::-1]
+    return [jobs[i] for i in order]
+
+
+class RuntimeRecorder:
+    # Appends measured runtimes to the history file as the jobs finish
+    def __init__(self, history_file):
+        directory = os.path.dirname(history_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        new_file = not os.path.exists(history_file)
+        self.file = open(history_file, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(_history_columns)
+
+    def record(self, job, seconds):
+        self.writer.writerow([job['name'], job['sim_type'], job['rb_type'], job['days'], round(seconds, 3)])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import shutil
+import threading
+
+
+class ShardDirectory:
+    # Job manifest split in shards on a shared (POSIX) filesystem, so launchers on any number of hosts can share a
+    # campaign without a broker. A shard is claimed by renaming its file, which only one launcher can do:
+    #   <directory>/ready/shard-00000.json                      not claimed yet
+    #   <directory>/claimed/shard-00000.json@<launcher>         being run, the launcher touches it while it runs
+    #   <directory>/done/shard-00000.json                       finished
+    # A claimed shard that has not been touched for lease_seconds (its launcher died) is moved back to ready.
+
+    def __init__(self, directory, lease_seconds=1800):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.ready = os.path.join(directory, 'ready')
+        self.claimed = os.path.join(directory, 'claimed')
+        self.done = os.path.join(directory, 'done')
+
+
+    def exists(self):
+        return os.path.isdir(self.directory)
+
+
+    def create(self, jobs, shard_size):
+        # Writes the manifest in a temporary folder that is renamed into place, so launchers started at the same time
+        # do not create it twice. Returns True if this launcher's manifest was used.
+        temporary = self.directory.rstrip('/') + '.tmp-' + str(os.getpid())
+        for folder in ['ready', 'claimed', 'done']:
+            os.makedirs(os.path.join(temporary, folder), exist_ok=True)
+        for number, start in enumerate(range(0, len(jobs), shard_size)):
+            with open(os.path.join(temporary, 'ready', 'shard-%05d.json' % number), 'w') as file:
+                json.dump(jobs[start:start + shard_size], file)
+
+        try:
+            os.rename(temporary, self.directory)
+            return True
+        except OSError:
+            shutil.rmtree(temporary)  # Another launcher created the manifest first
+            return False
+
+
+    def claim(self, launcher):
+        # Returns (claimed file, jobs) of a shard claimed by the launcher, or None if no shard is ready
+        for shard in sorted(os.listdir(self.ready)):
+            ready_file = os.path.join(self.ready, shard)
+            claimed_file = os.path.join(self.claimed, shard + '@' + launcher)
+            try:
+                # The claim starts now: touched before the rename, so another launcher never sees it as expired
+                os.utime(ready_file)
+                os.rename(ready_file, claimed_file)
+                with open(claimed_file) as file:
+                    return claimed_file, json.load(file)
+            except FileNotFoundError:
+                continue  # Claimed by another launcher, or reclaimed from this one
+        return None
+
+
+    def finish(self, claimed_file):
+        try:
+            os.rename(claimed_file, os.path.join(self.done, get_shard(claimed_file)))
+        except FileNotFoundError:
+            pass  # The lease expired and the shard was reclaimed, it is run again by another launcher
+
+
+    def release(self, claimed_file):
+        os.rename(claimed_file, os.path.join(self.ready, get_shard(claimed_file)))
+
+
+    def reclaim_expired(self):
+        # Moves the shards whose launcher stopped touching them back to ready, returns the number of shards moved
+        count = 0
+        for claim in os.listdir(self.claimed):
+            claimed_file = os.path.join(self.claimed, claim)
+            try:
+                if time.time() - os.path.getmtime(claimed_file) > self.lease_seconds:
+                    self.release(claimed_file)
+                    count += 1
+            except FileNotFoundError:
+                pass  # Finished, or reclaimed by another launcher
+        return count
+
+
+    def counts(self):
+        return {folder: len(os.listdir(os.path.join(self.directory, folder))) for folder in ['ready', 'claimed', 'done']}
+
+
+def get_shard(claimed_file):
+    return os.path.basename(claimed_file).split('@')[0]
+
+
+class Heartbeat:
+    # Touches a claimed shard every interval seconds while its jobs run, so other launchers do not reclaim it
+    #   with Heartbeat(claimed_file, interval):
+    #       ...
+    # or heartbeat.start() and heartbeat.stop() when the shard's jobs run along with other shards'
+    def __init__(self, claimed_file, interval):
+        self.claimed_file = claimed_file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.claimed_file)
+            except FileNotFoundError:
+                return  # Reclaimed by another launcher
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,216 @@
+import os
+import csv
+import sys
+import time
+import shutil
+import tempfile
+import itertools
+import pandas as pd
+from functools import lru_cache
+from multiprocessing import Pool
+from pyswmm import Simulation, SystemStats
+from InputFileTemplate import InputFileTemplate
+from InputFile import get_seconds
+from extraction import extract_variables
+from concurrency import get_cpu_count
+
+
+# Chooses the REPORT_STEP, WET_STEP, DRY_STEP and ROUTING_STEP of the input files. A stratified sample of block groups
+# is simulated with every candidate setting and with a fine-step reference, in parallel. For each candidate the
+# runtime is measured, along with how far the runoff, infiltration and evaporation totals (from SWMM's statistics)
+# and the extracted runoff and evaporation + infiltration totals (from the .out file) are from the reference.
+# The cheapest candidate whose deviations all stay within the tolerance is recommended for each sim_type.
+#   python step_tuning.py 0.01           Simulate the sample and recommend settings within 1% of the reference
+#   python step_tuning.py analyze 0.02   Recommend settings from the existing results with another tolerance
+# Each result is appended to results_file as it arrives, so analyze works on a partial run, and running the tuning
+# again only runs the simulations that have no result yet. Failed simulations get a row with status 'error'.
+
+
+characteristics_file = '../data/input_file_data/Selected_BG_inputs_20191212.csv'
+results_file = '../logs/step_tuning.csv'
+
+_sim_types = ('ng', 'rg', 'rb')
+_rb_type = 'subcatchment'
+
+# Simulation window of the sample, shorter than the campaign's so every candidate can be run
+_start = '01/01/2014'
+_end = '12/31/2014'
+
+# Default relative tolerance of the deviations from the reference
+_tolerance = 0.01
+
+# The sample is stratified by quantile bins of these columns, with _samples_per_stratum block groups per stratum
+_strata = {'PCT_I_adj_30m': 4, 'Keff_adj_BG_30m': 4}
+_samples_per_stratum = 2
+_seed = 0
+
+# Fine-step reference, and the candidate steps (HH:MM:SS). Candidates with a dry or report step shorter than their wet
+# step are skipped. ROUTING_STEP only matters for the input files that do not IGNORE_ROUTING.
+_reference = {'report_step': '01:00:00', 'wet_step': '00:01:00', 'dry_step': '00:01:00', 'routing_step': '00:00:30'}
+_report_steps = ['01:00:00', '03:00:00', '06:00:00', '12:00:00', '24:00:00']
+_wet_steps = ['00:01:00', '00:06:00', '00:15:00', '00:30:00', '01:00:00']
+_dry_steps = ['00:06:00', '01:00:00', '06:00:00']
+_routing_steps = ['00:01:00']
+
+_step_columns = ['report_step', 'wet_step', 'dry_step', 'routing_step']
+_total_columns = ['runoff', 'infiltration', 'evaporation', 'extracted_runoff', 'extracted_evaporation_infiltration']
+_result_columns = ['GEOID10', 'sim_type', 'candidate'] + _step_columns + ['seconds'] + _total_columns + ['status', 'error']
+
+
+def get_candidates():
+    # Returns the reference followed by every candidate, as dictionaries of steps
+    candidates = [dict(_reference)]
+    for report_step, wet_step, dry_step, routing_step in itertools.product(_report_steps, _wet_steps, _dry_steps, _routing_steps):
+        wet_seconds = get_seconds(wet_step)
+        if get_seconds(dry_step) < wet_seconds or get_seconds(report_step) < wet_seconds:
+            continue
+        candidate = {'report_step': report_step, 'wet_step': wet_step, 'dry_step': dry_step, 'routing_step': routing_step}
+        if candidate != _reference:
+            candidates.append(candidate)
+    return candidates
+
+
+def sample_block_groups(frame, samples_per_stratum=_samples_per_stratum, seed=_seed):
+    # Returns samples_per_stratum block groups (or every block group of a smaller stratum) from each stratum of _strata
+    bins = []
+    for column, count in _strata.items():
+        ranks = pd.to_numeric(frame[column], errors='coerce').rank(method='first')
+        bins.append(pd.qcut(ranks, count, labels=False).rename(column + '_bin'))
+    groups = frame.groupby(bins, group_keys=False)
+    return groups.apply(lambda group: group.sample(min(len(group), samples_per_stratum), random_state=seed))
+
+
+@lru_cache(maxsize=None)
+def get_template(sim_type, steps):
+    # Each worker compiles a template once per sim_type and candidate, steps is a tuple of (name, step) pairs
+    return InputFileTemplate(sim_type, _rb_type, _start, _end, dict(steps))
+
+
+def run_candidate(item):
+    # Runs one block group with one candidate setting, returns its runtime and totals, or its error
+    values, fields, sim_type, candidate_id, steps = item
+    key = [values[fields.index('GEOID10')], sim_type, candidate_id] + [steps[column] for column in _step_columns]
+    try:
+        seconds, totals = simulate_candidate(values, fields, sim_type, steps)
+    except Exception as error:
+        return key + [None] * (1 + len(_total_columns)) + ['error', repr(error)]
+    return key + [seconds] + totals + ['ok', '']
+
+
+def simulate_candidate(values, fields, sim_type, steps):
+    template = get_template(sim_type, tuple(sorted(steps.items())))
+    scratch = tempfile.mkdtemp()
+    try:
+        input_file = template.write_values([values[fields.index(field)] for field in template.fields], scratch)
+        start = time.time()
+        with Simulation(input_file) as sim:
+            sim.step_advance(int((sim.end_time - sim.start_time).total_seconds()) + 1)
+            for _ in sim:
+                pass
+            statistics = SystemStats(sim).runoff_stats
+        seconds = time.time() - start
+
+        # The extracted series are rates sampled every report step, so their totals are scaled by the report step
+        frame = extract_variables(input_file[:-4] + '.out', daily=False)
+        report_seconds = get_seconds(steps['report_step'])
+        totals = [statistics['runoff'], statistics['infiltration'], statistics['evaporation'],
+                  frame['runoff'].sum() * report_seconds, frame['evaporation_infiltration'].sum() * report_seconds]
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return seconds, totals
+
+
+def read_results():
+    if not os.path.exists(results_file):
+        return pd.DataFrame(columns=_result_columns)
+    results = pd.read_csv(results_file, dtype={'GEOID10': str, 'sim_type': str, 'error': str})
+    if 'status' not in results.columns:  # Written before failed simulations were recorded
+        results['status'] = 'ok'
+    return results
+
+
+def run_tuning(sample):
+    # Simulates every block group of the sample with every candidate, for every sim_type, appending each result to
+    # results_file. The simulations that already have a result are skipped. Returns every result.
+    candidates = get_candidates()
+    fields = list(sample.columns)
+    finished = set(read_results()[['GEOID10', 'sim_type', 'candidate']].itertuples(index=False, name=None))
+    items = [(values, fields, sim_type, candidate_id, steps)
+             for values in sample.itertuples(index=False, name=None)
+             for sim_type in _sim_types
+             for candidate_id, steps in enumerate(candidates)
+             if (values[fields.index('GEOID10')], sim_type, candidate_id) not in finished]
+    print('Simulations:', len(items), '(' + str(len(sample)), 'block groups,', len(_sim_types), 'sim_types,',
+          len(candidates), 'settings,', len(finished), 'already run)')
+
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a', newline='') as file, Pool(get_cpu_count()) as pool:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(_result_columns)
+        for row in pool.imap_unordered(run_candidate, items):
+            writer.writerow(row)
+            file.flush()
+    return read_results()
+
+
+def get_deviations(results):
+    # Relative deviation of every total from the reference (candidate 0) of the same block group and sim_type.
+    # Totals whose reference is 0 have no relative deviation (NaN). Failed simulations are left out.
+    results = results.loc[results['status'] == 'ok']
+    keys = ['GEOID10', 'sim_type']
+    reference = results.loc[results['candidate'] == 0, keys + _total_columns]
+    merged = results.merge(reference, on=keys, suffixes=('', '_reference'))
+    for column in _total_columns:
+        reference_total = merged[column + '_reference'].abs().where(lambda total: total > 0)
+        merged[column + '_deviation'] = (merged[column] - merged[column + '_reference']).abs() / reference_total
+    return merged
+
+
+def recommend(results, tolerance=_tolerance):
+    # OUTPUT:
+    #   summary: one row per sim_type and candidate with its mean runtime, its largest deviation over the sample and
+    #            whether it is within the tolerance, cheapest first
+    #   recommended: the cheapest candidate within the tolerance of each sim_type
+
+    deviations = get_deviations(results)
+    deviation_columns = [column + '_deviation' for column in _total_columns]
+    deviations['max_deviation'] = deviations[deviation_columns].max(axis=1)
+
+    summary = deviations.groupby(['sim_type', 'candidate'] + _step_columns).agg(
+        seconds=('seconds', 'mean'), max_deviation=('max_deviation', 'max'), samples=('GEOID10', 'count')).reset_index()
+    # A setting that failed for a block group of the sample is never recommended
+    failures = results.loc[results['status'] != 'ok'].groupby(['sim_type', 'candidate']).size().rename('failures')
+    summary = summary.join(failures, on=['sim_type', 'candidate'])
+    summary['failures'] = summary['failures'].fillna(0).astype(int)
+    summary['within_tolerance'] = (summary['max_deviation'].fillna(0) <= tolerance) & (summary['failures'] == 0)
+    summary = summary.sort_values(['sim_type', 'seconds'])
+
+    reference_seconds = summary.loc[summary['candidate'] == 0].set_index('sim_type')['seconds']
+    summary['speedup'] = summary['sim_type'].map(reference_seconds) / summary['seconds']
+    recommended = summary.loc[summary['within_tolerance']].groupby('sim_type').head(1)
+    return summary, recommended
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'analyze':
+        tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else _tolerance
+        results = read_results()
+    else:
+        tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else _tolerance
+        characteristics_frame = pd.read_csv(characteristics_file, skip_blank_lines=True, low_memory=False, dtype=str)
+        results = run_tuning(sample_block_groups(characteristics_frame))
+        print('Results:', results_file)
+    failed = results.loc[results['status'] != 'ok']
+    if len(failed) > 0:
+        print(len(failed), 'simulations failed, see the error column of', results_file)
+
+    summary, recommended = recommend(results, tolerance)
+    print('Cheapest settings within', tolerance, 'of the reference:')
+    print(recommended[['sim_type'] + _step_columns + ['seconds', 'speedup', 'max_deviation']].to_string(index=False))
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from pyswmm import Simulation, Subcatchments, SystemStats
+from hotstart import get_name, save_hotstart
+
+
+# Subcatchments whose totals are accumulated, when they exist in the input file (Subcatch4 is the rain barrel roof)
+subcatchment_names = ['Subcatch1', 'Subcatch4']
+
+# Cumulative subcatchment statistics (precipitation is a depth in inches, the others are volumes in cubic feet)
+_subcatchment_statistics = ['precipitation', 'runoff', 'evaporation', 'infiltration']
+
+# Number of simulated seconds between each read of the cumulative statistics (day boundaries are also month boundaries)
+_stride = 86400
+
+
+def get_columns(subcatchments):
+    columns = ['rainfall', 'runoff', 'evaporation_infiltration', 'outfall_flow']
+    for name in subcatchments:
+        columns.extend([name.lower() + '_' + statistic for statistic in _subcatchment_statistics])
+    return columns
+
+
+def read_statistics(system, subcatchment_objects, current):
+    # Reads the cumulative statistics into current, in the order of get_columns
+    runoff_statistics = system.runoff_stats
+    current[0] = runoff_statistics['rainfall']
+    current[1] = runoff_statistics['runoff']
+    current[2] = runoff_statistics['evaporation'] + runoff_statistics['infiltration']
+    current[3] = system.routing_stats['outflow']
+
+    i = 4
+    for subcatchment in subcatchment_objects:
+        statistics = subcatchment.statistics
+        for statistic in _subcatchment_statistics:
+            current[i] = statistics[statistic]
+            i += 1
+
+
+def run_streaming(input_file, frequency='D', subcatchments=None, use_hotstart=None, hotstart_directory=None):
+    # INPUTS:
+    #   input_file: path to the .inp file
+    #   frequency (optional): 'D' for daily totals, 'M' for monthly totals (default D)
+    #   subcatchments (optional): subcatchments to accumulate (default subcatchment_names, missing ones are skipped)
+    #   use_hotstart (optional): hotstart file to start the simulation from (default None, a cold start)
+    #   hotstart_directory (optional): folder to save the state at the end of the simulation in (see hotstart.py)
+
+    # OUTPUT:
+    #   frame: one row per day (or month) of the simulation. System rainfall, runoff and evaporation + infiltration are
+    #          depths (inches) over the whole area, outfall_flow is the routed outflow volume, and each subcatchment has
+    #          its precipitation depth and runoff, evaporation and infiltration volumes.
+    #
+    # The simulation is stepped a day at a time and SWMM's cumulative statistics are read at the end of each step, so
+    # the totals do not depend on REPORT_STEP and nothing is read back from the .out file.
+
+    if subcatchments is None:
+        subcatchments = subcatchment_names
+
+    with Simulation(input_file) as sim:
+        if use_hotstart is not None:
+            sim.use_hotstart(use_hotstart)
+        available = [subcatchment.subcatchmentid for subcatchment in Subcatchments(sim)]
+        subcatchments = [name for name in subcatchments if name in available]
+        system = SystemStats(sim)
+        subcatchment_objects = [Subcatchments(sim)[name] for name in subcatchments]
+
+        periods = pd.period_range(sim.start_time, sim.end_time, freq=frequency)
+        columns = get_columns(subcatchments)
+        totals = np.zeros((len(periods), len(columns)))  # Preallocated, one row per period
+        previous = np.zeros(len(columns))
+        current = np.empty(len(columns))
+
+        sim.step_advance(_stride)
+        for _ in sim:
+            read_statistics(system, subcatchment_objects, current)
+
+            # The step ends on the period boundary, so its totals belong to the period ending at the current time
+            period = pd.Period(sim.current_time - timedelta(seconds=1), freq=frequency)
+            totals[period.ordinal - periods[0].ordinal] += current - previous
+            previous[:] = current
+
+        # The last step ends with the simulation, after the loop has stopped
+        read_statistics(system, subcatchment_objects, current)
+        totals[-1] += current - previous
+
+        if hotstart_directory is not None:
+            save_hotstart(sim, hotstart_directory, get_name(input_file))
+
+    return pd.DataFrame(totals, index=periods.to_timestamp().rename('date'), columns=columns)
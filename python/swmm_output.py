@@ -0,0 +1,172 @@
+import mmap
+import struct
+import numpy as np
+import pandas as pd
+
+
+# Reporting variables of the SWMM 5 binary output file, in the order they are written for each object type.
+# Pollutant concentrations follow the subcatchment, node and link variables.
+subcatchment_variables = ['Rainfall', 'Snow_depth', 'Evaporation_loss', 'Infiltration_loss', 'Runoff_rate', 'Groundwater_outflow',
+                          'Groundwater_elevation', 'Soil_moisture']
+node_variables = ['Depth_above_invert', 'Hydraulic_head', 'Volume_stored_ponded', 'Lateral_inflow', 'Total_inflow', 'Flow_lost_flooding']
+link_variables = ['Flow_rate', 'Flow_depth', 'Flow_velocity', 'Froude_number', 'Capacity']
+system_variables = ['Air_temperature', 'Rainfall', 'Snow_depth', 'Evaporation_infiltration', 'Runoff', 'Dry_weather_inflow',
+                    'Groundwater_inflow', 'RDII_inflow', 'User_direct_inflow', 'Total_lateral_inflow', 'Flow_lost_to_flooding',
+                    'Flow_leaving_outfalls', 'Volume_stored_water', 'Evaporation_rate', 'Potential_PET']
+
+_magic_number = 516114522
+_swmm_epoch = pd.Timestamp('1899-12-30')  # SWMM dates are decimal days since 12/30/1899
+
+
+class SwmmOutput:
+    # Memory mapped reader of a SWMM 5 binary output (.out) file.
+    # The header and catalog are parsed once when the file is opened. Every variable is returned as a NumPy view
+    # into the mapped file (no copy), and time ranges are sliced by computing the reporting period offsets.
+    #
+    #   with SwmmOutput('./170319800001_ng.out') as output:
+    #       rainfall = output.get('system', '', 'Rainfall')
+    #       runoff = output.get('subcatchment', 'Subcatch1', 'Runoff_rate', start='2014-01-01', end='2014-12-31')
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self._file = open(output_file, 'rb')
+        self.buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, self.flow_units, n_subcatchments, n_nodes, n_links, n_pollutants = struct.unpack_from('<7i', self.buffer, 0)
+        id_position, property_position, self._results_position, self.periods, self.error_code, closing_magic = struct.unpack_from('<6i', self.buffer, len(self.buffer) - 24)
+        assert magic == _magic_number and closing_magic == _magic_number, 'Not a complete SWMM binary output file: ' + output_file
+
+        # Object names
+        position = id_position
+        names = []
+        for _ in range(n_subcatchments + n_nodes + n_links + n_pollutants):
+            length = struct.unpack_from('<i', self.buffer, position)[0]
+            names.append(self.buffer[position + 4:position + 4 + length].decode())
+            position += 4 + length
+        self.subcatchments = names[:n_subcatchments]
+        self.nodes = names[n_subcatchments:n_subcatchments + n_nodes]
+        self.links = names[n_subcatchments + n_nodes:n_subcatchments + n_nodes + n_links]
+        self.pollutants = names[n_subcatchments + n_nodes + n_links:]
+
+        # Skip the object properties (a count, the property codes, then the values of every object)
+        position = property_position
+        for count in [n_subcatchments, n_nodes, n_links]:
+            n_properties = struct.unpack_from('<i', self.buffer, position)[0]
+            position += 4 * (1 + n_properties + n_properties * count)
+
+        # Number of reporting variables of each object type (followed by their codes)
+        n_variables = []
+        for _ in range(4):
+            n = struct.unpack_from('<i', self.buffer, position)[0]
+            n_variables.append(n)
+            position += 4 * (1 + n)
+        self.report_start = _swmm_epoch + pd.to_timedelta(struct.unpack_from('<d', self.buffer, position)[0], unit='D')
+        self.report_step = pd.Timedelta(seconds=struct.unpack_from('<i', self.buffer, position + 8)[0])
+
+        self.variables = {'subcatchment': (subcatchment_variables + self.pollutants)[:n_variables[0]],
+                          'node': (node_variables + self.pollutants)[:n_variables[1]],
+                          'link': (link_variables + self.pollutants)[:n_variables[2]],
+                          'system': system_variables[:n_variables[3]]
+                          }
+        self._objects = {'subcatchment': self.subcatchments, 'node': self.nodes, 'link': self.links, 'system': ['']}
+
+        # Each reporting period is a double (date) followed by 4 byte floats, so the results are viewed in 4 byte slots
+        self._offsets = {}
+        offset = 2  # The date takes the first two slots
+        for object_type, count in [('subcatchment', n_subcatchments), ('node', n_nodes), ('link', n_links), ('system', 1)]:
+            self._offsets[object_type] = offset
+            offset += count * len(self.variables[object_type])
+        self._period_slots = offset
+        self.results = np.ndarray((self.periods, self._period_slots), dtype='<f4', buffer=self.buffer, offset=self._results_position)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        self.results = None  # Views must be released before the map is closed
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass  # Views of the file are still in use, the map is closed when they are released
+        self._file.close()
+
+
+    def get_period(self, time):
+        # Index of the first reporting period at or after the given time
+        period = int(np.ceil((pd.Timestamp(time) - self.report_start) / self.report_step)) - 1
+        return min(max(period, 0), self.periods)
+
+
+    def get_periods(self, start=None, end=None):
+        # Slice of the reporting periods between start and end (inclusive), computed from the report step
+        first = 0 if start is None else self.get_period(start)
+        if end is None:
+            return slice(first, self.periods)
+        # Period i is reported at report_start + (i + 1) * report_step, so the periods up to end are the first stop
+        stop = int(np.floor((pd.Timestamp(end) - self.report_start) / self.report_step))
+        return slice(first, min(max(stop, first), self.periods))
+
+
+    def get_times(self, start=None, end=None):
+        periods = self.get_periods(start, end)
+        return self.report_start + self.report_step * np.arange(periods.start + 1, periods.stop + 1)
+
+
+    def get_column(self, object_type, name, variable):
+        # Column of the variable in self.results
+        objects = self._objects[object_type]
+        variables = self.variables[object_type]
+        assert name in objects, 'Unknown ' + object_type + ': ' + name
+        assert variable in variables, 'Unknown ' + object_type + ' variable: ' + variable
+        return self._offsets[object_type] + objects.index(name) * len(variables) + variables.index(variable)
+
+
+    def get(self, object_type, name, variable, start=None, end=None):
+        # INPUTS:
+        #   object_type: 'subcatchment', 'node', 'link' or 'system'
+        #   name: name of the subcatchment, node or link ('' or the variable name for system variables)
+        #   variable: ex. 'Runoff_rate', 'Total_inflow', 'Rainfall'
+        #   start, end (optional): time range to return (inclusive)
+
+        # OUTPUT:
+        #   values: float32 NumPy view of the variable's values in the mapped file (no copy)
+
+        if object_type == 'system':
+            name = ''
+        return self.results[self.get_periods(start, end), self.get_column(object_type, name, variable)]
+
+
+    def catalog(self):
+        # Every (type, name, variable) in the file, in the same form as swmmtoolbox.catalog
+        entries = []
+        for object_type in ['subcatchment', 'node', 'link']:
+            for name in self._objects[object_type]:
+                entries.extend([[object_type, name, variable] for variable in self.variables[object_type]])
+        entries.extend([['system', variable, variable] for variable in self.variables['system']])
+        return entries
+
+
+    def extract(self, *labels, start=None, end=None):
+        # Returns a dataframe of the labelled variables, labels are 'type,name,variable' strings or [type, name, variable] lists,
+        # in the same form (and with the same column names) as swmmtoolbox.extract
+        data = {}
+        for label in labels:
+            if isinstance(label, str):
+                label = label.split(',')
+            object_type, name, variable = label
+            if object_type == 'system':
+                name = ''
+            data[object_type + '_' + name + '_' + variable] = self.get(object_type, name, variable, start, end)
+        return pd.DataFrame(data, index=self.get_times(start, end))
+
+
+def extract(output_file, *labels, start=None, end=None):
+    # Drop-in replacement for swmmtoolbox.extract
+    with SwmmOutput(output_file) as output:
+        return output.extract(*labels, start=start, end=end).astype(np.float64)
@@ -0,0 +1,147 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import rasterio
+import shapely
+from scipy import sparse
+from functools import lru_cache
+from zonal_statistics import read_shape_file, get_polygon_pixels, weighted_means
+
+
+# Folder holding the cached polygon x pixel weight matrices
+_cache_dir = '../data/weight_matrices/'
+
+
+def hash_shape_file(shape_file):
+    # Hash of the shape file and its sidecar files (.shx, .dbf, .prj, ...), so editing any of them invalidates the cache.
+    # It is computed once per process for each version (modification time and size) of the files.
+    stem = os.path.splitext(shape_file)[0]
+    files = sorted(set([shape_file] + glob.glob(stem + '.*')))
+    versions = []
+    for file in files:
+        stat = os.stat(file)
+        versions.append((os.path.abspath(file), stat.st_mtime_ns, stat.st_size))
+    return _hash_files(tuple(versions))
+
+
+@lru_cache(maxsize=None)
+def _hash_files(versions):
+    sha = hashlib.sha1()
+    for file, _, _ in versions:
+        sha.update(os.path.basename(file).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def get_cache_key(shape_file, raster_file, proj4, all_touched, area_fraction):
+    # The key is made from the shape file's contents, the raster grid (size, transform, CRS) and the variant
+    with rasterio.open(raster_file) as raster:
+        grid = (raster.width, raster.height, tuple(raster.transform)[:6], raster.crs.to_wkt() if raster.crs else '')
+
+    sha = hashlib.sha1()
+    sha.update(hash_shape_file(shape_file).encode())
+    sha.update(repr((grid, proj4, bool(all_touched), bool(area_fraction))).encode())
+    return sha.hexdigest()
+
+
+def get_area_fractions(geometry, pixels, transform, width):
+    # Fraction of each pixel's area covered by the polygon
+    rows, cols = np.divmod(pixels, width)
+    left, top = transform * (cols, rows)
+    right, bottom = transform * (cols + 1, rows + 1)
+    boxes = shapely.box(np.minimum(left, right), np.minimum(top, bottom), np.maximum(left, right), np.maximum(top, bottom))
+    return shapely.area(shapely.intersection(boxes, geometry)) / abs(transform.a * transform.e)
+
+
+def build_weight_matrix(geometries, transform, shape, all_touched=True, area_fraction=False):
+    # INPUTS:
+    #   geometries: list of shapely polygons, in the raster's CRS
+    #   transform: affine transform of the raster grid
+    #   shape: (height, width) of the raster grid
+    #   all_touched (optional): include every pixel touched by a polygon, otherwise only pixels whose centre is inside (default True)
+    #   area_fraction (optional): weight each pixel by the fraction of its area inside the polygon instead of 1 (default False)
+
+    # OUTPUT:
+    #   matrix: sparse (polygons x pixels) float32 matrix, pixels are indexed row * width + col
+
+    # Area fractions are calculated for every touched pixel, pixels with no overlap are dropped below
+    pixels, offsets = get_polygon_pixels(geometries, transform, shape, all_touched or area_fraction)
+    weights = np.ones(len(pixels), dtype=np.float32)
+
+    if area_fraction:
+        for i, geometry in enumerate(geometries):
+            section = slice(offsets[i], offsets[i + 1])
+            weights[section] = get_area_fractions(geometry, pixels[section], transform, shape[1])
+
+    matrix = sparse.csr_matrix((weights, pixels, offsets), shape=(len(geometries), shape[0] * shape[1]))
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def get_weight_matrix(shape_file, raster_file, all_touched=True, area_fraction=False, proj4=None, id_column='GEOID10', cache_dir=_cache_dir):
+    # INPUTS:
+    #   shape_file: path to the shape file (or GeoPackage) of the block groups or counties
+    #   raster_file: any raster on the grid the matrix is used with (only its size, transform and CRS are read)
+    #   all_touched, area_fraction (optional): see build_weight_matrix
+    #   proj4 (optional): PROJ.4 string the shapes are projected to before rasterizing (default is the raster's CRS)
+    #   id_column (optional): attribute identifying each polygon, None to use the row number (default GEOID10)
+    #   cache_dir (optional): folder holding the cached matrices
+
+    # OUTPUT:
+    #   matrix: sparse (polygons x pixels) float32 weight matrix, loaded from the cache when it has already been built
+    #   ids: id_column value of each row of the matrix
+
+    key = get_cache_key(shape_file, raster_file, proj4, all_touched, area_fraction)
+    cache_file = os.path.join(cache_dir, key + '_' + str(id_column) + '.npz')
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            matrix = sparse.csr_matrix((cached['data'].astype(np.float32), cached['indices'], cached['indptr']), shape=tuple(cached['shape']))
+            return matrix, cached['ids']
+
+    with rasterio.open(raster_file) as raster:
+        transform = raster.transform
+        shape = (raster.height, raster.width)
+        crs = raster.crs
+
+    shape_frame = read_shape_file(shape_file)
+    if proj4 is not None:
+        shape_frame = shape_frame.to_crs(proj4)
+    elif crs is not None and shape_frame.crs is not None:
+        shape_frame = shape_frame.to_crs(crs)
+
+    matrix = build_weight_matrix(list(shape_frame.geometry), transform, shape, all_touched, area_fraction)
+    if id_column is None:
+        ids = np.arange(len(shape_frame))
+    else:
+        ids = shape_frame[id_column].astype(str).to_numpy().astype('U')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_file = cache_file + '.' + str(os.getpid()) + '.npz'  # Write then rename, so other processes never read a partial file
+    np.savez(temporary_file, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape), ids=ids)
+    os.replace(temporary_file, cache_file)
+    return matrix, ids
+
+
+def zonal_stats(matrix, band):
+    # Preconditions: A weight matrix and a (height, width) band with NaN nodata have been passed
+    # Postconditions: A dictionary of count, min, max and mean arrays (one value per polygon) has been returned,
+    #                 the same statistics as rasterstats.zonal_stats(stats=['count', 'min', 'max', 'mean'])
+    values = np.asarray(band, dtype=np.float64).ravel()
+    polygon_values = np.append(values[matrix.indices], np.nan)  # Every polygon's pixel values, padded so every start index is valid
+    starts = matrix.indptr[:-1]
+    empty = np.diff(matrix.indptr) == 0
+
+    count = np.add.reduceat(~np.isnan(polygon_values), starts)
+    minimum = np.fmin.reduceat(polygon_values, starts)  # fmin and fmax ignore NaN
+    maximum = np.fmax.reduceat(polygon_values, starts)
+
+    # reduceat returns the value at the start index for polygons without pixels
+    count = np.where(empty, 0, count).astype(np.int64)
+    minimum = np.where(empty, np.nan, minimum)
+    maximum = np.where(empty, np.nan, maximum)
+
+    return {'count': count, 'min': minimum, 'max': maximum, 'mean': weighted_means(matrix, values)}
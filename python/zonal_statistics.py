@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio import features, windows
+from rasterio.transform import rowcol
+from functools import lru_cache
+
+
+@lru_cache(maxsize=2)
+def read_shape_file(shape_file):
+    # The block group GeoPackage is only read once per process
+    return gpd.read_file(shape_file)
+
+
+def get_band_name(geotiff):
+    # Masked GeoTIFFs are named by their band number (ex. ./daily/masked_geotiffs/1.geotiff)
+    return int(os.path.basename(geotiff).split('.')[0])
+
+
+def sort_geotiffs(geotiffs):
+    # Sort smallest to largest (1, 2, 3, ..., 365)
+    return sorted(geotiffs, key=get_band_name)
+
+
+def read_band_stack(geotiffs):
+    # INPUTS:
+    #   geotiffs: list of single band GeoTIFFs on the same grid (ex. one masked NARR GeoTIFF per day)
+
+    # OUTPUT:
+    #   stack: (bands, height, width) float32 array, nodata pixels are NaN
+    #   transform: affine transform of the grid
+
+    with rasterio.open(geotiffs[0]) as raster:
+        height, width = raster.height, raster.width
+        transform = raster.transform
+
+    stack = np.empty((len(geotiffs), height, width), dtype=np.float32)  # Preallocated, each band is read into its slice
+    for i, geotiff in enumerate(geotiffs):
+        with rasterio.open(geotiff) as raster:
+            raster.read(1, out=stack[i])
+            stack[i][raster.read_masks(1) == 0] = np.nan  # Same pixels as read(masked=True)
+    return stack, transform
+
+
+@lru_cache(maxsize=1)  # A year of hourly bands is large, only the last stack read is kept
+def _read_cached_band_stack(geotiffs):
+    return read_band_stack(list(geotiffs))
+
+
+def get_pixel_window(geometry, transform, shape):
+    # Returns the (row_start, row_stop, col_start, col_stop) of the pixels under the geometry's bounding box
+    minx, miny, maxx, maxy = geometry.bounds
+    rows, cols = rowcol(transform, [minx, maxx], [maxy, miny])
+    row_start, row_stop = max(min(rows), 0), min(max(rows) + 1, shape[0])
+    col_start, col_stop = max(min(cols), 0), min(max(cols) + 1, shape[1])
+    return row_start, row_stop, col_start, col_stop
+
+
+def get_polygon_pixels(geometries, transform, shape, all_touched=True):
+    # INPUTS:
+    #   geometries: list of shapely polygons, in the raster's CRS
+    #   transform: affine transform of the raster grid
+    #   shape: (height, width) of the raster grid
+    #   all_touched (optional): include every pixel touched by the polygon, same as rasterstats (default True)
+
+    # OUTPUT:
+    #   pixels: flat pixel indices of every polygon, one polygon after another
+    #   offsets: polygon i's pixels are pixels[offsets[i]:offsets[i + 1]]
+
+    pixels = []
+    offsets = [0]
+    for geometry in geometries:
+        row_start, row_stop, col_start, col_stop = get_pixel_window(geometry, transform, shape)
+
+        if row_stop <= row_start or col_stop <= col_start:  # The polygon is outside of the raster
+            offsets.append(offsets[-1])
+            continue
+
+        window = windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+        mask = features.geometry_mask([geometry], out_shape=(window.height, window.width), transform=windows.transform(window, transform),
+                                      all_touched=all_touched, invert=True)  # Only rasterize the polygon's bounding box
+        rows, cols = np.nonzero(mask)
+        pixels.append((rows + row_start) * shape[1] + (cols + col_start))
+        offsets.append(offsets[-1] + len(rows))
+
+    pixels = np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64)
+    return pixels, np.array(offsets, dtype=np.int64)
+
+
+def zonal_means(stack, pixels, offsets):
+    # Preconditions: A band stack and the pixels of each polygon (from get_polygon_pixels) have been passed
+    # Postconditions: A (polygons, bands) array of each polygon's mean has been returned, ignoring nodata (NaN) pixels.
+    #                 Every polygon and band is reduced at once with cumulative sums over the polygons' pixels.
+    values = stack.reshape(len(stack), -1)[:, pixels]
+    valid = ~np.isnan(values)
+
+    sums = np.zeros((len(stack), len(pixels) + 1))
+    np.cumsum(np.where(valid, values, 0), axis=1, out=sums[:, 1:])
+    counts = np.zeros((len(stack), len(pixels) + 1))
+    np.cumsum(valid, axis=1, out=counts[:, 1:])
+
+    sums = sums[:, offsets[1:]] - sums[:, offsets[:-1]]
+    counts = counts[:, offsets[1:]] - counts[:, offsets[:-1]]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts).T  # Polygons without valid pixels are NaN
+
+
+def weighted_means(matrix, values, chunk_size=None):
+    # Preconditions: A weight matrix and a (pixels,) band or (bands, pixels) stack have been passed, nodata is NaN.
+    #                Optional: the number of bands reduced at a time (default every band), limits the temporary copies.
+    # Postconditions: The weighted mean of every polygon (and band) has been returned as a float32 (polygons,) or
+    #                 (polygons, bands) array
+    values = np.asarray(values)
+    if values.ndim == 1:
+        return weighted_means(matrix, values[np.newaxis], chunk_size)[:, 0]
+
+    means = np.empty((matrix.shape[0], len(values)), dtype=np.float32)
+    chunk_size = chunk_size or len(values)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        valid = ~np.isnan(chunk)
+        sums = matrix @ np.where(valid, chunk, 0).T
+        weights = matrix @ valid.T.astype(np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[:, start:start + chunk_size] = sums / weights  # Polygons without valid pixels are NaN
+    return means
+
+
+def zonal_timeseries(shape_frame, geotiffs, all_touched=True, id_column='GEOID10', chunk_size=5000, stack=None, weights=None):
+    # INPUTS:
+    #   shape_frame: geopandas frame of the polygons (in the raster's CRS)
+    #   geotiffs: list of single band GeoTIFFs named by band number (ex. 1.geotiff ... 365.geotiff)
+    #   all_touched (optional): include every pixel touched by a polygon (default True)
+    #   id_column (optional): column used as the index of the output (default GEOID10)
+    #   chunk_size (optional): number of polygons (or of bands, with weights) reduced at a time, limits memory use for
+    #                          long band stacks
+    #   stack (optional): (stack, transform) returned by read_band_stack, if it has already been read
+    #   weights (optional): weight matrix of the shape frame's polygons (weight_matrix.get_weight_matrix), replaces rasterizing
+
+    # OUTPUT:
+    #   frame: dataframe with one row per polygon and one column per band (sorted by band number), holding the mean
+
+    geotiffs = sort_geotiffs(geotiffs)
+    if stack is None:
+        stack = read_band_stack(geotiffs)
+    stack, transform = stack
+
+    if weights is not None:  # The polygons' pixels are already known, so the timeseries are one sparse product
+        data = weighted_means(weights, stack.reshape(len(stack), -1), chunk_size)
+    else:
+        geometries = list(shape_frame.geometry)
+        data = np.empty((len(geometries), len(stack)), dtype=np.float32)
+        for start in range(0, len(geometries), chunk_size):
+            pixels, offsets = get_polygon_pixels(geometries[start:start + chunk_size], transform, stack.shape[1:], all_touched)
+            data[start:start + chunk_size] = zonal_means(stack, pixels, offsets)
+
+    columns = [get_band_name(geotiff) for geotiff in geotiffs]
+    return pd.DataFrame(data, index=shape_frame[id_column].astype(str).to_numpy(), columns=columns)
+
+
+def get_geoid_timeseries(geoid, shape_file, geotiffs, all_touched=True):
+    # Timeseries of a single block group. shape_file is a path or an already read geopandas frame.
+    # The shape file and band stack are cached, so calling this for many block groups only reads them once.
+    shape_frame = read_shape_file(shape_file) if isinstance(shape_file, str) else shape_file
+    shape = shape_frame[shape_frame['GEOID10'] == geoid]
+    geotiffs = sort_geotiffs(geotiffs)
+    frame = zonal_timeseries(shape, geotiffs, all_touched, stack=_read_cached_band_stack(tuple(geotiffs)))
+    return frame.iloc[0]